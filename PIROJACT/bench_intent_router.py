@@ -0,0 +1,88 @@
+"""Micro-benchmark for the chatbot intent router.
+
+Usage: python bench_intent_router.py [--corpus messages.txt] [--rounds 200]
+
+The corpus file holds one chat message per line (e.g. exported from the chat logs); without it a
+built-in sample of typical messages is used. Only routing is timed, no database work.
+"""
+import argparse
+import time
+from collections import Counter
+
+from chat_intents import route_intent
+
+SAMPLE_MESSAGES = [
+    "ticket 42",
+    "ticket #1187",
+    "show ticket 305",
+    "details for ticket 77",
+    "what is the status of ticket id 512",
+    "can you pull up ticket 9",
+    "who created ticket 88",
+    "creator of ticket 140",
+    "tickets by priya@cloudkeeper.com",
+    "show tickets for rahul",
+    "search tickets for s3 access denied",
+    "find tickets about vpn timeout",
+    "how many tickets are open",
+    "how many tickets are in progress",
+    "count of all tickets",
+    "show me the latest 3 tickets",
+    "latest 10 tickets please",
+    "open tickets",
+    "show me resolved tickets",
+    "tickets where status is pending user",
+    "hi",
+    "what is an ec2 reserved instance",
+    "how do i rotate iam access keys",
+    "billing alarm not triggering in us-east-1",
+    "cloudfront returns 403 after deploying the new bucket policy",
+    "rds storage full on the reporting db",
+    "lambda cold starts are slow for the invoice service",
+    "can you explain the difference between gp2 and gp3 volumes",
+]
+
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def load_corpus(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.strip().lower() for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chatbot intent routing latency.")
+    parser.add_argument('--corpus', help="File with one chat message per line.")
+    parser.add_argument('--rounds', type=int, default=200, help="Passes over the corpus (default 200).")
+    args = parser.parse_args()
+
+    messages = load_corpus(args.corpus) if args.corpus else [m.lower() for m in SAMPLE_MESSAGES]
+    if not messages:
+        raise SystemExit("Corpus is empty.")
+
+    for message in messages: # warm up the regex engine
+        route_intent(message)
+
+    timings = []
+    clock = time.perf_counter_ns
+    for _ in range(args.rounds):
+        for message in messages:
+            start = clock()
+            route_intent(message)
+            timings.append(clock() - start)
+    timings.sort()
+
+    intents = Counter(route_intent(message)[0] or 'none (FTS / AI)' for message in messages)
+    print(f"{len(messages)} messages x {args.rounds} rounds = {len(timings)} routings")
+    print(f"mean {sum(timings) / len(timings) / 1000:.2f} us | p50 {percentile(timings, 50) / 1000:.2f} us | "
+          f"p99 {percentile(timings, 99) / 1000:.2f} us | max {timings[-1] / 1000:.2f} us")
+    print("Intent distribution:")
+    for intent, count in intents.most_common():
+        print(f"  {intent:<20} {count}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import re
+
+# Intent router for the ticket assistant. Every pattern is folded into one compiled regex, so
+# working out what a chat message asks for is a single anchored match instead of a chain of
+# startswith/in checks. Alternatives are tried in order, so the list below is also the priority.
+
+STATUS_WORDS = {'in progress': 'In Progress', 'pending user': 'Pending User', 'pending': 'Pending User', 'open': 'Open', 'resolved': 'Resolved', 'closed': 'Closed'}
+_STATUS_ALT = '|'.join(re.escape(s) for s in STATUS_WORDS) # longest phrases first
+
+INTENT_PATTERNS = [
+    ('ticket_creator', r'(?:who created|creator of) ticket\s*#?\s*(?P<creator_id>\d+)\b'),
+    ('ticket_by_id', r'(?:ticket id|show ticket|details for ticket|ticket\s*#|ticket)\s*(?P<ticket_id>\d+)\b'),
+    ('ticket_by_trailing_id', r'(?=.*(?:ticket|id)).*\s(?P<trailing_id>\d+)\s*$'),
+    ('tickets_by_user', r'(?:tickets by|show tickets for)\b\s*(?P<user>.*)'),
+    ('search', r'(?:search tickets for|find tickets about)\b\s*(?P<keyword>.*)'),
+    ('count', rf'(?:how many tickets are|count of)\b(?:.*?(?P<count_status>{_STATUS_ALT})|.*?(?P<count_total>total tickets|all tickets))?'),
+    ('tickets_by_status', rf'(?=.*(?: tickets| status is ))(?=.*?(?P<status>{_STATUS_ALT}))'),
+    ('latest', r'(?=.*latest )(?=.* tickets)(?:.*?\blatest (?P<n>\d+)\b)?'),
+]
+
+_ROUTER_RE = re.compile('|'.join(f'(?P<{name}>{pattern})' for name, pattern in INTENT_PATTERNS), re.DOTALL)
+_INTENT_NAMES = [name for name, _ in INTENT_PATTERNS]
+
+
+def route_intent(message_lower):
+    """Returns (intent, slots) for a lower-cased chat message; intent is None when nothing matches.
+
+    slots may hold: ticket_id (int), user, keyword, status (canonical status name), total (bool), n (int).
+    """
+    match = _ROUTER_RE.match(message_lower.strip())
+    if not match:
+        return None, {}
+    intent = next(name for name in _INTENT_NAMES if match.group(name) is not None)
+    groups = match.groupdict()
+    slots = {}
+    ticket_id = groups['creator_id'] or groups['ticket_id'] or groups['trailing_id']
+    if ticket_id:
+        slots['ticket_id'] = int(ticket_id)
+    if groups['user'] is not None:
+        slots['user'] = groups['user'].strip()
+    if groups['keyword'] is not None:
+        slots['keyword'] = groups['keyword'].strip()
+    status = groups['count_status'] or groups['status']
+    if status:
+        slots['status'] = STATUS_WORDS[status]
+    if groups['count_total']:
+        slots['total'] = True
+    if groups['n']:
+        slots['n'] = int(groups['n'])
+    if intent == 'ticket_by_trailing_id':
+        intent = 'ticket_by_id'
+    return intent, slots
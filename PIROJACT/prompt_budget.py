@@ -0,0 +1,71 @@
+import math
+import re
+from collections import Counter
+
+from ticket_vectors import STOP_WORDS
+
+# Prompt sizing helpers for Gemini calls. Token counts are estimated at ~4 characters per token,
+# which is close enough for English ticket text to keep prompts bounded without paying a
+# count_tokens round trip on every call.
+
+CHARS_PER_TOKEN = 4
+TRUNCATION_MARKER = " …[truncated]"
+_SENTENCE_RE = re.compile(r'[^\n.!?]+(?:[.!?]+|\n|$)')
+_WORD_RE = re.compile(r'[^\W_]+')
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cuts text to roughly max_tokens at a word boundary, marking the cut."""
+    limit = max_tokens * CHARS_PER_TOKEN
+    if not text or len(text) <= limit:
+        return text
+    limit = max(limit - len(TRUNCATION_MARKER), 0)
+    cut = text.rfind(' ', 0, limit)
+    return text[:cut if cut > limit // 2 else limit].rstrip() + TRUNCATION_MARKER
+
+
+def extractive_summary(text, max_tokens):
+    """Shrinks text to roughly max_tokens by keeping its most representative sentences, in order.
+
+    Sentences are picked greedily by the average frequency of their words across the text (stop
+    words ignored), SumBasic style: once a sentence is picked its words' weights are squared, so
+    the next pick favours content not covered yet instead of near-duplicate lines. The first
+    sentence is always kept since it usually states the problem.
+    """
+    if not text or estimate_tokens(text) <= max_tokens:
+        return text
+    sentences = [s.strip() for s in _SENTENCE_RE.findall(text) if s.strip()]
+    if len(sentences) < 2:
+        return truncate_to_tokens(text, max_tokens)
+
+    sentence_words = [set(w for w in _WORD_RE.findall(s.lower()) if w not in STOP_WORDS) for s in sentences]
+    frequency = Counter(w for words in sentence_words for w in words)
+    total = sum(frequency.values()) or 1
+    weight = {w: count / total for w, count in frequency.items()}
+
+    budget = max_tokens * CHARS_PER_TOKEN - len(TRUNCATION_MARKER)
+    chosen = {0}
+    used = len(sentences[0])
+    candidates = [i for i in range(1, len(sentences)) if sentence_words[i]]
+    while True:
+        candidates = [i for i in candidates if i not in chosen and used + len(sentences[i]) + 1 <= budget]
+        if not candidates:
+            break
+        best = max(candidates, key=lambda i: sum(weight[w] for w in sentence_words[i]) / len(sentence_words[i]))
+        chosen.add(best)
+        used += len(sentences[best]) + 1
+        for w in sentence_words[best]:
+            weight[w] *= weight[w]
+
+    parts = []
+    for i in sorted(chosen):
+        if parts and i - 1 not in chosen:
+            parts.append("…")
+        parts.append(sentences[i])
+    if len(chosen) < len(sentences) and max(chosen) != len(sentences) - 1:
+        parts.append("…")
+    return truncate_to_tokens(" ".join(parts), max_tokens)
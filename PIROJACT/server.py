@@ -1,39 +1,112 @@
 import flask
-from flask import Flask, request, jsonify, send_from_directory, redirect, url_for, render_template, session
+from flask import Flask, request, jsonify, send_from_directory, send_file, redirect, url_for, render_template, session, abort
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import os
+import sys
 import sqlite3
 from functools import wraps
 import random
-import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import google.generativeai as genai
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from dotenv import load_dotenv
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import json 
+import re
+import base64
+import hashlib
+import tempfile
+import threading
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from chat_intents import route_intent
+from ticket_vectors import TicketVectorIndex
+from prompt_budget import estimate_tokens, truncate_to_tokens, extractive_summary
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repo root, for common/
+from common.session_store import create_session_store, ServerSessionInterface
+from common.email_outbox import EmailOutbox
+
+try:
+    import lxml # noqa: F401 -- optional, much faster HTML parsing for GDoc imports
+    GDOC_HTML_PARSER = 'lxml'
+except ImportError:
+    GDOC_HTML_PARSER = 'html.parser'
+
+try:
+    from eventlet import patcher as eventlet_patcher, tpool # present when served by gunicorn -k eventlet (wsgi.py)
+except ImportError:
+    eventlet_patcher = tpool = None
 
 load_dotenv()
 
 UPLOAD_FOLDER = 'uploads'
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 DB_PATH = './tickets.db' 
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '30'))
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+DB_CACHE_SIZE_KIB = int(os.getenv('DB_CACHE_SIZE_KIB', '65536'))
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(os.path.join(BLOB_FOLDER, 'tmp'), exist_ok=True)
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'def@ult-Sup3r-S3cr3t-Key-P13a5e-Chang3-M3!')
 CORS(app, supports_credentials=True) 
 
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Sessions live server-side (see common/session_store.py). 'memory' suits a single worker; with
+# GUNICORN_WORKERS > 1 use e.g. sqlite:///./sessions.db so every worker sees the same sessions.
+SESSION_STORE = os.getenv('SESSION_STORE', 'memory')
+SESSION_TTL = float(os.getenv('SESSION_TTL', str(7 * 24 * 3600)))
+session_store = create_session_store(SESSION_STORE, SESSION_TTL)
+app.session_interface = ServerSessionInterface(session_store)
+
+# Set SOCKETIO_MESSAGE_QUEUE when running more than one worker process so an emit from any worker
+# reaches clients attached to the others, e.g. redis://localhost:6379/0 (needs the redis package) or,
+# without a Redis server, the kombu SQLite transport sqla+sqlite:///socketio_queue.db (needs kombu
+# and SQLAlchemy). Empty keeps the single-process, in-memory behaviour.
+SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE', '')
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=SOCKETIO_MESSAGE_QUEUE or None)
 
 GEMINI_API_KEY = os.getenv('GOOGLE_API_KEY')
 OTP_EMAIL_SENDER = os.getenv('EMAIL_USER')
 OTP_EMAIL_PASSWORD = os.getenv('PASSWORD') 
+# Outgoing mail goes through the email_outbox queue (see common/email_outbox.py). For local testing point it
+# at a debugging server, e.g. `python -m aiosmtpd -n -l localhost:1025` with SMTP_HOST=localhost
+# SMTP_PORT=1025 SMTP_STARTTLS=0; login is skipped when PASSWORD is unset.
+SMTP_HOST = os.getenv('SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', '1') == '1'
+EMAIL_BATCH_SIZE = int(os.getenv('EMAIL_BATCH_SIZE', '20'))
+EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', '6'))
+EMAIL_RETENTION_DAYS = float(os.getenv('EMAIL_RETENTION_DAYS', '7')) # sent/failed outbox rows are deleted after this
+GDOC_MAX_BYTES = int(os.getenv('GDOC_MAX_BYTES', str(10 * 1024 * 1024)))
+GDOC_CACHE_MAX_ENTRIES = int(os.getenv('GDOC_CACHE_MAX_ENTRIES', '128'))
+GEMINI_MODEL_NAME = 'gemini-1.5-flash-latest'
+AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', '4'))
+AI_MAX_QUEUE = int(os.getenv('AI_MAX_QUEUE', '32'))
+AI_CALL_TIMEOUT = float(os.getenv('AI_CALL_TIMEOUT', '30'))
+AI_CACHE_MAX_ENTRIES = int(os.getenv('AI_CACHE_MAX_ENTRIES', '1024'))
+AI_CACHE_TTL = float(os.getenv('AI_CACHE_TTL', '3600'))
+GEMINI_WARMUP = os.getenv('GEMINI_WARMUP', '1') == '1'
+AI_CACHE_DB = os.getenv('AI_CACHE_DB', '') # e.g. ./ai_cache.db to keep cached replies across restarts
+TICKET_VECTOR_DIR = os.getenv('TICKET_VECTOR_DIR', './ticket_vectors')
+TICKET_VECTOR_DIM = int(os.getenv('TICKET_VECTOR_DIM', '256'))
+TICKET_VECTOR_MIN_SCORE = float(os.getenv('TICKET_VECTOR_MIN_SCORE', '0.2'))
+CHAT_SIMILAR_TICKETS = int(os.getenv('CHAT_SIMILAR_TICKETS', '5'))
+AI_PROMPT_TOKEN_BUDGET = int(os.getenv('AI_PROMPT_TOKEN_BUDGET', '3000')) # context pasted into one prompt
+AI_FIELD_TOKEN_BUDGET = int(os.getenv('AI_FIELD_TOKEN_BUDGET', '600')) # one ticket description/remedies
+TICKET_SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv('TICKET_SUMMARY_CACHE_MAX_ENTRIES', '512'))
+TICKET_NOTIFY_WINDOW = float(os.getenv('TICKET_NOTIFY_WINDOW', '0.5')) # seconds of changes folded into one tickets_changed event
+TICKET_NOTIFY_MAX_BATCH = int(os.getenv('TICKET_NOTIFY_MAX_BATCH', '200'))
 
 
 
@@ -48,8 +121,53 @@ else:
         print(f"Error configuring Gemini API: {e}")
         GEMINI_API_KEY = None 
 
+# --- Connection pool ---
+# Connections are opened with check_same_thread=False so an idle one can be handed to
+# whichever OS thread / eventlet greenthread asks next. A borrowed connection is owned
+# exclusively by the borrower until it is released, so it is never used concurrently.
+_db_pool = []
+_db_pool_lock = threading.Lock()
+
+def _open_db_connection():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # Per-connection pragmas; journal_mode=WAL is persistent and is set once in init_db().
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KIB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def acquire_db():
+    with _db_pool_lock:
+        conn = _db_pool.pop() if _db_pool else None
+    return conn if conn is not None else _open_db_connection()
+
+def release_db(conn):
+    if conn.in_transaction:
+        conn.rollback()
+    with _db_pool_lock:
+        if len(_db_pool) < DB_POOL_SIZE:
+            _db_pool.append(conn)
+            return
+    conn.close()
+
+@contextmanager
+def get_db():
+    """Borrow a pooled connection. Commits on success, rolls back on error."""
+    conn = acquire_db()
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        release_db(conn)
+
 def init_db():
     with sqlite3.connect(DB_PATH) as conn:
+        mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
         conn.execute('''CREATE TABLE IF NOT EXISTS tickets (
                             id INTEGER PRIMARY KEY AUTOINCREMENT,
                             title TEXT NOT NULL,
@@ -68,15 +186,279 @@ def init_db():
                             otp TEXT,
                             verified INTEGER DEFAULT 0
                         )''')
+        init_ticket_timestamps(conn)
+        init_ticket_search(conn)
+        init_ticket_counters(conn)
+        init_attachments(conn)
+        init_ticket_vectors(conn)
+        email_outbox.init_table(conn)
         conn.commit()
-    print(f"Database initialized/checked at {DB_PATH}")
+    print(f"Database initialized/checked at {DB_PATH} (journal_mode={mode})")
+
+# --- Normalized timestamps ---
+# created_at is stored as entered ('%Y-%m-%dT%H:%M'); created_at_ts mirrors it as epoch seconds
+# (0 when unparseable) so ordering, keyset paging and per-day grouping can use plain indexes.
+CREATED_AT_TS_SQL = "COALESCE(CAST(strftime('%s', {}) AS INTEGER), 0)"
+
+def init_ticket_timestamps(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(tickets)")}
+    if 'created_at_ts' not in columns:
+        conn.execute("ALTER TABLE tickets ADD COLUMN created_at_ts INTEGER")
+        print("Added tickets.created_at_ts column.")
+    backfilled = conn.execute(f"UPDATE tickets SET created_at_ts = {CREATED_AT_TS_SQL.format('created_at')} WHERE created_at_ts IS NULL").rowcount
+    if backfilled:
+        print(f"Backfilled created_at_ts for {backfilled} ticket(s).")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_created_at_ts ON tickets (created_at_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_status_created_at_ts ON tickets (status, created_at_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_created_by_created_at_ts ON tickets (created_by, created_at_ts)")
+
+# --- Dashboard counters ---
+# ticket_counters holds per-status, per-day and per-creator ticket counts so dashboard polls read
+# a handful of rows instead of aggregating the whole tickets table. submit_ticket and update_ticket
+# adjust it in the same transaction as their write; `flask --app server rebuild-counters` repairs drift.
+def init_ticket_counters(conn):
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ticket_counters'").fetchone()
+    conn.execute('''CREATE TABLE IF NOT EXISTS ticket_counters (
+                        kind TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        count INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (kind, key)
+                    ) WITHOUT ROWID''')
+    if not exists:
+        rebuild_ticket_counters(conn)
+
+def rebuild_ticket_counters(conn):
+    conn.execute("DELETE FROM ticket_counters")
+    conn.execute("INSERT INTO ticket_counters (kind, key, count) SELECT 'status', status, COUNT(*) FROM tickets WHERE status IS NOT NULL GROUP BY status")
+    conn.execute("INSERT INTO ticket_counters (kind, key, count) SELECT 'day', date(MIN(created_at_ts), 'unixepoch'), COUNT(*) FROM tickets WHERE created_at_ts > 0 GROUP BY created_at_ts / 86400")
+    conn.execute("INSERT INTO ticket_counters (kind, key, count) SELECT 'creator', created_by, COUNT(*) FROM tickets WHERE created_by IS NOT NULL GROUP BY created_by")
+    return conn.execute("SELECT COUNT(*) FROM ticket_counters").fetchone()[0]
+
+def bump_ticket_counters(cur, delta, status=None, created_by=None, day=None):
+    keys = [(kind, key) for kind, key in (('status', status), ('creator', created_by), ('day', day)) if key]
+    cur.executemany("INSERT INTO ticket_counters (kind, key, count) VALUES (?, ?, ?) ON CONFLICT (kind, key) DO UPDATE SET count = count + excluded.count",
+                    [(kind, key, delta) for kind, key in keys])
+
+@app.cli.command('rebuild-counters')
+def rebuild_counters_command():
+    """Recompute ticket_counters from the tickets table."""
+    init_db()
+    with get_db() as conn:
+        rows = rebuild_ticket_counters(conn)
+    print(f"Rebuilt ticket_counters: {rows} row(s).")
+
+# --- Attachments ---
+# Uploaded files live in a content-addressed store: uploads/blobs/<aa>/<bb>/<sha256>. Identical
+# uploads share one blob, and the attachments table records which ticket uses which blob under
+# what name. They are served as uploads/<sha256>/<filename>, which never changes content, so
+# the sha256 doubles as a strong ETag. Tickets created before this keep their legacy
+# file_path/remedy_doc_path strings, which are merged in when tickets are read.
+_BLOB_URL_RE = re.compile(r'^([0-9a-f]{64})/([^/]+)$')
+
+def init_attachments(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS attachments (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        ticket_id INTEGER NOT NULL REFERENCES tickets(id),
+                        kind TEXT NOT NULL, /* 'screenshot' or 'remedy_doc' */
+                        sha256 TEXT NOT NULL,
+                        filename TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        content_type TEXT,
+                        created_at TEXT NOT NULL DEFAULT (datetime('now'))
+                    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_attachments_ticket_id ON attachments (ticket_id)")
+
+def blob_path(sha256):
+    return os.path.join(BLOB_FOLDER, sha256[:2], sha256[2:4], sha256)
+
+def store_upload(file_obj):
+    """Streams an uploaded file into the blob store. Returns (sha256, size); identical content is stored once."""
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.join(BLOB_FOLDER, 'tmp'))
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            while True:
+                chunk = file_obj.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+        sha256 = digest.hexdigest()
+        final_path = blob_path(sha256)
+        if os.path.exists(final_path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path)
+        return sha256, size
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def attachment_url_path(sha256, filename):
+    return f"{UPLOAD_FOLDER}/{sha256}/{filename}"
+
+def upload_route_filename(url_path):
+    """Maps a stored 'uploads/...' path to the <filename> argument of the uploaded_file route."""
+    prefix = UPLOAD_FOLDER + '/'
+    url_path = url_path.replace(os.sep, '/')
+    return url_path[len(prefix):] if url_path.startswith(prefix) else os.path.basename(url_path)
+
+def merge_ticket_attachments(cur, ticket_dicts):
+    """Adds attachment-table files to the file_path/remedy_doc_path of each ticket dict that has those keys."""
+    wanted = [t for t in ticket_dicts if 'file_path' in t or 'remedy_doc_path' in t]
+    if not wanted:
+        return ticket_dicts
+    by_id = {t['id']: t for t in wanted}
+    ids = list(by_id)
+    for i in range(0, len(ids), 500):
+        batch = ids[i:i + 500]
+        cur.execute(f"SELECT ticket_id, kind, sha256, filename FROM attachments WHERE ticket_id IN ({','.join('?' * len(batch))}) ORDER BY id", batch)
+        for row in cur.fetchall():
+            ticket = by_id[row['ticket_id']]
+            path = attachment_url_path(row['sha256'], row['filename'])
+            if row['kind'] == 'remedy_doc' and 'remedy_doc_path' in ticket:
+                ticket['remedy_doc_path'] = path
+            elif row['kind'] == 'screenshot' and 'file_path' in ticket:
+                ticket['file_path'].append(path)
+    return ticket_dicts
+
+# --- Full-text search ---
+# tickets_fts is an external-content FTS5 index over tickets; the triggers below keep it in
+# step with every INSERT/UPDATE/DELETE, so submit_ticket and update_ticket need no extra work.
+TICKET_FTS_COLUMNS = ['title', 'description', 'remedies', 'created_by', 'status', 'created_at']
+TICKET_FTS_WEIGHTS = '10.0, 4.0, 2.0, 3.0, 1.0, 1.0' # bm25() weights, same order as TICKET_FTS_COLUMNS
+
+def init_ticket_search(conn):
+    cols = ", ".join(TICKET_FTS_COLUMNS)
+    new_cols = ", ".join(f"new.{c}" for c in TICKET_FTS_COLUMNS)
+    old_cols = ", ".join(f"old.{c}" for c in TICKET_FTS_COLUMNS)
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tickets_fts'").fetchone()
+    conn.execute(f'''CREATE VIRTUAL TABLE IF NOT EXISTS tickets_fts USING fts5(
+                        {cols}, content='tickets', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+                    )''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS tickets_fts_ai AFTER INSERT ON tickets BEGIN
+                        INSERT INTO tickets_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+                    END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS tickets_fts_ad AFTER DELETE ON tickets BEGIN
+                        INSERT INTO tickets_fts(tickets_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                    END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS tickets_fts_au AFTER UPDATE OF {cols} ON tickets BEGIN
+                        INSERT INTO tickets_fts(tickets_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                        INSERT INTO tickets_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+                    END''')
+    if not exists:
+        conn.execute("INSERT INTO tickets_fts(tickets_fts) VALUES ('rebuild')")
+        print("Built tickets_fts full-text index from existing tickets.")
+
+_FTS_TOKEN_RE = re.compile(r'[^\W_]+')
+
+def to_fts_query(text, columns=None):
+    """Turn free text into an FTS5 MATCH expression.
+
+    Every whitespace-separated word becomes a quoted phrase of its tokens with a prefix match
+    on the last one, so 'bob@cloud' matches 'bob@cloudkeeper.com' and '2024-05' matches dates.
+    Returns '' when the text has nothing searchable.
+    """
+    phrases = []
+    for word in text.lower().split():
+        tokens = _FTS_TOKEN_RE.findall(word)
+        if tokens:
+            phrases.append('"' + " ".join(tokens) + '"*')
+    if not phrases:
+        return ""
+    expr = " AND ".join(phrases)
+    if columns:
+        return "{" + " ".join(columns) + "} : (" + expr + ")"
+    return expr
+
+def search_tickets(cur, text, select_cols, columns=None, limit=None, after=None):
+    """bm25-ranked full-text search over tickets. select_cols refer to the tickets table as 't'.
+
+    Rows come back with an extra 'rank' column ordered by (rank, id); pass the (rank, id) of the
+    last row as after= to continue from there.
+    """
+    match = to_fts_query(text, columns)
+    if not match:
+        return []
+    query = f"SELECT * FROM (SELECT {select_cols}, bm25(tickets_fts, {TICKET_FTS_WEIGHTS}) AS rank FROM tickets_fts JOIN tickets t ON t.id = tickets_fts.rowid WHERE tickets_fts MATCH ?)"
+    params = [match]
+    if after is not None:
+        query += " WHERE rank > ? OR (rank = ? AND id > ?)"
+        params.extend([after[0], after[0], after[1]])
+    query += " ORDER BY rank, id"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    cur.execute(query, params)
+    return cur.fetchall()
+
+# --- Similar-ticket index ---
+# ticket_vector_index (see ticket_vectors.py) ranks tickets by overall word overlap with a chat
+# message, so the chatbot still finds related tickets when full-text search (which needs every
+# word to match) comes back short. It is built from the tickets table when missing or when its
+# dimension changes, or offline with `flask --app server rebuild-vector-index`; submit_ticket and
+# update_ticket append to it after their transaction commits.
+ticket_vector_index = TicketVectorIndex(TICKET_VECTOR_DIR, TICKET_VECTOR_DIM)
+
+def ticket_vector_rows(conn):
+    cur = conn.execute("SELECT id, title, description, remedies FROM tickets ORDER BY id")
+    while True:
+        batch = cur.fetchmany(1000)
+        if not batch:
+            return
+        for ticket_id, title, description, remedies in batch:
+            yield ticket_id, {'title': title, 'description': description, 'remedies': remedies}
+
+def init_ticket_vectors(conn):
+    if ticket_vector_index.needs_rebuild():
+        rows = ticket_vector_index.rebuild(ticket_vector_rows(conn))
+        print(f"Built similar-ticket index from {rows} ticket(s) at {TICKET_VECTOR_DIR}.")
+
+def index_ticket_vector(ticket_id, title, description, remedies):
+    try:
+        ticket_vector_index.upsert(ticket_id, {'title': title, 'description': description, 'remedies': remedies})
+    except Exception as e:
+        app.logger.error(f"Failed to update similar-ticket index for ticket {ticket_id}: {e}")
+
+@app.cli.command('rebuild-vector-index')
+def rebuild_vector_index_command():
+    """Recompute the similar-ticket index from the tickets table (also drops superseded rows)."""
+    init_db()
+    with get_db() as conn:
+        rows = ticket_vector_index.rebuild(ticket_vector_rows(conn))
+    print(f"Rebuilt similar-ticket index: {rows} ticket(s).")
+
+def similar_tickets(cur, text, select_cols, limit, exclude_ids=()):
+    """Tickets closest to text in the vector index, best first. select_cols refer to the tickets table as 't'."""
+    if limit <= 0:
+        return []
+    exclude_ids = set(exclude_ids)
+    hits = ticket_vector_index.search(text, limit + len(exclude_ids), min_score=TICKET_VECTOR_MIN_SCORE)
+    ids = [ticket_id for ticket_id, _ in hits if ticket_id not in exclude_ids][:limit]
+    if not ids:
+        return []
+    cur.execute(f"SELECT {select_cols} FROM tickets t WHERE t.id IN ({','.join('?' * len(ids))})", ids)
+    by_id = {row['id']: row for row in cur.fetchall()}
+    return [by_id[ticket_id] for ticket_id in ids if ticket_id in by_id]
+
+# --- Email outbox ---
+# One outbox per process, backed by the tickets DB so queued mail survives restarts. The sender
+# thread is started at boot (to drain anything left over) and again, idempotently, on enqueue.
+email_outbox = EmailOutbox(DB_PATH, SMTP_HOST, SMTP_PORT, username=OTP_EMAIL_SENDER, password=OTP_EMAIL_PASSWORD,
+                           starttls=SMTP_STARTTLS, batch_size=EMAIL_BATCH_SIZE, max_attempts=EMAIL_MAX_ATTEMPTS,
+                           retention=EMAIL_RETENTION_DAYS * 24 * 3600)
 
 def is_valid_email(email):
     return email and email.endswith('@cloudkeeper.com')
 
 def send_otp_email(to_email, otp):
-    if not OTP_EMAIL_SENDER or not OTP_EMAIL_PASSWORD:
-        print(f"ERROR: OTP Email credentials not configured in .env. Cannot send OTP. SENDER: {OTP_EMAIL_SENDER}, PASS_CONFIGURED: {bool(OTP_EMAIL_PASSWORD)}")
+    """Queues the OTP email; the outbox sender delivers it in the background. Returns False only if it could not be queued."""
+    if not OTP_EMAIL_SENDER:
+        print("ERROR: OTP Email sender (EMAIL_USER) not configured in .env. Cannot send OTP.")
         return False
 
     msg = MIMEMultipart('alternative')
@@ -117,22 +499,36 @@ The CloudKeeper Team
     msg.attach(MIMEText(html, 'html'))
 
     try:
-        with smtplib.SMTP('smtp.gmail.com', 587) as server:
-            server.starttls()
-            server.login(OTP_EMAIL_SENDER, OTP_EMAIL_PASSWORD) 
-            server.sendmail(msg['From'], [msg['To']], msg.as_string())
-            print(f"OTP email sent successfully to {to_email}!")
-            return True
-    except Exception as e:
-        print(f"Failed to send OTP email to {to_email}: {e}")
+        outbox_id = email_outbox.enqueue(msg)
+    except sqlite3.Error as e:
+        print(f"Failed to queue OTP email to {to_email}: {e}")
         return False
-
+    email_outbox.start()
+    print(f"OTP email to {to_email} queued (outbox id {outbox_id}).")
+    return True
+
+def cached_user(username):
+    """The user's {username, verified} record from the session store; the users table is read only on a miss."""
+    record = session_store.get_user(username)
+    if record is None:
+        with get_db() as conn:
+            row = conn.execute("SELECT username, verified FROM users WHERE username = ?", (username,)).fetchone()
+        record = {"username": username, "verified": bool(row and row['verified'])}
+        session_store.put_user(username, record)
+    return record
+
+def session_is_verified():
+    """The check login_required makes, for handlers that cannot redirect (Socket.IO)."""
+    return 'username' in session and cached_user(session['username'])['verified']
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'username' not in session:
             return redirect(url_for('login', next=request.url))
+        if not cached_user(session['username'])['verified']:
+            session.pop('username', None)
+            return redirect(url_for('login', next=request.url))
         return f(*args, **kwargs)
     return decorated_function
 
@@ -147,14 +543,15 @@ def login():
         if not is_valid_email(username):
             return render_template('login.html', error="Invalid email. Must be @cloudkeeper.com.")
         
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_db() as conn:
             cur = conn.cursor()
             # TODO: HASH CHECK! This is insecure.
             cur.execute("SELECT * FROM users WHERE username = ? AND password = ? AND verified = 1", (username, password))
             user = cur.fetchone()
             if user:
+                session.regenerate()
                 session['username'] = user['username']
+                session_store.put_user(user['username'], {"username": user['username'], "verified": True})
                 next_url = request.args.get('next')
                 print(f"User '{username}' logged in successfully.")
                 return redirect(next_url or url_for('form')) 
@@ -187,8 +584,7 @@ def signup():
 
         otp = str(random.randint(100000, 999999))
 
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_db() as conn:
             cur = conn.cursor()
             cur.execute("SELECT id, username, verified FROM users WHERE username = ?", (username,))
             existing_user = cur.fetchone()
@@ -199,6 +595,7 @@ def signup():
                  else: 
                     cur.execute("UPDATE users SET password = ?, otp = ? WHERE id = ?", (password, otp, existing_user['id'])) 
                     conn.commit()
+                    session_store.invalidate_user(username)
                     print(f"OTP updated for existing unverified user: {username}")
                     if send_otp_email(username, otp):
                         session['pending_user'] = username
@@ -208,6 +605,7 @@ def signup():
             else:
                 cur.execute("INSERT INTO users (username, password, otp, verified) VALUES (?, ?, ?, 0)", (username, password, otp)) 
                 conn.commit()
+                session_store.invalidate_user(username)
                 print(f"New user created: {username}")
                 if send_otp_email(username, otp):
                     session['pending_user'] = username
@@ -239,8 +637,7 @@ def verify_otp():
         if not otp_input:
             return render_template('verify.html', error="OTP is required.", email=email_to_verify_on_post, message=message_from_redirect)
         
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_db() as conn:
             cur = conn.cursor()
             cur.execute("SELECT otp, verified FROM users WHERE username = ?", (email_to_verify_on_post,))
             user_record = cur.fetchone()
@@ -248,6 +645,7 @@ def verify_otp():
             if user_record and not user_record['verified'] and user_record['otp'] == otp_input:
                 cur.execute("UPDATE users SET verified = 1, otp = NULL WHERE username = ?", (email_to_verify_on_post,))
                 conn.commit()
+                session_store.invalidate_user(email_to_verify_on_post)
                 session.pop('pending_user', None)
                 print(f"User {email_to_verify_on_post} verified successfully.")
                 return redirect(url_for('login', success='Your email has been verified! Please log in.'))
@@ -272,7 +670,7 @@ def logout():
 
 @socketio.on('connect')
 def handle_socket_connect():
-    if 'username' in session:
+    if session_is_verified():
         username = session['username']
         join_room(username) 
         join_room('all_authenticated_users') 
@@ -290,6 +688,45 @@ def handle_socket_disconnect():
     else:
         print(f"SocketIO Anonymous client ({request.sid}) disconnected.")
 
+# --- Ticket notifications ---
+# Ticket changes are not emitted from the request that made them. notify_ticket_change() records the
+# change, keyed by ticket id so repeated edits to one ticket collapse into its latest state, and the
+# first change in a window schedules a background flush TICKET_NOTIFY_WINDOW seconds later. The flush
+# sends everything collected as a single 'tickets_changed' event: {"changes": [...], "more": n}, where
+# each change carries kind ('created' or 'updated'), the ticket fields pages render, message and
+# updated_by. Beyond TICKET_NOTIFY_MAX_BATCH changes only the count is sent in "more" and pages reload.
+_pending_ticket_changes = OrderedDict() # ticket_id -> change
+_pending_ticket_changes_lock = threading.Lock()
+_ticket_flush_scheduled = False
+
+def notify_ticket_change(change):
+    global _ticket_flush_scheduled
+    with _pending_ticket_changes_lock:
+        previous = _pending_ticket_changes.pop(change['id'], None)
+        if previous is not None and previous['kind'] == 'created':
+            change = dict(change, kind='created') # created and edited within one window is still new to clients
+        _pending_ticket_changes[change['id']] = change
+        if _ticket_flush_scheduled:
+            return
+        _ticket_flush_scheduled = True
+    socketio.start_background_task(_flush_ticket_changes)
+
+def _flush_ticket_changes():
+    global _ticket_flush_scheduled
+    socketio.sleep(TICKET_NOTIFY_WINDOW)
+    with _pending_ticket_changes_lock:
+        changes = list(_pending_ticket_changes.values())
+        _pending_ticket_changes.clear()
+        _ticket_flush_scheduled = False
+    if not changes:
+        return
+    payload = {"changes": changes[:TICKET_NOTIFY_MAX_BATCH], "more": max(len(changes) - TICKET_NOTIFY_MAX_BATCH, 0)}
+    try:
+        socketio.emit('tickets_changed', payload, room='all_authenticated_users')
+        print(f"Emitted tickets_changed for {len(changes)} ticket(s).")
+    except Exception as e:
+        app.logger.error(f"Failed to emit tickets_changed for {len(changes)} ticket(s): {e}")
+
 @app.route('/submit', methods=['POST'])
 @login_required
 def submit_ticket():
@@ -302,6 +739,7 @@ def submit_ticket():
     created_at = ""
     file_path_str = ""
     remedy_doc_path = None
+    new_attachments = [] # (kind, sha256, filename, size, content_type)
 
     is_json_request = request.is_json 
 
@@ -321,45 +759,50 @@ def submit_ticket():
         remedies = request.form.get('remedies', '')
         created_by = request.form.get('created_by', current_user)
         created_at = request.form.get('created_at')
-        
+
+    if not all([title, created_by, created_at]):
+        app.logger.warning(f"Submit ticket: Missing required fields. Title: {title}, CreatedBy: {created_by}, CreatedAt: {created_at}")
+        return jsonify({"success": False, "detail": "Title, Submitted By, and Date of Occurrence are required."}), 400
+
+    # Blobs are only written once the ticket is known to be valid, so a rejected submit stores nothing.
+    if not is_json_request:
         uploaded_files = request.files.getlist('screenshot') 
-        saved_file_paths = []
         if uploaded_files:
             for file_obj in uploaded_files:
                 if file_obj and file_obj.filename:
-                    filename = secure_filename(file_obj.filename)
-                    file_save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                    filename = secure_filename(file_obj.filename) or 'file'
                     try:
-                        file_obj.save(file_save_path)
-                        saved_file_paths.append(file_save_path)
+                        sha256, size = store_upload(file_obj)
+                        new_attachments.append(('screenshot', sha256, filename, size, file_obj.mimetype))
                     except Exception as e:
                         app.logger.error(f"Failed to save uploaded file {filename}: {e}")
                         return jsonify({"success": False, "detail": f"Failed to save file {filename}."}), 500
-        file_path_str = ";".join(saved_file_paths)
 
         remedy_doc = request.files.get('remedy_doc') 
         if remedy_doc and remedy_doc.filename:
-            remedy_filename = secure_filename(remedy_doc.filename)
-            remedy_doc_path = os.path.join(app.config['UPLOAD_FOLDER'], remedy_filename)
+            remedy_filename = secure_filename(remedy_doc.filename) or 'document'
             try:
-                remedy_doc.save(remedy_doc_path)
+                sha256, size = store_upload(remedy_doc)
+                new_attachments.append(('remedy_doc', sha256, remedy_filename, size, remedy_doc.mimetype))
             except Exception as e:
                 app.logger.error(f"Failed to save remedy doc {remedy_filename}: {e}")
                 return jsonify({"success": False, "detail": f"Failed to save remedy document {remedy_filename}."}), 500
 
-    if not all([title, created_by, created_at]):
-        app.logger.warning(f"Submit ticket: Missing required fields. Title: {title}, CreatedBy: {created_by}, CreatedAt: {created_at}")
-        return jsonify({"success": False, "detail": "Title, Submitted By, and Date of Occurrence are required."}), 400
-
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with get_db() as conn:
             cur = conn.cursor()
             cur.execute(
-                'INSERT INTO tickets (title, description, remedies, file_path, remedy_doc_path, created_by, created_at, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                (title, description, remedies, file_path_str, remedy_doc_path, created_by, created_at, 'Open')
+                f'INSERT INTO tickets (title, description, remedies, file_path, remedy_doc_path, created_by, created_at, created_at_ts, status) VALUES (?, ?, ?, ?, ?, ?, ?, {CREATED_AT_TS_SQL.format("?")}, ?)',
+                (title, description, remedies, file_path_str, remedy_doc_path, created_by, created_at, created_at, 'Open')
             )
             new_ticket_id = cur.lastrowid
+            cur.executemany("INSERT INTO attachments (ticket_id, kind, sha256, filename, size, content_type) VALUES (?, ?, ?, ?, ?, ?)",
+                            [(new_ticket_id,) + attachment for attachment in new_attachments])
+            cur.execute("SELECT date(created_at_ts, 'unixepoch') FROM tickets WHERE id = ? AND created_at_ts > 0", (new_ticket_id,))
+            day_row = cur.fetchone()
+            bump_ticket_counters(cur, 1, status='Open', created_by=created_by, day=day_row[0] if day_row else None)
             conn.commit()
+        index_ticket_vector(new_ticket_id, title, description, remedies)
     except sqlite3.Error as e:
         app.logger.error(f"Database error during ticket submission: {e}")
         return jsonify({"success": False, "detail": "A database error occurred while creating the ticket."}), 500
@@ -377,15 +820,16 @@ def submit_ticket():
         except ValueError:
             app.logger.warning(f"Could not parse created_at string '{created_at}' for ticket {new_ticket_id}. Using as is for display.")
         
-        print(f"Emitting new_ticket_notification for ticket {new_ticket_id}")
-        socketio.emit('new_ticket_notification', {
+        notify_ticket_change({
+            'kind': 'created',
             'id': new_ticket_id, 
             'title': title, 
             'created_by': created_by, 
             'status': 'Open',
             'created_at_display': created_at_display_str, 
-            'message': f'New ticket #{new_ticket_id} ("{title}") by {created_by} has been created.'
-        }, room='all_authenticated_users')
+            'message': f'New ticket #{new_ticket_id} ("{title}") by {created_by} has been created.',
+            'updated_by': current_user
+        })
         
         return jsonify({"success": True, "message": "Ticket created successfully!", "ticket_id": new_ticket_id})
     else:
@@ -401,33 +845,103 @@ def form():
                            username=session.get('username'))
 
 
+TICKET_FIELDS = ['id', 'title', 'description', 'remedies', 'file_path', 'remedy_doc_path', 'created_by', 'created_at', 'status']
+TICKETS_PAGE_MAX = 500
+
+def encode_cursor(mode, key, ticket_id):
+    raw = json.dumps([mode, key, ticket_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor, mode):
+    """Returns (key, id) from an opaque cursor, or raises ValueError if it is malformed or from another listing."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_mode, key, ticket_id = json.loads(raw)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if cursor_mode != mode or not isinstance(ticket_id, int):
+        raise ValueError("Cursor does not belong to this listing")
+    return key, ticket_id
+
+def ticket_row_to_dict(row, fields=None):
+    ticket_dict = {f: row[f] for f in fields} if fields else dict(row)
+    if 'file_path' in ticket_dict:
+        if ticket_dict['file_path'] and isinstance(ticket_dict['file_path'], str):
+            ticket_dict['file_path'] = [path.strip() for path in ticket_dict['file_path'].split(';') if path.strip()]
+        else:
+            ticket_dict['file_path'] = []
+    return ticket_dict
+
 @app.route('/tickets', methods=['GET'])
 @login_required
 def get_tickets():
-    search = request.args.get('search', '')
-    query = "SELECT id, title, description, remedies, file_path, remedy_doc_path, created_by, created_at, status FROM tickets WHERE 1=1"
-    params = []
-    if search:
-        search_term_like = f"%{search}%"
-        query += " AND (LOWER(title) LIKE LOWER(?) OR LOWER(description) LIKE LOWER(?) OR LOWER(created_by) LIKE LOWER(?) OR LOWER(created_at) LIKE LOWER(?) OR LOWER(id) LIKE LOWER(?) OR LOWER(status) LIKE LOWER(?))"
-        params.extend([search_term_like] * 6)
-    query += " ORDER BY datetime(created_at) DESC"
+    """Lists tickets, newest first, or bm25-ranked when ?search= is given.
+
+    Optional ?fields=id,title,... projects the columns returned. With ?limit=N (and the
+    ?cursor= from the previous page) the response is {"tickets": [...], "next_cursor": ...}
+    instead of a bare list.
+    """
+    search = request.args.get('search', '').strip()
+    fields = TICKET_FIELDS
+    if request.args.get('fields'):
+        fields = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+        unknown = [f for f in fields if f not in TICKET_FIELDS]
+        if unknown:
+            return jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400
+        if 'id' not in fields:
+            fields.insert(0, 'id')
+    paginate = 'limit' in request.args or 'cursor' in request.args
+    limit = None
+    if paginate:
+        limit = request.args.get('limit', 50, type=int)
+        if limit is None or limit < 1:
+            return jsonify({"error": "limit must be a positive integer"}), 400
+        limit = min(limit, TICKETS_PAGE_MAX)
+    cursor = request.args.get('cursor')
+    select_cols = ", ".join(f"t.{f}" for f in fields)
     
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        after = decode_cursor(cursor, 'search' if search else 'recent') if cursor else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with get_db() as conn:
             cur = conn.cursor()
-            cur.execute(query, params)
-            tickets_raw = cur.fetchall()
-            tickets = []
-            for row in tickets_raw:
-                ticket_dict = dict(row)
-                if 'file_path' in ticket_dict and ticket_dict['file_path'] and isinstance(ticket_dict['file_path'], str):
-                    ticket_dict['file_path'] = [path.strip() for path in ticket_dict['file_path'].split(';') if path.strip()]
+            fetch_limit = limit + 1 if limit else None
+            if search:
+                tickets_raw = []
+                if search.isdigit() and after is None:
+                    # An exact id hit ranks ahead of every bm25 score (which are always > -1e300).
+                    cur.execute(f"SELECT {select_cols}, -1e300 AS rank FROM tickets t WHERE t.id = ?", (int(search),))
+                    tickets_raw.extend(cur.fetchall())
+                seen_ids = {row['id'] for row in tickets_raw}
+                tickets_raw.extend(row for row in search_tickets(cur, search, select_cols, ['title', 'description', 'created_by', 'status', 'created_at'], limit=fetch_limit, after=after) if row['id'] not in seen_ids)
+            else:
+                query = f"SELECT {select_cols}, t.created_at_ts AS sort_key FROM tickets t"
+                params = []
+                if after is not None:
+                    query += " WHERE (t.created_at_ts, t.id) < (?, ?)"
+                    params = list(after)
+                query += " ORDER BY t.created_at_ts DESC, t.id DESC"
+                if fetch_limit:
+                    query += " LIMIT ?"
+                    params.append(fetch_limit)
+                cur.execute(query, params)
+                tickets_raw = cur.fetchall()
+
+            if not paginate:
+                return jsonify(merge_ticket_attachments(cur, [ticket_row_to_dict(row, fields) for row in tickets_raw]))
+
+            page = tickets_raw[:limit]
+            next_cursor = None
+            if len(tickets_raw) > limit:
+                last = page[-1]
+                if search:
+                    next_cursor = encode_cursor('search', last['rank'], last['id'])
                 else:
-                    ticket_dict['file_path'] = []
-                tickets.append(ticket_dict)
-            return jsonify(tickets)
+                    next_cursor = encode_cursor('recent', last['sort_key'], last['id'])
+            return jsonify({"tickets": merge_ticket_attachments(cur, [ticket_row_to_dict(row, fields) for row in page]), "next_cursor": next_cursor})
     except Exception as e:
         app.logger.error(f"Error fetching tickets: {e}")
         return jsonify({"error": "Failed to retrieve tickets"}), 500
@@ -437,9 +951,9 @@ def get_tickets():
 @login_required
 def get_ticket_status_summary():
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row; cur = conn.cursor()
-            cur.execute("SELECT status, COUNT(*) as count FROM tickets GROUP BY status")
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT key AS status, count FROM ticket_counters WHERE kind = 'status'")
             db_summary = {row['status']: row['count'] for row in cur.fetchall() if row['status']}
             config = {"Open": {"c":0,"color":"rgba(255,159,64,0.8)"},"In Progress":{"c":0,"color":"rgba(54,162,235,0.8)"},"Resolved":{"c":0,"color":"rgba(75,192,192,0.8)"},"Closed":{"c":0,"color":"rgba(150,150,150,0.8)"},"Pending User":{"c":0,"color":"rgba(201,203,207,0.8)"}}
             for s, d_val in config.items(): # Renamed 'data' to 'd_val'
@@ -454,9 +968,9 @@ def get_ticket_status_summary():
 @login_required
 def get_tickets_over_time_counts():
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row; cur = conn.cursor()
-            cur.execute("""SELECT DATE(created_at) as creation_date, COUNT(*) as count FROM tickets WHERE DATE(created_at) >= DATE('now', '-30 days') GROUP BY DATE(created_at) ORDER BY creation_date ASC""")
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute("""SELECT key as creation_date, count FROM ticket_counters WHERE kind = 'day' AND key >= date('now', '-30 days') AND count > 0 ORDER BY key ASC""")
             rows = cur.fetchall()
             return jsonify({"labels": [r['creation_date'] for r in rows if r['creation_date']], "counts": [r['count'] for r in rows if r['creation_date']]})
     except Exception as e: 
@@ -467,18 +981,12 @@ def get_tickets_over_time_counts():
 @login_required
 def get_ticket(ticket_id):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_db() as conn:
             cur = conn.cursor()
             cur.execute("SELECT id, title, description, remedies, file_path, remedy_doc_path, created_by, created_at, status FROM tickets WHERE id=?", (ticket_id,))
             row = cur.fetchone()
             if row:
-                ticket_dict = dict(row)
-                if 'file_path' in ticket_dict and ticket_dict['file_path'] and isinstance(ticket_dict['file_path'], str):
-                    ticket_dict['file_path'] = [path.strip() for path in ticket_dict['file_path'].split(';') if path.strip()]
-                else:
-                    ticket_dict['file_path'] = []
-                return jsonify(ticket_dict)
+                return jsonify(merge_ticket_attachments(cur, [ticket_row_to_dict(row)])[0])
             return jsonify({"error": "Ticket not found"}), 404
     except Exception as e:
         app.logger.error(f"Error fetching ticket {ticket_id}: {e}")
@@ -502,8 +1010,7 @@ def update_ticket(ticket_id):
         return jsonify({"error": "Title is required"}), 400
     
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_db() as conn:
             cur = conn.cursor()
             cur.execute("SELECT created_by, status, title, created_at FROM tickets WHERE id = ?", (ticket_id,))
             original_ticket = cur.fetchone()
@@ -520,10 +1027,17 @@ def update_ticket(ticket_id):
 
             cur.execute('''UPDATE tickets SET title = ?, description = ?, remedies = ?, status = ? WHERE id = ?''',
                          (title, description, remedies, new_status, ticket_id))
+            updated = cur.rowcount # read before the counter upserts reuse the cursor
+            if updated and new_status != original_ticket['status']:
+                bump_ticket_counters(cur, -1, status=original_ticket['status'])
+                bump_ticket_counters(cur, 1, status=new_status)
             conn.commit()
 
-            if cur.rowcount == 0:
+            if updated == 0:
                 app.logger.info(f"No rows updated for ticket {ticket_id}, possibly no changes or ID mismatch on update.")
+
+        ai_response_cache.invalidate_tag(f"ticket:{ticket_id}")
+        index_ticket_vector(ticket_id, title, description, remedies)
     
         msg = f'Ticket #{ticket_id} ("{title}") updated by {current_user}.'
         if new_status and new_status != original_ticket['status']:
@@ -539,19 +1053,14 @@ def update_ticket(ticket_id):
             app.logger.warning(f"Could not parse original_ticket created_at for display: {original_ticket['created_at']}")
 
 
-        if original_ticket['created_by'] and original_ticket['created_by'] != current_user:
-            socketio.emit('ticket_update_notification', {
-                'id': ticket_id, 'title': title, 'status': new_status, 
-                'message': msg, 'created_by': original_ticket['created_by'], 
-                'created_at_display': created_at_display
-            }, room=original_ticket['created_by'])
-        
-        socketio.emit('ticket_updated_globally', {
+        notify_ticket_change({
+            'kind': 'updated',
             'id': ticket_id, 'title': title, 'status': new_status, 
             'created_by': original_ticket['created_by'], 
             'created_at_display': created_at_display,
-            'message': msg
-        }, room='all_authenticated_users')
+            'message': msg,
+            'updated_by': current_user
+        })
         
         return jsonify({'message': 'Ticket updated successfully'})
 
@@ -565,6 +1074,17 @@ def update_ticket(ticket_id):
 @app.route('/uploads/<path:filename>')
 @login_required
 def uploaded_file(filename):
+    blob_match = _BLOB_URL_RE.match(filename)
+    if blob_match:
+        sha256, download_name = blob_match.groups()
+        path = os.path.abspath(blob_path(sha256))
+        if not os.path.isfile(path):
+            abort(404)
+        response = send_file(path, download_name=download_name, etag=sha256, conditional=True, max_age=31536000)
+        response.cache_control.immutable = True
+        response.cache_control.public = False # max_age made it public; these are per-login files, browser cache only
+        response.cache_control.private = True
+        return response
     return send_from_directory(os.path.abspath(app.config['UPLOAD_FOLDER']), filename)
 
 @app.route('/')
@@ -592,9 +1112,9 @@ def user_ticket_view_page():
 @login_required
 def index_counts_page():
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with get_db() as conn:
             cur = conn.cursor()
-            cur.execute('SELECT created_by, COUNT(*) as ticket_count FROM tickets GROUP BY created_by ORDER BY ticket_count DESC')
+            cur.execute("SELECT key AS created_by, count AS ticket_count FROM ticket_counters WHERE kind = 'creator' AND count > 0 ORDER BY count DESC")
             users_data = cur.fetchall() 
         return render_template('index.html', users=users_data, username=session.get('username'))
     except Exception as e:
@@ -606,7 +1126,7 @@ def index_counts_page():
 @login_required
 def get_users_list():
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with get_db() as conn:
             cur = conn.cursor()
             cur.execute("SELECT DISTINCT created_by FROM tickets WHERE created_by IS NOT NULL AND created_by != '' ORDER BY created_by COLLATE NOCASE")
             users = [row[0] for row in cur.fetchall()]
@@ -620,25 +1140,79 @@ def get_users_list():
 def get_tickets_for_user_api(username):
 
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_db() as conn:
             cur = conn.cursor()
-            cur.execute("SELECT id, title, description, remedies, file_path, remedy_doc_path, created_by, created_at, status FROM tickets WHERE created_by = ? ORDER BY datetime(created_at) DESC", (username,))
-            tickets_raw = cur.fetchall()
-            tickets = []
-            for row in tickets_raw:
-                ticket_dict = dict(row)
-                if 'file_path' in ticket_dict and ticket_dict['file_path'] and isinstance(ticket_dict['file_path'], str):
-                    ticket_dict['file_path'] = [path.strip() for path in ticket_dict['file_path'].split(';') if path.strip()]
-                else:
-                    ticket_dict['file_path'] = []
-                tickets.append(ticket_dict)
+            cur.execute("SELECT id, title, description, remedies, file_path, remedy_doc_path, created_by, created_at, status FROM tickets WHERE created_by = ? ORDER BY created_at_ts DESC", (username,))
+            tickets = merge_ticket_attachments(cur, [ticket_row_to_dict(row) for row in cur.fetchall()])
             return jsonify(tickets)
     except Exception as e:
         app.logger.error(f"Error fetching tickets for user {username}: {e}")
         return jsonify({"error": f"Failed to retrieve tickets for user {username}"}), 500
 
 
+# --- Google Doc import ---
+# One pooled session for all imports, a hard cap on downloaded bytes, and a per-URL cache of the
+# extracted text revalidated with ETag/Last-Modified, so re-importing an unchanged doc is a 304.
+class GDocTooLarge(Exception):
+    pass
+
+_gdoc_session = requests.Session()
+_gdoc_session.headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+_gdoc_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_gdoc_cache = OrderedDict() # url -> {"etag", "last_modified", "content"}
+_gdoc_cache_lock = threading.Lock()
+
+def extract_gdoc_text(html):
+    """Returns the visible text of a published doc, or None if it has no content area."""
+    # Only build the #contents subtree; fall back to a full parse for docs without it.
+    soup = BeautifulSoup(html, GDOC_HTML_PARSER, parse_only=SoupStrainer('div', id='contents'))
+    content_div = soup.find('div', id='contents')
+    if not content_div:
+        content_div = BeautifulSoup(html, GDOC_HTML_PARSER).body
+        if not content_div:
+            return None
+    for s_or_s_tag in content_div(['script', 'style']):
+        s_or_s_tag.decompose()
+    return content_div.get_text(separator='\n', strip=True)
+
+def fetch_gdoc_text(gdoc_url):
+    """Returns (extracted_text, served_from_cache). Raises GDocTooLarge or requests exceptions."""
+    with _gdoc_cache_lock:
+        cached = _gdoc_cache.get(gdoc_url)
+    headers = {}
+    if cached:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    with _gdoc_session.get(gdoc_url, headers=headers, timeout=20, stream=True) as response:
+        if response.status_code == 304 and cached:
+            with _gdoc_cache_lock:
+                if gdoc_url in _gdoc_cache:
+                    _gdoc_cache.move_to_end(gdoc_url)
+            return cached['content'], True
+        response.raise_for_status()
+        declared_length = response.headers.get('Content-Length')
+        if declared_length and declared_length.isdigit() and int(declared_length) > GDOC_MAX_BYTES:
+            raise GDocTooLarge(f"Document is {int(declared_length)} bytes (limit {GDOC_MAX_BYTES}).")
+        body = bytearray()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            body.extend(chunk)
+            if len(body) > GDOC_MAX_BYTES:
+                raise GDocTooLarge(f"Document exceeds the {GDOC_MAX_BYTES} byte limit.")
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+    extracted_text = extract_gdoc_text(bytes(body))
+    if extracted_text and (etag or last_modified):
+        with _gdoc_cache_lock:
+            _gdoc_cache[gdoc_url] = {"etag": etag, "last_modified": last_modified, "content": extracted_text}
+            _gdoc_cache.move_to_end(gdoc_url)
+            while len(_gdoc_cache) > GDOC_CACHE_MAX_ENTRIES:
+                _gdoc_cache.popitem(last=False)
+    return extracted_text, False
+
 @app.route('/extract_gdoc_content', methods=['POST'])
 @login_required
 def extract_gdoc_content_route():
@@ -657,29 +1231,19 @@ def extract_gdoc_content_route():
 
 
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        response = requests.get(gdoc_url, timeout=20, headers=headers) 
-        response.raise_for_status() 
-        
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        content_div = soup.find('div', id='contents')
-        if not content_div: 
-            content_div = soup.body 
-            if not content_div:
-                 return jsonify({"success": False, "detail": "Could not find main content area in the document."}), 400
-        
-        for s_or_s_tag in content_div(['script', 'style']):
-            s_or_s_tag.decompose()
-        
+        extracted_text, from_cache = fetch_gdoc_text(gdoc_url)
 
-        extracted_text = content_div.get_text(separator='\n', strip=True)
+        if extracted_text is None:
+            return jsonify({"success": False, "detail": "Could not find main content area in the document."}), 400
         
         if not extracted_text.strip():
             return jsonify({"success": False, "detail": "No text content found in the document after cleaning."}), 400
             
-        return jsonify({"success": True, "content": extracted_text})
+        return jsonify({"success": True, "content": extracted_text, "cached": from_cache})
 
+    except GDocTooLarge as e:
+        app.logger.warning(f"GDoc too large {gdoc_url}: {e}")
+        return jsonify({"success": False, "detail": f"The document is too large to import. {e}"}), 413
     except requests.exceptions.Timeout:
         app.logger.error(f"Timeout fetching GDoc URL: {gdoc_url}")
         return jsonify({"success": False, "detail": "The request to Google Docs timed out. Please try again."}), 504
@@ -696,6 +1260,302 @@ def extract_gdoc_content_route():
         return jsonify({"success": False, "detail": "An error occurred while parsing the document content."}), 500
 
 
+# --- AI execution layer ---
+# Gemini calls block for seconds, so they run on a small dedicated pool instead of the request
+# worker, and the caller waits with socketio.sleep(). Under gunicorn -k eventlet threading is
+# monkey-patched and the pool's threads are greenthreads, while the Gemini client blocks inside C
+# (gRPC) where no greenthread can yield; so the blocking calls themselves go through run_blocking(),
+# which hands them to eventlet's pool of real OS threads (EVENTLET_THREADPOOL_SIZE, default 20, keep
+# it at least AI_MAX_CONCURRENCY) and keeps ticket routes responsive while chats are in flight.
+# Work beyond AI_MAX_QUEUE pending calls is rejected up front rather than piling up.
+class AIServiceBusy(Exception):
+    pass
+
+class AITimeout(Exception):
+    pass
+
+def run_blocking(fn, *args, **kwargs):
+    """Calls fn on a real OS thread when eventlet has patched threading (the greenthread waits cooperatively), else directly."""
+    if tpool is not None and eventlet_patcher.is_monkey_patched('thread'):
+        return tpool.execute(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+def iterate_blocking(iterable):
+    """Yields the items of a blocking iterator (a streamed Gemini response), fetching each one with run_blocking()."""
+    iterator = run_blocking(iter, iterable)
+    end = object()
+    while True:
+        item = run_blocking(next, iterator, end)
+        if item is end:
+            return
+        yield item
+
+_ai_executor = ThreadPoolExecutor(max_workers=AI_MAX_CONCURRENCY, thread_name_prefix='gemini')
+_ai_stats_lock = threading.Lock()
+_ai_stats = {"queued": 0, "in_flight": 0, "completed": 0, "failed": 0, "timed_out": 0, "rejected": 0, "prompt_tokens": 0, "response_tokens": 0}
+
+def _ai_stat(**deltas):
+    with _ai_stats_lock:
+        for key, delta in deltas.items():
+            _ai_stats[key] += delta
+
+def _run_ai_job(fn, args, kwargs):
+    _ai_stat(queued=-1, in_flight=1)
+    try:
+        result = fn(*args, **kwargs)
+        _ai_stat(completed=1)
+        return result
+    except Exception:
+        _ai_stat(failed=1)
+        raise
+    finally:
+        _ai_stat(in_flight=-1)
+
+def submit_ai_job(fn, *args, **kwargs):
+    with _ai_stats_lock:
+        if _ai_stats["queued"] + _ai_stats["in_flight"] >= AI_MAX_CONCURRENCY + AI_MAX_QUEUE:
+            _ai_stats["rejected"] += 1
+            raise AIServiceBusy("AI service is at capacity.")
+        _ai_stats["queued"] += 1
+    return _ai_executor.submit(_run_ai_job, fn, args, kwargs)
+
+def _ai_deadline_expired(future, deadline):
+    if time.monotonic() < deadline:
+        return False
+    if future.cancel(): # never started, so _run_ai_job will not decrement the queue itself
+        _ai_stat(queued=-1)
+    _ai_stat(timed_out=1)
+    return True
+
+def run_ai_call(fn, *args, timeout=AI_CALL_TIMEOUT, **kwargs):
+    """Runs blocking fn on the AI pool and waits up to timeout seconds for its result."""
+    future = submit_ai_job(run_blocking, fn, *args, **kwargs)
+    deadline = time.monotonic() + timeout
+    while not future.done():
+        if _ai_deadline_expired(future, deadline):
+            raise AITimeout(f"AI call did not finish within {timeout}s.")
+        socketio.sleep(0.05)
+    return future.result()
+
+def gemini_generation_config(max_output_tokens, temperature):
+    return genai.types.GenerationConfig(max_output_tokens=max_output_tokens, temperature=temperature)
+
+def response_text(response):
+    return "".join(part.text for part in response.candidates[0].content.parts).strip() if response.candidates and response.candidates[0].content.parts else ""
+
+# --- Model registry ---
+# GenerativeModel handles are built once per model name and shared, so every call reuses the same
+# client and its open channel instead of paying setup again.
+_gemini_models = {}
+_gemini_models_lock = threading.Lock()
+
+def get_gemini_model(name=GEMINI_MODEL_NAME):
+    model = _gemini_models.get(name)
+    if model is None:
+        with _gemini_models_lock:
+            model = _gemini_models.get(name)
+            if model is None:
+                model = genai.GenerativeModel(name)
+                _gemini_models[name] = model
+    return model
+
+def warm_up_gemini():
+    """Builds the default model handle and opens its channel in the background with a free count_tokens call."""
+    if not GEMINI_API_KEY or not GEMINI_WARMUP:
+        return
+
+    def warm_up():
+        started = time.monotonic()
+        try:
+            run_blocking(get_gemini_model().count_tokens, "warm-up")
+            print(f"Gemini model '{GEMINI_MODEL_NAME}' warmed up in {time.monotonic() - started:.2f}s.")
+        except Exception as e:
+            print(f"Gemini warm-up failed (first AI request will pay connection setup): {e}")
+
+    _ai_executor.submit(warm_up)
+
+def record_ai_usage(prompt, usage_metadata, started, streamed=False):
+    """Logs prompt/response token counts for one Gemini call and adds them to the AI metrics."""
+    prompt_tokens = getattr(usage_metadata, 'prompt_token_count', None) or 0
+    response_tokens = getattr(usage_metadata, 'candidates_token_count', None) or 0
+    _ai_stat(prompt_tokens=prompt_tokens, response_tokens=response_tokens)
+    app.logger.info(f"Gemini {'stream' if streamed else 'call'}: prompt_tokens={prompt_tokens} (estimated {estimate_tokens(prompt)}), "
+                    f"response_tokens={response_tokens}, {time.monotonic() - started:.2f}s")
+
+def generate_ai_content(prompt, max_output_tokens=400, temperature=0.5, timeout=AI_CALL_TIMEOUT):
+    model = get_gemini_model()
+    started = time.monotonic()
+    response = run_ai_call(model.generate_content, prompt, generation_config=gemini_generation_config(max_output_tokens, temperature), timeout=timeout)
+    record_ai_usage(prompt, getattr(response, 'usage_metadata', None), started)
+    return response
+
+# --- AI response cache ---
+class AIResponseCache:
+    """Content-addressed LRU/TTL cache of Gemini reply text, optionally backed by a SQLite file.
+
+    Entries can carry tags (e.g. 'ticket:42') so everything derived from a ticket can be dropped
+    when that ticket changes. Only non-empty replies are cached.
+    """
+
+    def __init__(self, max_entries, ttl, db_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (expires_at, text, tags)
+        self._tag_keys = defaultdict(set)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS ai_cache (key TEXT PRIMARY KEY, text TEXT NOT NULL, tags TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS ai_cache_tags (tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key)) WITHOUT ROWID")
+            self._db.execute("DELETE FROM ai_cache_tags WHERE key IN (SELECT key FROM ai_cache WHERE expires_at <= ?)", (time.time(),))
+            self._db.execute("DELETE FROM ai_cache WHERE expires_at <= ?", (time.time(),))
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model_name, prompt, generation_config):
+        raw = json.dumps([model_name, prompt, generation_config], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                self._drop(key)
+            if self._db is not None:
+                row = self._db.execute("SELECT text, tags, expires_at FROM ai_cache WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+                if row:
+                    self._remember(key, row[0], row[1].split(), row[2])
+                    self.hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, text, tags=()):
+        if not text:
+            return
+        expires_at = time.time() + self.ttl
+        tags = list(tags)
+        with self._lock:
+            self._remember(key, text, tags, expires_at)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO ai_cache (key, text, tags, expires_at) VALUES (?, ?, ?, ?)", (key, text, " ".join(tags), expires_at))
+                self._db.executemany("INSERT OR IGNORE INTO ai_cache_tags (tag, key) VALUES (?, ?)", [(tag, key) for tag in tags])
+                self._db.commit()
+
+    def invalidate_tag(self, tag):
+        with self._lock:
+            for key in list(self._tag_keys.get(tag, ())):
+                self._drop(key)
+            if self._db is not None:
+                self._db.execute("DELETE FROM ai_cache WHERE key IN (SELECT key FROM ai_cache_tags WHERE tag = ?)", (tag,))
+                self._db.execute("DELETE FROM ai_cache_tags WHERE tag = ?", (tag,))
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "persistent": self._db is not None}
+
+    def _remember(self, key, text, tags, expires_at):
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (expires_at, text, tags)
+        for tag in tags:
+            self._tag_keys[tag].add(key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tag_keys.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tag_keys[tag]
+
+ai_response_cache = AIResponseCache(AI_CACHE_MAX_ENTRIES, AI_CACHE_TTL, AI_CACHE_DB or None)
+
+def ai_cache_key(prompt, max_output_tokens, temperature):
+    return AIResponseCache.make_key(GEMINI_MODEL_NAME, prompt, {"max_output_tokens": max_output_tokens, "temperature": temperature})
+
+def generate_ai_text(prompt, max_output_tokens=400, temperature=0.5, tags=(), timeout=AI_CALL_TIMEOUT):
+    """Cached text generation. Returns (text, response); response is None when served from the cache."""
+    key = ai_cache_key(prompt, max_output_tokens, temperature)
+    cached = ai_response_cache.get(key)
+    if cached is not None:
+        return cached, None
+    response = generate_ai_content(prompt, max_output_tokens=max_output_tokens, temperature=temperature, timeout=timeout)
+    text = response_text(response)
+    ai_response_cache.put(key, text, tags)
+    return text, response
+
+def stream_ai_content(prompt, max_output_tokens=400, temperature=0.5, timeout=AI_CALL_TIMEOUT):
+    """Yields text chunks of a streamed Gemini response as they arrive. timeout bounds the whole stream."""
+    chunks = queue.Queue()
+    end_of_stream = object()
+
+    def produce():
+        started = time.monotonic()
+        usage_metadata = None
+        try:
+            model = get_gemini_model()
+            response = run_blocking(model.generate_content, prompt, generation_config=gemini_generation_config(max_output_tokens, temperature), stream=True)
+            for chunk in iterate_blocking(response):
+                text = "".join(part.text for part in chunk.candidates[0].content.parts) if chunk.candidates and chunk.candidates[0].content.parts else ""
+                usage_metadata = getattr(chunk, 'usage_metadata', None) or usage_metadata # final chunk carries the totals
+                if text:
+                    chunks.put(text)
+            record_ai_usage(prompt, usage_metadata, started, streamed=True)
+        except Exception as e:
+            chunks.put(e)
+            raise
+        finally:
+            chunks.put(end_of_stream)
+
+    future = submit_ai_job(produce)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            item = chunks.get_nowait()
+        except queue.Empty:
+            if _ai_deadline_expired(future, deadline):
+                raise AITimeout(f"AI stream did not finish within {timeout}s.")
+            socketio.sleep(0.05)
+            continue
+        if item is end_of_stream:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def ai_metrics():
+    with _ai_stats_lock:
+        stats = dict(_ai_stats)
+    stats["queue_depth"] = stats["queued"]
+    stats["max_concurrency"] = AI_MAX_CONCURRENCY
+    stats["max_queue"] = AI_MAX_QUEUE
+    stats["cache"] = ai_response_cache.stats()
+    return stats
+
+@app.route('/api/ai_metrics', methods=['GET'])
+@login_required
+def get_ai_metrics():
+    return jsonify(ai_metrics())
+
+@app.route('/api/email_metrics', methods=['GET'])
+@login_required
+def get_email_metrics():
+    return jsonify(email_outbox.metrics())
+
 @app.route('/ai-description', methods=['POST'])
 @login_required
 def ai_description():
@@ -713,6 +1573,8 @@ def ai_description():
     if not description and not title:
         return jsonify({"error": "Either a title or a description is required to generate an AI description."}), 400
 
+    description = extractive_summary(description, AI_PROMPT_TOKEN_BUDGET)
+    title = truncate_to_tokens(title, AI_FIELD_TOKEN_BUDGET)
     prompt_parts = ["You are an expert technical writer for a ticketing system. Your task is to refine or generate a bug/issue description."]
     if description:
         prompt_parts.append(f"Given the following user-submitted description:\n'''\n{description}\n'''")
@@ -727,16 +1589,7 @@ def ai_description():
     app.logger.info(f"AI Description Prompt (first 100 chars): {prompt[:100]}...")
 
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash-latest') 
-        response = model.generate_content(
-            prompt,
-            generation_config=genai.types.GenerationConfig(
-                max_output_tokens=400, 
-                temperature=0.5      
-            )
-        )
-        
-        generated_text = "".join(part.text for part in response.candidates[0].content.parts).strip() if response.candidates and response.candidates[0].content.parts else ""
+        generated_text, response = generate_ai_text(prompt, max_output_tokens=400, temperature=0.5)
         
         if not generated_text:
             if response.prompt_feedback and response.prompt_feedback.block_reason:
@@ -748,213 +1601,190 @@ def ai_description():
             
         return jsonify({"generated": generated_text})
 
+    except AIServiceBusy:
+        app.logger.warning("AI Description: AI pool at capacity, rejecting request.")
+        return jsonify({"error": "The AI service is busy right now. Please try again in a moment."}), 503
+    except AITimeout as e:
+        app.logger.error(f"AI Description: {e}")
+        return jsonify({"error": "The AI service took too long to respond. Please try again."}), 504
     except Exception as e:
         app.logger.error(f"Gemini API error during AI description generation: {str(e)}")
         return jsonify({"error": "An error occurred while communicating with the AI service."}), 500
 
+# --- Prompt budgeting ---
+# Ticket fields can hold whole Google Doc imports, so everything pasted into a Gemini prompt is held
+# to a token budget: long description/remedies fields are cut down to their most representative
+# sentences (prompt_budget.extractive_summary), and the result is cached per ticket, field and
+# content hash so repeat questions about the same ticket skip the work. Edits change the hash.
+_ticket_summary_cache = OrderedDict() # (ticket_id, field, sha1, max_tokens) -> summary
+_ticket_summary_cache_lock = threading.Lock()
+
+def ticket_field_for_prompt(ticket_id, field, text, max_tokens=AI_FIELD_TOKEN_BUDGET):
+    if not text or estimate_tokens(text) <= max_tokens:
+        return text
+    key = (ticket_id, field, hashlib.sha1(text.encode('utf-8')).hexdigest(), max_tokens)
+    with _ticket_summary_cache_lock:
+        summary = _ticket_summary_cache.get(key)
+        if summary is not None:
+            _ticket_summary_cache.move_to_end(key)
+            return summary
+    summary = extractive_summary(text, max_tokens)
+    app.logger.info(f"Condensed ticket {ticket_id} {field} from ~{estimate_tokens(text)} to ~{estimate_tokens(summary)} tokens for the AI prompt.")
+    with _ticket_summary_cache_lock:
+        _ticket_summary_cache[key] = summary
+        while len(_ticket_summary_cache) > TICKET_SUMMARY_CACHE_MAX_ENTRIES:
+            _ticket_summary_cache.popitem(last=False)
+    return summary
+
 DIRECT_AI_SIGNAL = "USE_DIRECT_AI_FOR_GENERAL_QUERY" 
 
-def query_database_for_chatbot(user_message_lower):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    response_data = "Sorry, I couldn't find specific information related to your query in our ticket system. You can try asking about: 'ticket id 123', 'tickets by user@example.com', 'open tickets', 'search tickets for [keyword]', 'how many open tickets are there?', or 'show me the latest 3 tickets'."
-    found_specific_query = False
+CHAT_HELP_TEXT = "Sorry, I couldn't find specific information related to your query in our ticket system. You can try asking about: 'ticket id 123', 'tickets by user@example.com', 'open tickets', 'search tickets for [keyword]', 'how many open tickets are there?', or 'show me the latest 3 tickets'."
+
+# Statements for the chat intents. They are module constants so the text stays identical between
+# calls, which lets each pooled connection's statement cache hand back the already-prepared statement.
+CHAT_SQL = {
+    'ticket_by_id': "SELECT * FROM tickets WHERE id = ?",
+    'ticket_creator': "SELECT created_by, title FROM tickets WHERE id = ?",
+    'tickets_by_user': "SELECT id, title, status, created_at FROM tickets WHERE LOWER(created_by) LIKE LOWER(?) ORDER BY created_at_ts DESC LIMIT 5",
+    'tickets_by_status': "SELECT id, title, created_by FROM tickets WHERE status = ? ORDER BY created_at_ts DESC LIMIT 5",
+    'count_status': "SELECT COUNT(*) FROM tickets WHERE status = ?",
+    'count_total': "SELECT COUNT(*) FROM tickets",
+    'latest': "SELECT id, title, status FROM tickets ORDER BY created_at_ts DESC LIMIT ?",
+}
+
+def _chat_ticket_by_id(cur, slots):
+    tid = slots['ticket_id']
+    try:
+        cur.execute(CHAT_SQL['ticket_by_id'], (tid,))
+        ticket = cur.fetchone()
+        if not ticket:
+            return f"Sorry, I couldn't find any ticket with ID {tid}."
+        text_parts = [
+            f"Ticket ID: {ticket['id']}", f"Title: {ticket['title']}", f"Status: {ticket['status']}"
+        ]
+        if ticket['description'] and ticket['description'].strip(): text_parts.append(f"Description: {ticket_field_for_prompt(tid, 'description', ticket['description'])}")
+        text_parts.append(f"Created By: {ticket['created_by']} on {ticket['created_at']}")
+        if ticket['remedies'] and ticket['remedies'].strip(): text_parts.append(f"Remedies: {ticket_field_for_prompt(tid, 'remedies', ticket['remedies'])}")
+
+        ticket_data_for_response = {
+            "type": "ticket_details", 
+            "id": ticket['id'], "title": ticket['title'], "status": ticket['status'],
+            "description": ticket['description'], "created_by": ticket['created_by'],
+            "created_at": ticket['created_at'], "remedies": ticket['remedies'],
+            "file_paths_raw": [], "remedy_doc_path_raw": None
+        }
+        files = merge_ticket_attachments(cur, [ticket_row_to_dict(ticket, ['id', 'file_path', 'remedy_doc_path'])])[0]
+        if files['file_path']:
+            ticket_data_for_response["file_paths_raw"] = files['file_path']
+            screenshots_text = [os.path.basename(p) for p in ticket_data_for_response["file_paths_raw"]]
+            if screenshots_text: text_parts.append(f"Attached Files: {', '.join(screenshots_text)}")
+        if files['remedy_doc_path'] and files['remedy_doc_path'].strip():
+            ticket_data_for_response["remedy_doc_path_raw"] = files['remedy_doc_path'].strip()
+            text_parts.append(f"Remedy Document: {os.path.basename(ticket_data_for_response['remedy_doc_path_raw'])}")
+
+        ticket_data_for_response["summary_text_for_ai"] = "\n".join(text_parts) 
+        return ticket_data_for_response
+    except Exception as e:
+        app.logger.error(f"Chatbot error fetching ticket ID {tid}: {e}")
+        return "I encountered an error trying to fetch the ticket details."
 
+def _chat_ticket_creator(cur, slots):
+    tid = slots['ticket_id']
     try:
-        # id se ticket dhoodna
-        ticket_id_phrases = ["ticket id ", "show ticket ", "details for ticket ", "ticket #", "ticket#", "ticket "]
-        matched_phrase = None
-        for phrase in ticket_id_phrases:
-            if user_message_lower.startswith(phrase):
-                matched_phrase = phrase
-                break
-        
-        tid_str = None
-        if matched_phrase:
-            potential_id = user_message_lower[len(matched_phrase):].strip().split(" ")[0] 
-            if potential_id.isdigit():
-                tid_str = potential_id
-        elif user_message_lower.split()[-1].isdigit() and \
-             any(kw in user_message_lower for kw in ["ticket", "id"]): 
-            tid_str = user_message_lower.split()[-1]
-
-        if tid_str is not None:
-            found_specific_query = True
-            try:
-                tid = int(tid_str)
-                cur.execute("SELECT * FROM tickets WHERE id = ?", (tid,))
-                ticket = cur.fetchone()
-                if ticket:
-                    text_parts = [
-                        f"Ticket ID: {ticket['id']}", f"Title: {ticket['title']}", f"Status: {ticket['status']}"
-                    ]
-                    if ticket['description'] and ticket['description'].strip(): text_parts.append(f"Description: {ticket['description']}")
-                    text_parts.append(f"Created By: {ticket['created_by']} on {ticket['created_at']}")
-                    if ticket['remedies'] and ticket['remedies'].strip(): text_parts.append(f"Remedies: {ticket['remedies']}")
-
-                    ticket_data_for_response = {
-                        "type": "ticket_details", 
-                        "id": ticket['id'], "title": ticket['title'], "status": ticket['status'],
-                        "description": ticket['description'], "created_by": ticket['created_by'],
-                        "created_at": ticket['created_at'], "remedies": ticket['remedies'],
-                        "file_paths_raw": [], "remedy_doc_path_raw": None
-                    }
-                    if ticket['file_path'] and ticket['file_path'].strip():
-                        ticket_data_for_response["file_paths_raw"] = [p.strip() for p in ticket['file_path'].split(';') if p.strip()]
-                        screenshots_text = [os.path.basename(p) for p in ticket_data_for_response["file_paths_raw"]]
-                        if screenshots_text: text_parts.append(f"Attached Files: {', '.join(screenshots_text)}")
-                    if ticket['remedy_doc_path'] and ticket['remedy_doc_path'].strip():
-                        ticket_data_for_response["remedy_doc_path_raw"] = ticket['remedy_doc_path'].strip()
-                        text_parts.append(f"Remedy Document: {os.path.basename(ticket_data_for_response['remedy_doc_path_raw'])}")
-                    
-                    ticket_data_for_response["summary_text_for_ai"] = "\n".join(text_parts) 
-                    response_data = ticket_data_for_response 
-                else:
-                    response_data = f"Sorry, I couldn't find any ticket with ID {tid}."
-            except ValueError:
-                response_data = f"The ticket ID '{tid_str}' doesn't seem to be a valid number."
-                app.logger.warning(f"Chatbot: Invalid string for ticket ID: {tid_str}")
-            except Exception as e:
-                app.logger.error(f"Chatbot error fetching ticket ID {tid_str}: {e}")
-                response_data = "I encountered an error trying to fetch the ticket details."
-        
-        # har user ka ticket
-        elif any(user_message_lower.startswith(p) for p in ["tickets by ", "show tickets for "]):
-            found_specific_query = True
-            try:
-                s_query = next((user_message_lower[len(p):].strip() for p in ["tickets by ", "show tickets for "] if user_message_lower.startswith(p)), None)
-                if not s_query:
-                    response_data = "Please specify a username or email to search for (e.g., 'tickets by user@example.com')."
-                else:
-                    cur.execute("SELECT id, title, status, created_at FROM tickets WHERE LOWER(created_by) LIKE LOWER(?) ORDER BY datetime(created_at) DESC LIMIT 5", (f"%{s_query}%",))
-                    tickets = cur.fetchall()
-                    if tickets:
-                        response_data = f"Here are the latest 5 tickets for users matching '{s_query}':\n" + "\n".join([f"- ID {t['id']}: {t['title']} (Status: {t['status']}, Created: {t['created_at']})" for t in tickets])
-                    else:
-                        response_data = f"No tickets found for users matching '{s_query}'."
-            except Exception as e:
-                app.logger.error(f"Chatbot error fetching tickets by user '{s_query}': {e}")
-                response_data = "I encountered an error trying to fetch user tickets."
-
-        # status tickets ka
-        elif any(keyword in user_message_lower for keyword in [" tickets", " status is "]) and \
-             any(status_keyword in user_message_lower for status_keyword in ['open', 'resolved', 'closed', 'in progress', 'pending', 'pending user']): 
-            found_specific_query = True
-            status_to_find = None
-            possible_statuses = {'open': 'Open', 'resolved': 'Resolved', 'closed': 'Closed', 'in progress': 'In Progress', 'pending user': 'Pending User', 'pending':'Pending User'} 
-            for key_phrase, status_val in possible_statuses.items():
-                if key_phrase in user_message_lower:
-                    status_to_find = status_val
-                    break
-            if status_to_find:
-                cur.execute("SELECT id, title, created_by FROM tickets WHERE status = ? ORDER BY datetime(created_at) DESC LIMIT 5", (status_to_find,))
-                tickets = cur.fetchall()
-                if tickets:
-                    response_data = f"Here are the latest 5 '{status_to_find}' tickets:\n" + "\n".join([f"- ID {t['id']}: {t['title']} (By: {t['created_by']})" for t in tickets])
-                else:
-                    response_data = f"No '{status_to_find}' tickets found currently."
-            else: 
-                response_data = "Which status are you interested in (e.g., open, resolved, closed)?"
-
-        # tickets seaching keywors k sath
-        elif user_message_lower.startswith("search tickets for ") or user_message_lower.startswith("find tickets about "):
-            found_specific_query = True
-            search_term = user_message_lower.replace("search tickets for ", "").replace("find tickets about ","").strip()
-            if search_term:
-                like_term = f"%{search_term}%"
-                cur.execute("SELECT id, title, status FROM tickets WHERE LOWER(title) LIKE LOWER(?) OR LOWER(description) LIKE LOWER(?) OR LOWER(remedies) LIKE LOWER(?) ORDER BY datetime(created_at) DESC LIMIT 5", 
-                            (like_term,like_term,like_term))
-                tickets = cur.fetchall()
-                if tickets:
-                    response_data = f"Found up to 5 tickets matching '{search_term}':\n" + "\n".join([f"- ID {t['id']}: {t['title']} (Status: {t['status']})" for t in tickets])
-                else:
-                    response_data = f"No tickets found matching '{search_term}'."
-            else:
-                response_data = "Please specify what you want to search for (e.g., 'search tickets for login issue')."
-
-        # ticket count krne 
-        elif user_message_lower.startswith("how many tickets are ") or user_message_lower.startswith("count of "):
-            found_specific_query = True
-            status_to_count = None
-            possible_statuses = {'open': 'Open', 'resolved': 'Resolved', 'closed': 'Closed', 'in progress': 'In Progress', 'pending user': 'Pending User', 'pending':'Pending User'}
-            for key_phrase, status_val in possible_statuses.items():
-                if key_phrase in user_message_lower:
-                    status_to_count = status_val
-                    break
-            if status_to_count:
-                cur.execute("SELECT COUNT(*) FROM tickets WHERE status = ?", (status_to_count,));
-                count = cur.fetchone()[0]
-                response_data = f"There are {count} ticket(s) with status '{status_to_count}'."
-            elif "total tickets" in user_message_lower or "all tickets" in user_message_lower: 
-                cur.execute("SELECT COUNT(*) FROM tickets");
-                count = cur.fetchone()[0]
-                response_data = f"There are a total of {count} ticket(s) in the system."
-            else:
-                response_data = "Which status count are you interested in (e.g., 'how many tickets are open')?"
+        cur.execute(CHAT_SQL['ticket_creator'], (tid,))
+        ticket = cur.fetchone()
+        if ticket:
+            return f"Ticket ID {tid} (\"{ticket['title']}\") was created by: {ticket['created_by']}."
+        return f"No ticket found with ID {tid}."
+    except Exception as e:
+        app.logger.error(f"Chatbot error fetching ticket creator for ID '{tid}': {e}")
+        return "I encountered an error trying to find the ticket creator."
 
-        # mst vali new tickets
-        elif "latest " in user_message_lower and " tickets" in user_message_lower:
-            found_specific_query = True
-            try:
-                parts = user_message_lower.split()
-                num_tickets = None
-                for i, part in enumerate(parts):
-                    if part == "latest" and i + 1 < len(parts) and parts[i+1].isdigit():
-                        num_tickets = int(parts[i+1])
-                        break
-                if num_tickets is not None:
-                    num_tickets = min(num_tickets, 10) 
-                    cur.execute("SELECT id, title, status FROM tickets ORDER BY datetime(created_at) DESC LIMIT ?", (num_tickets,))
-                    tickets = cur.fetchall()
-                    if tickets:
-                        response_data = f"Here are the latest {len(tickets)} tickets:\n" + "\n".join([f"- ID {t['id']}: {t['title']} (Status: {t['status']})" for t in tickets])
-                    else:
-                        response_data = "No tickets found."
-                else:
-                    response_data = "Please specify how many latest tickets you want (e.g., 'latest 5 tickets')."
-            except ValueError:
-                response_data = "Please specify a valid number for latest tickets."
-            except Exception as e:
-                app.logger.error(f"Chatbot error fetching latest tickets: {e}")
-                response_data = "I encountered an error trying to fetch the latest tickets."
+def _chat_tickets_by_user(cur, slots):
+    s_query = slots['user']
+    if not s_query:
+        return "Please specify a username or email to search for (e.g., 'tickets by user@example.com')."
+    try:
+        cur.execute(CHAT_SQL['tickets_by_user'], (f"%{s_query}%",))
+        tickets = cur.fetchall()
+        if tickets:
+            return f"Here are the latest 5 tickets for users matching '{s_query}':\n" + "\n".join([f"- ID {t['id']}: {t['title']} (Status: {t['status']}, Created: {t['created_at']})" for t in tickets])
+        return f"No tickets found for users matching '{s_query}'."
+    except Exception as e:
+        app.logger.error(f"Chatbot error fetching tickets by user '{s_query}': {e}")
+        return "I encountered an error trying to fetch user tickets."
+
+def _chat_tickets_by_status(cur, slots):
+    status_to_find = slots['status']
+    cur.execute(CHAT_SQL['tickets_by_status'], (status_to_find,))
+    tickets = cur.fetchall()
+    if tickets:
+        return f"Here are the latest 5 '{status_to_find}' tickets:\n" + "\n".join([f"- ID {t['id']}: {t['title']} (By: {t['created_by']})" for t in tickets])
+    return f"No '{status_to_find}' tickets found currently."
+
+def _chat_search(cur, slots):
+    search_term = slots['keyword']
+    if not search_term:
+        return "Please specify what you want to search for (e.g., 'search tickets for login issue')."
+    tickets = search_tickets(cur, search_term, "t.id, t.title, t.status", ['title', 'description', 'remedies'], limit=5)
+    tickets += similar_tickets(cur, search_term, "t.id, t.title, t.status", 5 - len(tickets), exclude_ids=[t['id'] for t in tickets])
+    if tickets:
+        return f"Found up to 5 tickets matching '{search_term}':\n" + "\n".join([f"- ID {t['id']}: {t['title']} (Status: {t['status']})" for t in tickets])
+    return f"No tickets found matching '{search_term}'."
+
+def _chat_count(cur, slots):
+    if 'status' in slots:
+        cur.execute(CHAT_SQL['count_status'], (slots['status'],))
+        count = cur.fetchone()[0]
+        return f"There are {count} ticket(s) with status '{slots['status']}'."
+    if slots.get('total'):
+        cur.execute(CHAT_SQL['count_total'])
+        count = cur.fetchone()[0]
+        return f"There are a total of {count} ticket(s) in the system."
+    return "Which status count are you interested in (e.g., 'how many tickets are open')?"
+
+def _chat_latest(cur, slots):
+    if 'n' not in slots:
+        return "Please specify how many latest tickets you want (e.g., 'latest 5 tickets')."
+    try:
+        cur.execute(CHAT_SQL['latest'], (min(slots['n'], 10),))
+        tickets = cur.fetchall()
+        if tickets:
+            return f"Here are the latest {len(tickets)} tickets:\n" + "\n".join([f"- ID {t['id']}: {t['title']} (Status: {t['status']})" for t in tickets])
+        return "No tickets found."
+    except Exception as e:
+        app.logger.error(f"Chatbot error fetching latest tickets: {e}")
+        return "I encountered an error trying to fetch the latest tickets."
+
+CHAT_INTENT_HANDLERS = {
+    'ticket_by_id': _chat_ticket_by_id,
+    'ticket_creator': _chat_ticket_creator,
+    'tickets_by_user': _chat_tickets_by_user,
+    'tickets_by_status': _chat_tickets_by_status,
+    'search': _chat_search,
+    'count': _chat_count,
+    'latest': _chat_latest,
+}
 
-        # kisne banai
-        elif any(user_message_lower.startswith(p) for p in ["who created ticket ", "creator of ticket "]):
-            found_specific_query = True
-            try:
-                creator_tid_str = None
-                for p in ["who created ticket ", "creator of ticket "]:
-                    if user_message_lower.startswith(p):
-                        potential_id = user_message_lower[len(p):].strip().split(" ")[0]
-                        if potential_id.isdigit():
-                            creator_tid_str = potential_id
-                            break
-                if not creator_tid_str and user_message_lower.split()[-1].isdigit() and \
-                   any(kw in user_message_lower for kw in ["ticket", "id", "creator"]):
-                     creator_tid_str = user_message_lower.split()[-1]
-
-                if not creator_tid_str:
-                    response_data = "Please provide a valid ticket ID to find its creator (e.g., 'creator of ticket 123')."
-                else:
-                    tid = int(creator_tid_str)
-                    cur.execute("SELECT created_by, title FROM tickets WHERE id = ?", (tid,));
-                    ticket = cur.fetchone()
-                    if ticket:
-                        response_data = f"Ticket ID {tid} (\"{ticket['title']}\") was created by: {ticket['created_by']}."
-                    else:
-                        response_data = f"No ticket found with ID {tid}."
-            except ValueError: 
-                response_data = "Please provide a valid ticket ID (must be a number)."
-            except Exception as e:
-                app.logger.error(f"Chatbot error fetching ticket creator for ID '{creator_tid_str}': {e}")
-                response_data = "I encountered an error trying to find the ticket creator."
-        
-        if not found_specific_query and len(user_message_lower.split()) > 1: 
-            like_term = f"%{user_message_lower}%"
-            cur.execute("SELECT id, title, status FROM tickets WHERE LOWER(title) LIKE LOWER(?) OR LOWER(description) LIKE LOWER(?) OR LOWER(remedies) LIKE LOWER(?) OR LOWER(created_by) LIKE LOWER(?) ORDER BY datetime(created_at) DESC LIMIT 3", 
-                        (like_term, like_term, like_term, like_term))
-            tickets = cur.fetchall()
+def query_database_for_chatbot(user_message_lower):
+    intent, slots = route_intent(user_message_lower)
+    # Nothing to look up and too short for a useful full-text search: skip the pool entirely.
+    if intent is None and len(user_message_lower.split()) <= 1:
+        app.logger.info(f"Chatbot: No specific DB query matched for '{user_message_lower}'. Signaling for direct AI processing.")
+        return {"type": DIRECT_AI_SIGNAL, "original_query": user_message_lower}
+
+    conn = acquire_db()
+    cur = conn.cursor()
+    response_data = CHAT_HELP_TEXT
+    found_specific_query = intent is not None
+
+    try:
+        if intent is not None:
+            response_data = CHAT_INTENT_HANDLERS[intent](cur, slots)
+        else:
+            # Full-text hits first, then the nearest tickets from the vector index.
+            tickets = search_tickets(cur, user_message_lower, "t.id, t.title, t.status", ['title', 'description', 'remedies', 'created_by'], limit=3)
+            tickets += similar_tickets(cur, user_message_lower, "t.id, t.title, t.status", CHAT_SIMILAR_TICKETS - len(tickets), exclude_ids=[t['id'] for t in tickets])
             if tickets:
                 response_data = f"I found these tickets that might be related to '{user_message_lower}':\n" + "\n".join([f"- ID {t['id']}: {t['title']} (Status: {t['status']})" for t in tickets])
                 response_data += "\n\nCould you be more specific if this isn't what you're looking for, or ask a general question?"
@@ -969,7 +1799,7 @@ def query_database_for_chatbot(user_message_lower):
         response_data = "I encountered an unexpected issue while trying to understand your request. Please try again."
         found_specific_query = True 
     finally:
-        conn.close()
+        release_db(conn)
     
     if not found_specific_query:
         app.logger.info(f"Chatbot: No specific DB query matched for '{user_message_lower}'. Signaling for direct AI processing.")
@@ -980,28 +1810,20 @@ def query_database_for_chatbot(user_message_lower):
         
     return response_data
 
-def generate_ai_chat_response(user_message, db_query_or_signal):
-    if not GEMINI_API_KEY:
-        app.logger.warning("Chatbot: Gemini API Key is missing. AI responses will be limited.")
-        if isinstance(db_query_or_signal, dict) and db_query_or_signal.get("type") == DIRECT_AI_SIGNAL:
-            return "My AI capabilities are currently unavailable for general questions. Please try asking about specific tickets."
-        if isinstance(db_query_or_signal, dict) and db_query_or_signal.get("type") == "ticket_details":
-            return db_query_or_signal.get("summary_text_for_ai", "Ticket information is available, but AI summarization is currently offline.")
-        return str(db_query_or_signal) 
-
-    prompt = ""
+def build_chat_prompt(user_message, db_query_or_signal):
+    user_message = truncate_to_tokens(user_message, AI_FIELD_TOKEN_BUDGET)
     if isinstance(db_query_or_signal, dict) and db_query_or_signal.get("type") == DIRECT_AI_SIGNAL:
-        original_query = db_query_or_signal.get("original_query", user_message)
+        original_query = truncate_to_tokens(db_query_or_signal.get("original_query", user_message), AI_FIELD_TOKEN_BUDGET)
         app.logger.info(f"Chatbot: Using direct AI prompt for query: '{original_query}'")
-        prompt = f"""The user asked: "{original_query}"
+        return f"""The user asked: "{original_query}"
 Please provide a helpful and general response. You do not have access to specific database information for this question.
 Answer as a helpful assistant. If the question seems like a command you cannot fulfill (e.g. 'delete ticket 5'), politely explain you are an informational assistant and cannot perform actions.
 If the query is vague, ask for clarification. If it's a greeting, respond politely.
 Chatbot's Answer:"""
     elif isinstance(db_query_or_signal, dict) and db_query_or_signal.get("type") == "ticket_details":
-        ticket_summary = db_query_or_signal.get("summary_text_for_ai", "Found details for a ticket.")
+        ticket_summary = truncate_to_tokens(db_query_or_signal.get("summary_text_for_ai", "Found details for a ticket."), AI_PROMPT_TOKEN_BUDGET)
         app.logger.info(f"Chatbot: Using DB-contextualized (ticket_details) AI prompt for query: '{user_message}'")
-        prompt = f"""User asked: "{user_message}"
+        return f"""User asked: "{user_message}"
 Based *only* on this ticket information, provide a friendly and concise summary or answer related to the user's question.
 Do not invent information not present in the ticket details.
 Ticket Information:
@@ -1010,27 +1832,49 @@ Ticket Information:
 Chatbot's Answer:"""
     else: 
         app.logger.info(f"Chatbot: Using DB-contextualized (string) AI prompt for query: '{user_message}'")
-        prompt = f"""User asked: "{user_message}"
+        return f"""User asked: "{user_message}"
 Based *only* on the following database information, provide a friendly and concise answer. 
 If the database info is a list of items, summarize it or list key items. 
 If the database info indicates "no ticket/s found" or a similar negative result, state that politely. 
 If it's an error message or a help message like "Please specify...", rephrase that helpfully for the user.
 Do not add any information not present in the database result.
 Database Result:
-```{str(db_query_or_signal)}```
+```{truncate_to_tokens(str(db_query_or_signal), AI_PROMPT_TOKEN_BUDGET)}```
 Chatbot's Answer:"""
 
+_CHAT_TICKET_ID_RE = re.compile(r'\bID (\d+)\b')
+
+def chat_context_tags(db_query_or_signal):
+    """Cache tags for every ticket a chat prompt was built from, so update_ticket can invalidate them."""
+    if isinstance(db_query_or_signal, dict):
+        if db_query_or_signal.get("type") == "ticket_details":
+            return [f"ticket:{db_query_or_signal['id']}"]
+        return []
+    return sorted({f"ticket:{tid}" for tid in _CHAT_TICKET_ID_RE.findall(str(db_query_or_signal))})
+
+def offline_chat_response(db_query_or_signal):
+    if isinstance(db_query_or_signal, dict) and db_query_or_signal.get("type") == DIRECT_AI_SIGNAL:
+        return "My AI capabilities are currently unavailable for general questions. Please try asking about specific tickets."
+    if isinstance(db_query_or_signal, dict) and db_query_or_signal.get("type") == "ticket_details":
+        return db_query_or_signal.get("summary_text_for_ai", "Ticket information is available, but AI summarization is currently offline.")
+    return str(db_query_or_signal) 
+
+def ai_error_chat_response(db_query_or_signal):
+    if isinstance(db_query_or_signal, dict) and db_query_or_signal.get("type") == DIRECT_AI_SIGNAL:
+        return "An AI service error occurred. I can't process general queries right now. Try asking about specific tickets."
+    if isinstance(db_query_or_signal, dict) and db_query_or_signal.get("type") == "ticket_details":
+        return db_query_or_signal.get("summary_text_for_ai", "An AI service error occurred, but ticket details were found.")
+    return f"An AI service error occurred. Here's the direct information I found:\n{str(db_query_or_signal)}"
+
+def generate_ai_chat_response(user_message, db_query_or_signal):
+    if not GEMINI_API_KEY:
+        app.logger.warning("Chatbot: Gemini API Key is missing. AI responses will be limited.")
+        return offline_chat_response(db_query_or_signal)
+
+    prompt = build_chat_prompt(user_message, db_query_or_signal)
+
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash-latest') 
-        response = model.generate_content(
-            prompt,
-            generation_config=genai.types.GenerationConfig(
-                max_output_tokens=400,
-                temperature=0.5      
-            )
-        )
-        
-        ai_text = "".join(part.text for part in response.candidates[0].content.parts).strip() if response.candidates and response.candidates[0].content.parts else ""
+        ai_text, response = generate_ai_text(prompt, max_output_tokens=400, temperature=0.5, tags=chat_context_tags(db_query_or_signal))
         
         if not ai_text: 
             if response.prompt_feedback and response.prompt_feedback.block_reason:
@@ -1049,29 +1893,11 @@ Chatbot's Answer:"""
 
     except Exception as e:
         app.logger.error(f"Gemini API call error for chatbot (prompt: {prompt[:200]}...): {str(e)}")
-        if isinstance(db_query_or_signal, dict) and db_query_or_signal.get("type") == DIRECT_AI_SIGNAL:
-            return "An AI service error occurred. I can't process general queries right now. Try asking about specific tickets."
-        if isinstance(db_query_or_signal, dict) and db_query_or_signal.get("type") == "ticket_details":
-            return db_query_or_signal.get("summary_text_for_ai", "An AI service error occurred, but ticket details were found.")
-        return f"An AI service error occurred. Here's the direct information I found:\n{str(db_query_or_signal)}"
+        return ai_error_chat_response(db_query_or_signal)
 
 
-@app.route('/chat_api', methods=['POST'])
-@login_required
-def chat_api():
-    data = request.get_json()
-    if not data:
-        return jsonify({"error": "Invalid JSON payload"}), 400
-    
-    msg = data.get('message','').strip()
-    mode = data.get('mode', 'ticket_assistant') 
-
-    if not msg:
-        return jsonify({"reply": "Please type a message to start the chat."})
-
-    app.logger.info(f"Chat API: mode='{mode}', message='{msg}' from user: {session.get('username')}")
-
-    final_reply_text = ""
+def prepare_chat_context(msg, mode):
+    """Runs the DB side of a chat turn. Returns (db_result_for_ai_processing, relevant_docs, is_direct_ai, research_topic)."""
     relevant_docs_list = []
     is_direct_ai_response = False 
     research_topic_suggestion = msg 
@@ -1096,7 +1922,7 @@ def chat_api():
                     if raw_path: 
                         filename = os.path.basename(raw_path)
                         try:
-                            file_url = url_for('uploaded_file', filename=filename, _external=False)
+                            file_url = url_for('uploaded_file', filename=upload_route_filename(raw_path), _external=False)
                             relevant_docs_list.append({"name": filename, "url": file_url, "type": "attachment"})
                         except Exception as e:
                             app.logger.error(f"Could not generate URL for attachment {filename} in chat: {e}")
@@ -1105,7 +1931,7 @@ def chat_api():
                 if raw_remedy_path:
                     remedy_filename = os.path.basename(raw_remedy_path)
                     try:
-                        remedy_url = url_for('uploaded_file', filename=remedy_filename, _external=False)
+                        remedy_url = url_for('uploaded_file', filename=upload_route_filename(raw_remedy_path), _external=False)
                         relevant_docs_list.append({"name": remedy_filename, "url": remedy_url, "type": "remedy_document"})
                     except Exception as e:
                         app.logger.error(f"Could not generate URL for remedy doc {remedy_filename} in chat: {e}")
@@ -1121,6 +1947,26 @@ def chat_api():
             db_result_for_ai_processing = db_query_output
             is_direct_ai_response = False 
 
+    return db_result_for_ai_processing, relevant_docs_list, is_direct_ai_response, research_topic_suggestion
+
+
+@app.route('/chat_api', methods=['POST'])
+@login_required
+def chat_api():
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "Invalid JSON payload"}), 400
+    
+    msg = data.get('message','').strip()
+    mode = data.get('mode', 'ticket_assistant') 
+
+    if not msg:
+        return jsonify({"reply": "Please type a message to start the chat."})
+
+    app.logger.info(f"Chat API: mode='{mode}', message='{msg}' from user: {session.get('username')}")
+
+    db_result_for_ai_processing, relevant_docs_list, is_direct_ai_response, research_topic_suggestion = prepare_chat_context(msg, mode)
+
     final_reply_text = generate_ai_chat_response(msg, db_result_for_ai_processing)
     
     return jsonify({
@@ -1132,6 +1978,56 @@ def chat_api():
     })
 
 
+@socketio.on('chat_stream')
+def handle_chat_stream(data):
+    """Streaming variant of /chat_api: replies arrive as chat_stream_chunk events, then chat_stream_done."""
+    if not session_is_verified():
+        emit('chat_stream_done', {"request_id": None, "error": "Not logged in."})
+        return
+    data = data or {}
+    request_id = data.get('request_id')
+    msg = str(data.get('message', '')).strip()
+    mode = data.get('mode', 'ticket_assistant')
+    if not msg:
+        emit('chat_stream_done', {"request_id": request_id, "reply": "Please type a message to start the chat."})
+        return
+
+    app.logger.info(f"Chat stream: mode='{mode}', message='{msg}' from user: {session.get('username')}")
+    db_result_for_ai_processing, relevant_docs_list, is_direct_ai_response, research_topic_suggestion = prepare_chat_context(msg, mode)
+    done_payload = {
+        "request_id": request_id,
+        "relevant_docs": relevant_docs_list,
+        "is_direct_ai": is_direct_ai_response,
+        "research_topic_suggestion": research_topic_suggestion,
+        "aws_docs": []
+    }
+    socketio.start_background_task(_stream_chat_reply, request.sid, msg, db_result_for_ai_processing, done_payload)
+
+def _stream_chat_reply(sid, msg, db_result_for_ai_processing, done_payload):
+    request_id = done_payload["request_id"]
+    if not GEMINI_API_KEY:
+        socketio.emit('chat_stream_done', dict(done_payload, reply=offline_chat_response(db_result_for_ai_processing)), to=sid)
+        return
+    prompt = build_chat_prompt(msg, db_result_for_ai_processing)
+    cache_key = ai_cache_key(prompt, 400, 0.5)
+    cached = ai_response_cache.get(cache_key)
+    if cached is not None:
+        socketio.emit('chat_stream_done', dict(done_payload, reply=cached), to=sid)
+        return
+    parts = []
+    try:
+        for text in stream_ai_content(prompt, max_output_tokens=400, temperature=0.5):
+            parts.append(text)
+            socketio.emit('chat_stream_chunk', {"request_id": request_id, "text": text}, to=sid)
+        reply = "".join(parts).strip()
+        ai_response_cache.put(cache_key, reply, chat_context_tags(db_result_for_ai_processing))
+        reply = reply or offline_chat_response(db_result_for_ai_processing)
+    except Exception as e:
+        app.logger.error(f"Gemini streaming error for chatbot (prompt: {prompt[:200]}...): {str(e)}")
+        reply = ai_error_chat_response(db_result_for_ai_processing)
+    socketio.emit('chat_stream_done', dict(done_payload, reply=reply), to=sid)
+
+
 @app.route('/aws_doc_search_api', methods=['POST'])
 @login_required
 def aws_doc_search_api():
@@ -1142,6 +2038,7 @@ def aws_doc_search_api():
     research_topic = data.get('research_topic', '').strip()
     if not research_topic:
         return jsonify({"error": "Research topic is required."}), 400
+    research_topic = truncate_to_tokens(research_topic, AI_FIELD_TOKEN_BUDGET)
 
     app.logger.info(f"AWS Doc Search API request for topic: '{research_topic}'")
 
@@ -1164,16 +2061,7 @@ def aws_doc_search_api():
         ]
         If no specific official AWS docs are found, return an empty list ([]). Do not invent links. Do not add any other text before or after the JSON list.
         """
-        model = genai.GenerativeModel('gemini-1.5-flash-latest') 
-        response = model.generate_content(
-            aws_search_prompt,
-            generation_config=genai.types.GenerationConfig(
-                max_output_tokens=1500,
-                temperature=0.2       
-            )
-        )
-        
-        ai_response_text = "".join(part.text for part in response.candidates[0].content.parts).strip() if response.candidates and response.candidates[0].content.parts else ""
+        ai_response_text, _ = generate_ai_text(aws_search_prompt, max_output_tokens=1500, temperature=0.2)
         
         if ai_response_text:
             app.logger.debug(f"AWS Doc Search Gemini Raw Response: {ai_response_text}")
@@ -1209,6 +2097,12 @@ def aws_doc_search_api():
         
         return jsonify({"aws_docs": aws_documentation_links, "message": "AWS documentation search complete." if aws_documentation_links else "No relevant AWS documentation found by AI."})
 
+    except AIServiceBusy:
+        app.logger.warning("AWS Doc Search: AI pool at capacity, rejecting request.")
+        return jsonify({"error": "The AI service is busy right now. Please try again in a moment."}), 503
+    except AITimeout as e:
+        app.logger.error(f"AWS Doc Search: {e}")
+        return jsonify({"error": "The AI service took too long to respond. Please try again."}), 504
     except Exception as e:
         app.logger.error(f"Error during AWS doc search API for topic '{research_topic}': {e}")
         return jsonify({"error": "Failed to search for AWS documentation due to an internal error."}), 500
@@ -1235,12 +2129,14 @@ with app.app_context():
 
 if __name__ == '__main__':
     init_db()
+    email_outbox.start()
+    warm_up_gemini()
     print("DB Path:", os.path.abspath(DB_PATH))
     print(f"Flask app secret key is: {'SET (length ' + str(len(app.secret_key)) + ')' if app.secret_key and app.secret_key != 'def@ult-Sup3r-S3cr3t-Key-P13a5e-Chang3-M3!' else 'NOT SET (USING DEFAULT FALLBACK - INSECURE!)'}")
-    if not OTP_EMAIL_SENDER or not OTP_EMAIL_PASSWORD:
-        print("WARNING: Email sending credentials (EMAIL_USER or PASSWORD in .env for OTP) are not fully configured. OTP emails will fail.")
+    if not OTP_EMAIL_SENDER:
+        print("WARNING: Email sender (EMAIL_USER in .env for OTP) is not configured. OTP emails will fail.")
     else:
-        print(f"OTP Email sending configured with user: {OTP_EMAIL_SENDER}")
+        print(f"OTP Email sending configured with user: {OTP_EMAIL_SENDER} via {SMTP_HOST}:{SMTP_PORT} (login {'on' if OTP_EMAIL_PASSWORD else 'off'})")
     
     print("Starting Flask-SocketIO server...")
     socketio.run(app, host='0.0.0.0', port=5001, debug=True, use_reloader=True)
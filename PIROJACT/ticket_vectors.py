@@ -0,0 +1,173 @@
+import json
+import math
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+try:
+    import fcntl # POSIX only; used to serialise appends across gunicorn workers
+except ImportError:
+    fcntl = None
+
+# Similar-ticket index for the chatbot. Tickets are turned into fixed-size vectors with a signed
+# hashing vectorizer (no model download, no network), stored as a raw float32 matrix plus a
+# parallel int64 id file, and both are memory-mapped for querying. New and edited tickets are
+# appended; an edited ticket's old row is tombstoned by setting its id to -1. A rebuild writes
+# fresh files and swaps them in, which also compacts tombstones.
+
+VECTORIZER_VERSION = 1
+FIELD_WEIGHTS = {'title': 2.0, 'description': 1.0, 'remedies': 1.0}
+STOP_WORDS = frozenset('''a an and are as at be been but by can could do does for from had has have how i if in into is it
+its me my no not of on or our please so that the their them then there these this to too was we were what when where which
+while who why will with you your'''.split())
+_TOKEN_RE = re.compile(r'[^\W_]+')
+
+
+def text_features(text):
+    """Unigrams and adjacent-word bigrams of text, stop words dropped."""
+    tokens = [t for t in _TOKEN_RE.findall(text.lower()) if t not in STOP_WORDS]
+    return tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+
+def vectorize(fields, dim):
+    """Hashes a {field: text} mapping into an L2-normalised float32 vector of length dim."""
+    counts = {}
+    for field, text in fields.items():
+        if not text:
+            continue
+        weight = FIELD_WEIGHTS.get(field, 1.0)
+        for feature in text_features(text):
+            counts[feature] = counts.get(feature, 0.0) + weight
+    buckets = [0.0] * dim # accumulate in plain floats; per-element numpy updates are far slower
+    for feature, count in counts.items():
+        h = zlib.crc32(feature.encode('utf-8'))
+        weight = 1.0 + math.log(count)
+        buckets[h % dim] += weight if (h // dim) & 1 else -weight
+    vec = np.array(buckets, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    if norm > 0:
+        vec /= norm
+    return vec
+
+
+class TicketVectorIndex:
+    def __init__(self, directory, dim=256):
+        self.directory = directory
+        self.dim = dim
+        self.vectors_path = os.path.join(directory, 'vectors.f32')
+        self.ids_path = os.path.join(directory, 'ids.i64')
+        self.meta_path = os.path.join(directory, 'meta.json')
+        self._lock = threading.Lock()
+        self._mapped_stat = False # never equal to a real stat tuple (or None), forces a re-map
+        self._vectors = None
+        self._ids = None
+        os.makedirs(directory, exist_ok=True)
+
+    # --- reading ---
+
+    def _file_stat(self):
+        try:
+            v, i = os.stat(self.vectors_path), os.stat(self.ids_path)
+        except FileNotFoundError:
+            return None
+        return (v.st_ino, v.st_size, i.st_ino, i.st_size)
+
+    def _refresh(self):
+        """Re-maps the files if another writer (or worker process) appended or rebuilt them."""
+        stat = self._file_stat()
+        if stat == self._mapped_stat:
+            return
+        rows = 0 if stat is None else min(stat[1] // (4 * self.dim), stat[3] // 8)
+        if rows:
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+            self._ids = np.memmap(self.ids_path, dtype=np.int64, mode='r', shape=(rows,))
+        else:
+            self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+            self._ids = np.zeros(0, dtype=np.int64)
+        self._mapped_stat = stat
+
+    def needs_rebuild(self):
+        try:
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return True
+        return meta.get('dim') != self.dim or meta.get('version') != VECTORIZER_VERSION
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return int(np.count_nonzero(self._ids >= 0))
+
+    def search(self, text, k=5, min_score=0.0):
+        """Returns up to k (ticket_id, cosine score) pairs for text, best first."""
+        query = vectorize({'description': text}, self.dim)
+        if k <= 0 or not query.any():
+            return []
+        with self._lock:
+            self._refresh()
+            vectors, ids = self._vectors, self._ids
+        if not len(ids):
+            return []
+        scores = np.asarray(vectors @ query)
+        scores[ids < 0] = -np.inf
+        k = min(k, len(scores))
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(ids[i]), float(scores[i])) for i in top if scores[i] > min_score]
+
+    # --- writing ---
+
+    def _writer_lock(self):
+        lock_file = open(os.path.join(self.directory, 'lock'), 'a')
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def upsert(self, ticket_id, fields):
+        """Appends the vector for a new or edited ticket, tombstoning any older row for it."""
+        vec = vectorize(fields, self.dim)
+        with self._lock:
+            lock_file = self._writer_lock()
+            try:
+                self._refresh()
+                rows = len(self._ids)
+                stale = np.flatnonzero(self._ids == ticket_id)
+                if len(stale):
+                    with open(self.ids_path, 'r+b') as f:
+                        for row in stale:
+                            f.seek(int(row) * 8)
+                            f.write(np.int64(-1).tobytes())
+                # Trim any half-written row left by a crash so the two files stay aligned.
+                with open(self.vectors_path, 'ab') as vf, open(self.ids_path, 'ab') as idf:
+                    vf.truncate(rows * 4 * self.dim)
+                    idf.truncate(rows * 8)
+                    vf.write(vec.tobytes())
+                    idf.write(np.int64(ticket_id).tobytes())
+                self._mapped_stat = False
+            finally:
+                lock_file.close()
+
+    def rebuild(self, rows):
+        """Replaces the index with vectors for rows of (ticket_id, {field: text}). Returns the row count."""
+        tmp_vectors, tmp_ids = self.vectors_path + '.tmp', self.ids_path + '.tmp'
+        count = 0
+        with open(tmp_vectors, 'wb') as vf, open(tmp_ids, 'wb') as idf:
+            for ticket_id, fields in rows:
+                vf.write(vectorize(fields, self.dim).tobytes())
+                idf.write(np.int64(ticket_id).tobytes())
+                count += 1
+        with self._lock:
+            lock_file = self._writer_lock()
+            try:
+                os.replace(tmp_vectors, self.vectors_path)
+                os.replace(tmp_ids, self.ids_path)
+                with open(self.meta_path, 'w') as f:
+                    json.dump({'dim': self.dim, 'version': VECTORIZER_VERSION, 'rows': count}, f)
+                self._mapped_stat = False
+            finally:
+                lock_file.close()
+        return count
@@ -1,9 +1,71 @@
 # wsgi.py
-from server import app, socketio 
+from server import app, socketio, init_db, warm_up_gemini, email_outbox, SOCKETIO_MESSAGE_QUEUE
 import os
+import signal
+import subprocess
+import sys
+import time
+
+# Multi-worker mode: GUNICORN_WORKERS=N python wsgi.py starts N gunicorn processes, each running one
+# eventlet worker on its own port (GUNICORN_BASE_PORT, +1, ...). Socket.IO needs every request of a
+# session to hit the same worker, which gunicorn's own multi-worker balancing cannot guarantee, so
+# nginx spreads clients over the ports with ip_hash (see nginx/nginx.conf) and SOCKETIO_MESSAGE_QUEUE
+# carries emits between the workers.
+GUNICORN_WORKERS = int(os.environ.get("GUNICORN_WORKERS", "0"))
+GUNICORN_BASE_PORT = int(os.environ.get("GUNICORN_BASE_PORT", "5101"))
+GUNICORN_BIND_HOST = os.environ.get("GUNICORN_BIND_HOST", "127.0.0.1")
+# Set by the launcher for each gunicorn child it starts (0, 1, ...); unset in every other setup.
+WSGI_WORKER_INDEX = os.environ.get("WSGI_WORKER_INDEX")
+
+def start_serving_process():
+    """Startup side effects for a process that serves requests.
+
+    The launcher itself serves nothing: it creates the tables once before starting its children, so
+    they skip init_db, and only worker 0 runs the email outbox sender (one SMTP connection per set).
+    """
+    if WSGI_WORKER_INDEX is None:
+        init_db()
+    if WSGI_WORKER_INDEX in (None, "0"):
+        email_outbox.start()
+    warm_up_gemini()
+
+def run_gunicorn_workers(workers, base_port, host):
+    if workers > 1 and not SOCKETIO_MESSAGE_QUEUE:
+        sys.exit("GUNICORN_WORKERS > 1 needs SOCKETIO_MESSAGE_QUEUE (e.g. redis://localhost:6379/0), "
+                 "otherwise notifications only reach clients of the worker that sent them.")
+    init_db()
+    procs = []
+    for i in range(workers):
+        bind = f"{host}:{base_port + i}"
+        procs.append(subprocess.Popen([sys.executable, "-m", "gunicorn", "-k", "eventlet", "-w", "1", "-b", bind, "wsgi:app"],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)), env=dict(os.environ, WSGI_WORKER_INDEX=str(i))))
+        print(f"Started gunicorn+eventlet worker {i + 1}/{workers} on {bind} (pid {procs[-1].pid})")
+
+    def stop_all(*_):
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+    signal.signal(signal.SIGTERM, stop_all)
+
+    try:
+        # If any worker dies, take the rest down too so a supervisor restarts the whole set.
+        while all(proc.poll() is None for proc in procs):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_all()
+        for proc in procs:
+            proc.wait()
+    return max((proc.returncode or 0) for proc in procs)
+
+if not (__name__ == '__main__' and GUNICORN_WORKERS):
+    start_serving_process()
 
 if __name__ == '__main__':
+    if GUNICORN_WORKERS:
+        sys.exit(run_gunicorn_workers(GUNICORN_WORKERS, GUNICORN_BASE_PORT, GUNICORN_BIND_HOST))
     port = int(os.environ.get("PORT", 5001))
-    debug_mode = os.environ.get("FLASK_DEBUG", "0") == "1" 
+    debug_mode = os.environ.get("FLASK_DEBUG", "0") == "1"
     print(f"Starting SocketIO server via wsgi.py on port {port} with debug={debug_mode}")
     socketio.run(app, host='0.0.0.0', port=port, debug=debug_mode, use_reloader=debug_mode)
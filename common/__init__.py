@@ -0,0 +1,3 @@
+# Modules shared by the ticket app (PIROJACT) and the EC2 analyzer (pkrl): one copy of the session
+# and outbound mail code for both. Each app runs from its own directory and puts the repository root
+# on sys.path to import it, so deploy common/ next to the app directory.
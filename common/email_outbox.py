@@ -0,0 +1,231 @@
+import random
+import smtplib
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Outbound email queue. enqueue() stores a ready-to-send message in the email_outbox table and
+# returns at once; a background sender claims due rows in batches, pushes them through one
+# long-lived authenticated SMTP connection and retries failures with exponential backoff.
+# Claiming works through a lease (claim_token + next_attempt_at), so several worker processes can
+# share one outbox and a crashed sender's rows simply become due again.
+#
+# Messages carry OTPs, so a row's body is blanked as soon as it is sent or given up on, and finished
+# rows are deleted once they are older than `retention` seconds.
+#
+# To try it locally without a real mailbox, run a debugging SMTP server such as
+#   python -m aiosmtpd -n -l localhost:1025
+# and start the app with SMTP_HOST=localhost SMTP_PORT=1025 SMTP_STARTTLS=0 (and no PASSWORD).
+
+
+class EmailOutbox:
+    def __init__(self, db_path, smtp_host, smtp_port, username=None, password=None, starttls=True,
+                 batch_size=20, max_attempts=6, retry_base=5.0, retry_max=900.0, lease=120.0,
+                 poll_interval=5.0, idle_timeout=60.0, smtp_timeout=20.0, retention=7 * 24 * 3600.0):
+        self.db_path = db_path
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.smtp_timeout = smtp_timeout
+        self.retention = retention
+        self._wakeup = threading.Event()
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._counters = {"sent": 0, "retried": 0, "failed": 0, "connections_opened": 0, "purged": 0}
+        self._last = {"last_error": None, "last_sent_at": None}
+        self._last_purge = 0.0
+        self._smtp = None
+        self._smtp_last_used = 0.0
+
+    # --- queue ---
+
+    @contextmanager
+    def _connect_db(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def init_table(self, conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS email_outbox (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            from_addr TEXT NOT NULL,
+                            to_addr TEXT NOT NULL,
+                            message TEXT NOT NULL, /* full RFC 5322 message */
+                            status TEXT NOT NULL DEFAULT 'pending', /* pending, sent, failed */
+                            attempts INTEGER NOT NULL DEFAULT 0,
+                            next_attempt_at REAL NOT NULL,
+                            claim_token TEXT,
+                            last_error TEXT,
+                            created_at REAL NOT NULL,
+                            sent_at REAL
+                        )''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (status, next_attempt_at)")
+
+    def enqueue(self, msg):
+        """Queues an email.message.Message (From/To headers set) and returns its outbox id."""
+        now = time.time()
+        with self._connect_db() as conn:
+            cur = conn.execute("INSERT INTO email_outbox (from_addr, to_addr, message, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                               (msg['From'], msg['To'], msg.as_string(), now, now))
+            outbox_id = cur.lastrowid
+        self._wakeup.set()
+        return outbox_id
+
+    def _claim_batch(self):
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self._connect_db() as conn:
+            conn.execute('''UPDATE email_outbox SET claim_token = ?, next_attempt_at = ?
+                            WHERE id IN (SELECT id FROM email_outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?)''',
+                         (token, now + self.lease, now, self.batch_size))
+            return conn.execute("SELECT id, from_addr, to_addr, message, attempts FROM email_outbox WHERE claim_token = ? AND status = 'pending' ORDER BY id",
+                                (token,)).fetchall()
+
+    def _mark_sent(self, row):
+        with self._connect_db() as conn:
+            # message is NOT NULL in existing tables, so the body (and its OTP) is blanked rather than nulled
+            conn.execute("UPDATE email_outbox SET status = 'sent', message = '', attempts = attempts + 1, sent_at = ?, claim_token = NULL, last_error = NULL WHERE id = ?",
+                         (time.time(), row['id']))
+        self._record('sent', last_sent_at=time.time())
+
+    def _mark_failed(self, row, error, permanent):
+        attempts = row['attempts'] + 1
+        give_up = permanent or attempts >= self.max_attempts
+        delay = min(self.retry_base * (2 ** (attempts - 1)), self.retry_max) * random.uniform(0.8, 1.2)
+        with self._connect_db() as conn:
+            conn.execute("UPDATE email_outbox SET status = ?, message = CASE WHEN ? THEN '' ELSE message END, attempts = ?, next_attempt_at = ?, claim_token = NULL, last_error = ? WHERE id = ?",
+                         ('failed' if give_up else 'pending', give_up, attempts, time.time() + delay, str(error)[:500], row['id']))
+        if give_up:
+            self._record('failed', last_error=str(error))
+            print(f"Email {row['id']} to {row['to_addr']} failed permanently after {attempts} attempt(s): {error}")
+        else:
+            self._record('retried', last_error=str(error))
+            print(f"Email {row['id']} to {row['to_addr']} failed (attempt {attempts}), retrying in {delay:.0f}s: {error}")
+
+    # --- SMTP connection ---
+
+    def _smtp_connection(self):
+        """Returns a live, authenticated connection, reusing the previous one when it still answers."""
+        if self._smtp is not None:
+            try:
+                if time.monotonic() - self._smtp_last_used < 10 or self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            self._close_smtp()
+        smtp = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=self.smtp_timeout)
+        try:
+            if self.starttls:
+                smtp.starttls()
+            if self.username and self.password:
+                smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        self._smtp = smtp
+        self._record('connections_opened')
+        return smtp
+
+    def _close_smtp(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                self._smtp.close()
+            self._smtp = None
+
+    # --- sender ---
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name='email-outbox', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                sent_any = self._send_due()
+            except Exception as e:
+                self._record(last_error=str(e))
+                print(f"Email outbox sender error: {e}")
+                sent_any = False
+            if time.monotonic() - self._last_purge > 3600:
+                self._purge_finished()
+            if self._smtp is not None and time.monotonic() - self._smtp_last_used > self.idle_timeout:
+                self._close_smtp()
+            if not sent_any:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def _send_due(self):
+        rows = self._claim_batch()
+        if not rows:
+            return False
+        for row in rows:
+            try:
+                smtp = self._smtp_connection()
+                smtp.sendmail(row['from_addr'], [row['to_addr']], row['message'])
+                self._smtp_last_used = time.monotonic()
+                self._mark_sent(row)
+            except smtplib.SMTPRecipientsRefused as e:
+                # 5xx is a hard bounce; 4xx (greylisting, mailbox busy) is worth another try
+                self._mark_failed(row, e, permanent=all(code >= 500 for code, _ in e.recipients.values()))
+            except smtplib.SMTPResponseException as e:
+                self._mark_failed(row, e, permanent=500 <= e.smtp_code < 600 and not isinstance(e, smtplib.SMTPAuthenticationError))
+            except (smtplib.SMTPException, OSError) as e:
+                self._close_smtp() # connection-level trouble: reconnect on the next message
+                self._mark_failed(row, e, permanent=False)
+        return True
+
+    def _purge_finished(self):
+        """Deletes sent and failed rows older than the retention period."""
+        self._last_purge = time.monotonic()
+        try:
+            with self._connect_db() as conn:
+                purged = conn.execute("DELETE FROM email_outbox WHERE status IN ('sent', 'failed') AND created_at < ?",
+                                      (time.time() - self.retention,)).rowcount
+        except sqlite3.Error as e:
+            self._record(last_error=str(e))
+            print(f"Email outbox purge failed: {e}")
+            return
+        if purged:
+            self._record('purged', count=purged)
+
+    # --- metrics ---
+
+    def _record(self, counter=None, count=1, **last):
+        """Adds count to one of the counters and/or sets last_error / last_sent_at."""
+        with self._stats_lock:
+            if counter:
+                self._counters[counter] += count
+            self._last.update(last)
+
+    def metrics(self):
+        with self._stats_lock:
+            stats = {**self._counters, **self._last}
+        with self._connect_db() as conn:
+            stats["queue"] = {row[0]: row[1] for row in conn.execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status")}
+            oldest = conn.execute("SELECT MIN(created_at) FROM email_outbox WHERE status = 'pending'").fetchone()[0]
+        stats["oldest_pending_age_s"] = round(time.time() - oldest, 1) if oldest else 0
+        stats["connected"] = self._smtp is not None
+        return stats
@@ -0,0 +1,175 @@
+import json
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+# Server-side sessions. The browser cookie only carries a random session id; the session dict lives
+# in a store picked by SESSION_STORE: 'memory' (process-local LRU with TTL, the default) or
+# 'sqlite:///path/to/sessions.db' (shared by every worker on the host). The store also caches user
+# records by username so login_required can check the verified flag without touching the users
+# table; signup and OTP verification call invalidate_user() whenever that record changes.
+
+
+class MemorySessionStore:
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._sessions = OrderedDict() # sid -> (expires_at, data)
+        self._users = OrderedDict() # username -> (expires_at, record)
+        self._lock = threading.Lock()
+
+    def _get(self, table, key):
+        with self._lock:
+            entry = table.get(key)
+            if entry is None:
+                return None, 0
+            if entry[0] <= time.time():
+                del table[key]
+                return None, 0
+            table.move_to_end(key)
+            return entry[1], entry[0]
+
+    def _put(self, table, key, value):
+        with self._lock:
+            table[key] = (time.time() + self.ttl, value)
+            table.move_to_end(key)
+            while len(table) > self.max_entries:
+                table.popitem(last=False)
+
+    def load(self, sid):
+        """Returns (data, expires_at); data is None for unknown or expired sessions."""
+        data, expires_at = self._get(self._sessions, sid)
+        return (dict(data) if data is not None else None), expires_at
+
+    def save(self, sid, data):
+        self._put(self._sessions, sid, dict(data))
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def get_user(self, username):
+        return self._get(self._users, username)[0]
+
+    def put_user(self, username, record):
+        self._put(self._users, username, dict(record))
+
+    def invalidate_user(self, username):
+        with self._lock:
+            self._users.pop(username, None)
+
+
+class SQLiteSessionStore:
+    def __init__(self, db_path, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS server_sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS session_users (username TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._db.execute("DELETE FROM server_sessions WHERE expires_at <= ?", (time.time(),))
+        self._db.execute("DELETE FROM session_users WHERE expires_at <= ?", (time.time(),))
+        self._db.commit()
+
+    def _get(self, table, key_column, key):
+        with self._lock:
+            row = self._db.execute(f"SELECT data, expires_at FROM {table} WHERE {key_column} = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return (json.loads(row[0]), row[1]) if row else (None, 0)
+
+    def _put(self, table, key_column, key, value):
+        with self._lock:
+            self._db.execute(f"INSERT OR REPLACE INTO {table} ({key_column}, data, expires_at) VALUES (?, ?, ?)",
+                             (key, json.dumps(value), time.time() + self.ttl))
+            self._db.commit()
+
+    def _delete(self, table, key_column, key):
+        with self._lock:
+            self._db.execute(f"DELETE FROM {table} WHERE {key_column} = ?", (key,))
+            self._db.commit()
+
+    def load(self, sid):
+        return self._get('server_sessions', 'sid', sid)
+
+    def save(self, sid, data):
+        self._put('server_sessions', 'sid', sid, dict(data))
+
+    def delete(self, sid):
+        self._delete('server_sessions', 'sid', sid)
+
+    def get_user(self, username):
+        return self._get('session_users', 'username', username)[0]
+
+    def put_user(self, username, record):
+        self._put('session_users', 'username', username, dict(record))
+
+    def invalidate_user(self, username):
+        self._delete('session_users', 'username', username)
+
+
+def create_session_store(spec, ttl):
+    """'memory' or 'sqlite:///path/to/sessions.db'."""
+    if not spec or spec == 'memory':
+        return MemorySessionStore(ttl)
+    if spec.startswith('sqlite:///'):
+        return SQLiteSessionStore(spec[len('sqlite:///'):], ttl)
+    raise ValueError(f"Unknown SESSION_STORE '{spec}' (use 'memory' or 'sqlite:///path').")
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, needs_refresh=False):
+        def on_update(session):
+            session.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.needs_refresh = needs_refresh
+        self.replaced_sid = None
+
+    def regenerate(self):
+        """Moves the session to a fresh id (call on login so a planted session id is useless)."""
+        if self.replaced_sid is None and not self.new:
+            self.replaced_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface that keeps session data in a session store, keyed by a random cookie id.
+
+    Sessions slide: one that is read with less than half its TTL left is written back with a fresh TTL.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data, expires_at = self.store.load(sid)
+            if data is not None:
+                return ServerSession(data, sid=sid, needs_refresh=expires_at - time.time() < self.store.ttl / 2)
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.replaced_sid:
+            self.store.delete(session.replaced_sid)
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not (session.modified or session.new or session.needs_refresh):
+            return
+        self.store.save(session.sid, session)
+        response.set_cookie(name, session.sid, max_age=int(self.store.ttl), httponly=self.get_cookie_httponly(app),
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app), domain=domain, path=path)
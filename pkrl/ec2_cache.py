@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl # POSIX only; stops two processes from rebuilding the same cache at once
+except ImportError:
+    fcntl = None
+
+# Columnar cache for the preprocessed EC2 price table. The first boot after the CSV changes parses
+# and preprocesses it, then writes every column as its own .npy file under cache_dir/<version>/
+# (numbers as-is, strings as categorical codes with the categories kept in the manifest). Later
+# boots check the CSV against manifest.json and memory-map the columns instead, so startup costs
+# milliseconds and untouched pages never become resident.
+#
+# load_ec2_frame() can also be given a derive(df) callback whose {name: ndarray} result is stored and
+# memory-mapped the same way; the row indexes in ec2_index.py are kept there.
+#
+# manifest.json records the CSV's size, mtime and sha256. A matching size+mtime is trusted as is; if
+# only the mtime moved (a copy, a touch) the file is hashed and the cache is kept when the hash still
+# matches. The manifest is replaced atomically, so a reader never sees a half-written cache, and
+# rebuilds hold cache_dir/lock so concurrent workers wait for one rebuild and then map its result.
+#
+# The cache can also be written directly from AWS offer files by ingest_offers.py (write_ec2_frame).
+# Such a dataset has no CSV behind it and is used until a CSV newer than the ingestion shows up.
+
+CACHE_FORMAT_VERSION = 3
+MIN_PRICE_PER_HOUR = 0.00000001 # rows at or below this are placeholders / free tiers
+_MEMORY_RE = r'(\d+\.?\d*)'
+
+
+def preprocess_ec2_frame(df):
+    """Adds MemoryGiB, PricePerVCpu and PricePerMemoryGiB, drops zero-priced rows, and turns string columns into categoricals."""
+    # Memory looks like "16 GiB" and has a few hundred distinct values, so parse each distinct string once.
+    memory = df['Memory'].astype('category')
+    parsed = pd.to_numeric(memory.cat.categories.to_series().str.extract(_MEMORY_RE, expand=False), errors='coerce').to_numpy()
+    codes = memory.cat.codes.to_numpy()
+    df['MemoryGiB'] = np.where(codes >= 0, parsed[codes] if len(parsed) else np.nan, np.nan)
+
+    # Price per vCPU / per GiB; a zero or missing divisor gives inf, like the old row-wise version.
+    price = df['PricePerHourUSD'].to_numpy(dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for column, divisor in (('PricePerVCpu', df['vCPU']), ('PricePerMemoryGiB', df['MemoryGiB'])):
+            divisor = divisor.to_numpy(dtype=np.float64)
+            df[column] = np.where(divisor > 0, price / divisor, np.inf)
+
+    df = df[df['PricePerHourUSD'] > MIN_PRICE_PER_HOUR].reset_index(drop=True)
+    for column in df.columns:
+        if not pd.api.types.is_numeric_dtype(df[column]):
+            df[column] = df[column].astype('category')
+    return df
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return manifest if manifest.get('format') == CACHE_FORMAT_VERSION else None
+
+
+def _write_manifest(cache_dir, manifest):
+    tmp_path = os.path.join(cache_dir, 'manifest.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(cache_dir, 'manifest.json'))
+
+
+def _write_cache(df, arrays, cache_dir, source):
+    """Writes df column by column, plus the derived arrays, into a fresh version directory and points the manifest at it."""
+    version = f"{source['sha256'][:16]}-{time.time_ns()}"
+    version_dir = os.path.join(cache_dir, version)
+    os.makedirs(version_dir)
+    columns = []
+    for i, name in enumerate(df.columns):
+        filename = f'col{i}.npy'
+        series = df[name]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            np.save(os.path.join(version_dir, filename), series.cat.codes.to_numpy())
+            columns.append({'name': name, 'file': filename, 'categories': series.cat.categories.tolist()})
+        else:
+            np.save(os.path.join(version_dir, filename), series.to_numpy())
+            columns.append({'name': name, 'file': filename})
+    for name, values in arrays.items():
+        np.save(os.path.join(version_dir, f'{name}.npy'), values)
+    previous = _read_manifest(cache_dir)
+    _write_manifest(cache_dir, {'format': CACHE_FORMAT_VERSION, 'version': version, 'rows': len(df), 'columns': columns,
+                                'arrays': sorted(arrays), 'source': source})
+    # Processes that mapped the old version keep their (unlinked) files until they remap.
+    if previous and previous.get('version') != version:
+        shutil.rmtree(os.path.join(cache_dir, previous['version']), ignore_errors=True)
+
+
+def _load_cache(cache_dir, manifest):
+    version_dir = os.path.join(cache_dir, manifest['version'])
+    data = {}
+    for column in manifest['columns']:
+        values = np.load(os.path.join(version_dir, column['file']), mmap_mode='r')
+        if 'categories' in column:
+            values = pd.Categorical.from_codes(values, dtype=pd.CategoricalDtype(column['categories']), validate=False)
+        data[column['name']] = values
+    arrays = {name: np.load(os.path.join(version_dir, f'{name}.npy'), mmap_mode='r') for name in manifest['arrays']}
+    return pd.DataFrame(data, copy=False), arrays, manifest['version']
+
+
+def _cache_lock(cache_dir):
+    lock_file = open(os.path.join(cache_dir, 'lock'), 'a')
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def csv_signature(csv_path):
+    """(size, mtime_ns) of the CSV, or None if it is missing; cheap enough to poll."""
+    try:
+        stat = os.stat(csv_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def manifest_signature(cache_dir):
+    """(size, mtime_ns) of the cache manifest, or None; changes whenever any process rebuilds or ingests."""
+    return csv_signature(os.path.join(cache_dir, 'manifest.json'))
+
+
+def write_ec2_frame(df, cache_dir, source, derive=None):
+    """Preprocesses a raw Region/InstanceType/vCPU/Memory/PricePerHourUSD frame and stores it as the current cache version.
+
+    source describes where the rows came from; it needs a 'sha256' entry, which names the version.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    df = preprocess_ec2_frame(df)
+    arrays = derive(df) if derive else {}
+    lock_file = _cache_lock(cache_dir)
+    try:
+        _write_cache(df, arrays, cache_dir, source)
+    finally:
+        lock_file.close()
+    return len(df)
+
+
+def load_ec2_frame(csv_path, cache_dir, derive=None):
+    """Returns (preprocessed DataFrame, derived arrays, cache version), reading the CSV only when the cache is missing or stale.
+
+    derive(df) -> {name: ndarray} is run whenever the cache is rebuilt. Raises FileNotFoundError when there is neither a
+    CSV nor an ingested dataset.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    lock_file = _cache_lock(cache_dir)
+    try:
+        return _load_or_build(csv_path, cache_dir, derive)
+    finally:
+        lock_file.close()
+
+
+def _load_or_build(csv_path, cache_dir, derive):
+    manifest = _read_manifest(cache_dir)
+    try:
+        stat = os.stat(csv_path)
+    except FileNotFoundError:
+        stat = None
+    if manifest and manifest['source'].get('kind') == 'offers':
+        if stat is None or stat.st_mtime_ns <= manifest['source']['ingested_at_ns']:
+            return _load_cache(cache_dir, manifest)
+        manifest = None # a newer CSV replaces the ingested data
+    if stat is None:
+        raise FileNotFoundError(csv_path)
+    if manifest:
+        source = manifest['source']
+        if source['size'] == stat.st_size and source['mtime_ns'] == stat.st_mtime_ns:
+            return _load_cache(cache_dir, manifest)
+        if source['size'] == stat.st_size and source['sha256'] == _file_sha256(csv_path):
+            manifest['source']['mtime_ns'] = stat.st_mtime_ns
+            _write_manifest(cache_dir, manifest)
+            return _load_cache(cache_dir, manifest)
+
+    source = {'path': os.path.abspath(csv_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': _file_sha256(csv_path)}
+    df = preprocess_ec2_frame(pd.read_csv(csv_path))
+    _write_cache(df, derive(df) if derive else {}, cache_dir, source)
+    return _load_cache(cache_dir, _read_manifest(cache_dir))
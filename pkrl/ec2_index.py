@@ -0,0 +1,246 @@
+import numpy as np
+import pandas as pd
+
+# Row indexes over the preprocessed EC2 frame, so /ec2-analysis can answer a filter without copying
+# or re-sorting the frame:
+#   - rows grouped by region (region_order/region_starts: a CSR-style layout over Region codes),
+#   - rows grouped by lower-cased instance type in sorted order, so every type prefix is one
+#     contiguous slice found with two searchsorted calls (type_order/type_starts),
+#   - for each sortable column a presorted permutation and its inverse (the rank of every row),
+#     used to order a candidate set by rank and take a top N with argpartition,
+#   - a dense instance type x region price matrix (NaN where a type is not offered), holding the
+#     cheapest hourly price of each pair, so cheapest-region and region-vs-region lookups are a
+#     single row or column slice.
+# build_index_arrays() runs once per dataset and its arrays are stored in the columnar cache next to
+# the columns (see ec2_cache.py); EC2Index wraps the memory-mapped arrays at boot.
+
+# Sort key -> descending? Prices sort cheapest first, capacity columns biggest first.
+SORT_KEYS = {'PricePerHourUSD': False, 'PricePerVCpu': False, 'PricePerMemoryGiB': False, 'vCPU': True, 'MemoryGiB': True}
+DEFAULT_SORT_KEY = 'PricePerHourUSD'
+# Numeric bounds a query can carry: (column, query() keyword, comparison).
+BOUND_FIELDS = (('vCPU', 'min_vcpu', np.greater_equal), ('MemoryGiB', 'min_memory', np.greater_equal), ('PricePerHourUSD', 'max_price', np.less_equal))
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+
+def _type_rank(categories):
+    """Rank of each InstanceType category in case-insensitive sorted order, plus the sorted lower-cased names."""
+    lower = np.array([str(c).lower() for c in categories], dtype=object)
+    order = np.argsort(lower, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return rank, lower[order]
+
+
+def _grouped(keys, groups):
+    """Row positions stably grouped by key, and the start offset of every group (length groups + 1)."""
+    order = np.argsort(keys, kind='stable').astype(np.int32)
+    starts = np.zeros(groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys[keys >= 0], minlength=groups), out=starts[1:])
+    return order[np.count_nonzero(keys < 0):], starts
+
+
+def build_index_arrays(df):
+    """Computes the index arrays for df as a {name: ndarray} dict."""
+    arrays = {}
+    region_codes = df['Region'].cat.codes.to_numpy()
+    arrays['region_order'], arrays['region_starts'] = _grouped(region_codes, len(df['Region'].cat.categories))
+
+    type_codes = df['InstanceType'].cat.codes.to_numpy()
+    rank, _ = _type_rank(df['InstanceType'].cat.categories)
+    type_ranks = np.where(type_codes >= 0, rank[type_codes], -1)
+    arrays['type_order'], arrays['type_starts'] = _grouped(type_ranks, len(rank))
+
+    for key, descending in SORT_KEYS.items():
+        values = df[key].to_numpy(dtype=np.float64)
+        perm = np.argsort(-values if descending else values, kind='stable').astype(np.int32) # NaN sorts last either way
+        ranks = np.empty(len(perm), dtype=np.int32)
+        ranks[perm] = np.arange(len(perm), dtype=np.int32)
+        arrays[f'perm_{key}'] = perm
+        arrays[f'rank_{key}'] = ranks
+
+    arrays['price_matrix'], arrays['price_matrix_rows'] = _price_matrix(type_codes, region_codes, len(rank),
+                                                                        len(df['Region'].cat.categories),
+                                                                        df['PricePerHourUSD'].to_numpy(dtype=np.float64))
+    return arrays
+
+
+def _price_matrix(type_codes, region_codes, types, regions, price):
+    """(types x regions matrix of the lowest price per pair, NaN if none; row position of that price, -1 if none)."""
+    rows = np.flatnonzero((type_codes >= 0) & (region_codes >= 0) & ~np.isnan(price))
+    cells = type_codes[rows].astype(np.int64) * regions + region_codes[rows]
+    order = np.lexsort((price[rows], cells)) # by cell, cheapest first within a cell
+    cells, rows = cells[order], rows[order]
+    first = np.ones(len(cells), dtype=bool)
+    first[1:] = cells[1:] != cells[:-1]
+    matrix = np.full(types * regions, np.nan)
+    matrix[cells[first]] = price[rows[first]]
+    cell_rows = np.full(types * regions, -1, dtype=np.int32)
+    cell_rows[cells[first]] = rows[first]
+    return matrix.reshape(types, regions), cell_rows.reshape(types, regions)
+
+
+class EC2Index:
+    def __init__(self, df, arrays):
+        self.df = df
+        self.arrays = arrays
+        self.regions = df['Region'].cat.categories.tolist()
+        self._region_codes = {region: code for code, region in enumerate(self.regions)}
+        self.instance_types = df['InstanceType'].cat.categories.tolist()
+        self._instance_type_codes = {str(name).lower(): code for code, name in enumerate(self.instance_types)}
+        _, self._sorted_type_names = _type_rank(df['InstanceType'].cat.categories)
+        # InstanceType category -> family ("m5.large" -> "m5"), for the per-region family chart.
+        families = pd.Series(df['InstanceType'].cat.categories, dtype=object).astype(str).str.split('.', n=1).str[0]
+        self._family_codes, self.families = pd.factorize(families)
+        self.type_families = np.asarray(self.families, dtype=object)[self._family_codes] # family of every InstanceType category
+        self._filter_columns = {name: df[name].to_numpy() for name in ('vCPU', 'MemoryGiB', 'PricePerHourUSD')}
+        self._region_column = df['Region'].cat.codes.to_numpy()
+
+    def __len__(self):
+        return len(self.df)
+
+    def region_counts(self):
+        """Rows per region, in region order."""
+        return dict(zip(self.regions, np.diff(self.arrays['region_starts']).tolist()))
+
+    def region_rows(self, region):
+        code = self._region_codes.get(region)
+        if code is None:
+            return np.zeros(0, dtype=np.int32)
+        starts = self.arrays['region_starts']
+        return self.arrays['region_order'][starts[code]:starts[code + 1]]
+
+    def family_counts(self, region):
+        """Rows per instance family within region, largest first."""
+        type_codes = self.df['InstanceType'].cat.codes.to_numpy()[self.region_rows(region)]
+        counts = np.bincount(self._family_codes[type_codes[type_codes >= 0]], minlength=len(self.families))
+        order = np.argsort(-counts, kind='stable')
+        return [(self.families[i], int(counts[i])) for i in order if counts[i]]
+
+    def type_prefix_rows(self, prefix):
+        prefix = prefix.lower()
+        lo = np.searchsorted(self._sorted_type_names, prefix, side='left')
+        hi = np.searchsorted(self._sorted_type_names, prefix + '\U0010ffff', side='left')
+        starts = self.arrays['type_starts']
+        return self.arrays['type_order'][starts[lo]:starts[hi]]
+
+    def region_code(self, region):
+        return self._region_codes.get(region)
+
+    def instance_type_code(self, instance_type):
+        """Column code of an instance type (case-insensitive), or None if it is not in the data."""
+        return self._instance_type_codes.get(instance_type.strip().lower())
+
+    def cheapest_regions(self, type_code, n=None):
+        """(region codes, prices) of the n cheapest regions offering the type, cheapest first; n=None gives all of them."""
+        prices = self.arrays['price_matrix'][type_code]
+        offered = np.count_nonzero(~np.isnan(prices))
+        order = np.argsort(prices, kind='stable')[:offered if n is None else min(n, offered)] # NaN sorts last
+        return order, prices[order]
+
+    def compare_regions(self, region_a, region_b):
+        """(type codes offered in both, their prices in a, in b, number of types only in a, only in b) for two region codes."""
+        matrix = self.arrays['price_matrix']
+        price_a, price_b = matrix[:, region_a], matrix[:, region_b]
+        in_a, in_b = ~np.isnan(price_a), ~np.isnan(price_b)
+        both = np.flatnonzero(in_a & in_b)
+        return both, price_a[both], price_b[both], int(np.count_nonzero(in_a & ~in_b)), int(np.count_nonzero(in_b & ~in_a))
+
+    def _candidates(self, region, type_prefix):
+        """Rows matching region and type prefix, or None when neither narrows the set."""
+        if not type_prefix:
+            return self.region_rows(region) if region else None
+        rows = self.type_prefix_rows(type_prefix)
+        if not region:
+            return rows
+        code = self._region_codes.get(region)
+        return rows[self._region_column[rows] == code] if code is not None else rows[:0]
+
+    def _bounds(self, min_vcpu, min_memory, max_price):
+        values = {'min_vcpu': min_vcpu, 'min_memory': min_memory, 'max_price': max_price}
+        return [(self._filter_columns[name], values[field], op) for name, field, op in BOUND_FIELDS if values[field] is not None]
+
+    def query(self, region=None, type_prefix='', min_vcpu=None, min_memory=None, max_price=None, sort_by=DEFAULT_SORT_KEY, limit=None):
+        """Returns (row positions of the first `limit` matches in sort order, total number of matches).
+
+        limit=None returns every match. Positions index the frame with df.take() / iloc.
+        """
+        if sort_by not in SORT_KEYS:
+            sort_by = DEFAULT_SORT_KEY
+        candidates = self._candidates(region, type_prefix)
+        bounds = self._bounds(min_vcpu, min_memory, max_price)
+
+        if candidates is None:
+            # No index narrowed the set: walk the presorted permutation, which is already in order.
+            perm = self.arrays[f'perm_{sort_by}']
+            if bounds:
+                mask = np.ones(len(self.df), dtype=bool)
+                for column, value, op in bounds:
+                    mask &= op(column, value)
+                perm = perm[mask[perm]]
+            return perm[:limit], len(perm)
+
+        for column, value, op in bounds:
+            candidates = candidates[op(column[candidates], value)]
+        ranks = self.arrays[f'rank_{sort_by}'][candidates]
+        if limit is not None and limit < len(candidates):
+            top = np.argpartition(ranks, limit)[:limit] if limit > 0 else np.zeros(0, dtype=np.int64)
+            top = top[np.argsort(ranks[top])]
+        else:
+            top = np.argsort(ranks)
+        return candidates[top], len(candidates)
+
+    def query_many(self, specs, max_bytes=1 << 24):
+        """Evaluates a batch of query() keyword dicts together; returns [(positions, total)] in input order.
+
+        Specs with the same region, prefix and sort key share one candidate list, put in sort order
+        once. Each distinct bound value (say min_vcpu=8) is compared against it once and kept as a
+        packed bitmask, so a spec costs a few ANDs over len/8 bytes, a popcount for its total, and
+        unpacking only the prefix that holds its first `limit` hits. max_bytes caps the masks kept
+        per group. A spec with no partner in the batch simply goes through query().
+        """
+        groups = {}
+        for i, spec in enumerate(specs):
+            sort_by = spec.get('sort_by') if spec.get('sort_by') in SORT_KEYS else DEFAULT_SORT_KEY
+            groups.setdefault((spec.get('region') or None, (spec.get('type_prefix') or '').lower(), sort_by), []).append(i)
+
+        results = [None] * len(specs)
+        candidate_sets = {}
+        for (region, type_prefix, sort_by), members in groups.items():
+            if len(members) == 1:
+                results[members[0]] = self.query(**specs[members[0]])
+                continue
+            if (region, type_prefix) not in candidate_sets:
+                candidate_sets[region, type_prefix] = self._candidates(region, type_prefix)
+            candidates = candidate_sets[region, type_prefix]
+            if candidates is None:
+                ordered = self.arrays[f'perm_{sort_by}']
+            else:
+                ordered = candidates[np.argsort(self.arrays[f'rank_{sort_by}'][candidates])]
+            columns = {}
+            masks = {}
+            max_masks = max(1, max_bytes // (len(ordered) // 8 + 1))
+            for i in members:
+                packed = None
+                for name, field, op in BOUND_FIELDS:
+                    value = specs[i].get(field)
+                    if value is None:
+                        continue
+                    if (name, value) not in masks:
+                        if len(masks) >= max_masks:
+                            masks.clear()
+                        if name not in columns:
+                            columns[name] = self._filter_columns[name][ordered]
+                        masks[name, value] = np.packbits(op(columns[name], value))
+                    packed = masks[name, value] if packed is None else packed & masks[name, value]
+
+                limit = specs[i].get('limit')
+                if packed is None:
+                    results[i] = (ordered[:limit], len(ordered))
+                    continue
+                counts = _POPCOUNT[packed]
+                total = int(counts.sum())
+                if limit is not None and limit < total:
+                    packed = packed[:np.searchsorted(np.cumsum(counts), limit) + 1] # bytes holding the first `limit` hits
+                hits = np.flatnonzero(np.unpackbits(packed, count=min(len(packed) * 8, len(ordered))))
+                results[i] = (ordered[hits[:limit]], total)
+        return results
@@ -0,0 +1,374 @@
+import math
+
+import numpy as np
+
+# Fleet sizing on top of the instance type x region price matrix in EC2Index. A workload is either
+# totals (vCPU and GiB the fleet has to add up to) or pods, groups of identical requests that each
+# have to fit on one instance. optimize_fleet() returns the cheapest mix it finds in the allowed
+# regions (a fleet lives in one region) with at most max_instances instances:
+#   1. Candidates: every offered (type, region) cell at its cheapest price, narrowed to the allowed
+#      regions and families by slicing the matrix, then pruned to the Pareto frontier per region. A
+#      type is dropped when another one in the region costs no more and has at least its vCPU and
+#      memory, as swapping that one in can never make a fleet worse; a few dozen per region remain.
+#   2. Totals: branch and bound per region. The LP relaxation is solved on the convex hull of each
+#      type's vCPU and GiB per dollar; its optimum uses the one or two types of one hull edge, and
+#      the edge's dual prices bound every partial fleet from below. max_instances adds a Lagrangian
+#      bound that charges every instance extra. The search fixes the count of each other type in
+#      turn, skips types whose reduced cost alone exceeds the gap to the best fleet so far, and
+#      covers what is left with the edge types exactly. Regions go in lower bound order against the
+#      best fleet of any region, first each with an equal share of NODE_BUDGET and then the
+#      unfinished ones with the rest. 'optimal' tells whether every region that could hold a
+#      cheaper fleet was searched to the end; lower_bound bounds the optimum either way.
+#   3. Pods: first-fit decreasing into bins of every distinct frontier shape that holds the largest
+#      pod (identical pods are placed a whole group at a time), then each bin is right-sized to the
+#      cheapest frontier type, per region, that still holds its pods.
+
+NODE_BUDGET = 10000 # branch-and-bound nodes per request before the best plan so far is returned unproven
+_EPS = 1e-9
+
+
+def _frontier(index, regions, families):
+    """Pareto-optimal candidate cells as {name: array} (region, type, price, vcpu, memory), sorted by region then price."""
+    matrix = index.arrays['price_matrix']
+    region_codes = np.arange(matrix.shape[1])
+    if regions:
+        unknown = [region for region in regions if index.region_code(region) is None]
+        if unknown:
+            raise ValueError(f"Unknown region(s): {', '.join(unknown)}.")
+        region_codes = np.unique([index.region_code(region) for region in regions])
+    type_codes = np.arange(matrix.shape[0])
+    if families:
+        families = {family.lower() for family in families}
+        unknown = families - set(index.type_families)
+        if unknown:
+            raise ValueError(f"Unknown instance family(s): {', '.join(sorted(unknown))}.")
+        type_codes = np.flatnonzero(np.isin(index.type_families, list(families)))
+
+    prices = matrix[np.ix_(type_codes, region_codes)]
+    t, r = np.nonzero(~np.isnan(prices))
+    rows = index.arrays['price_matrix_rows'][type_codes[t], region_codes[r]]
+    cells = {'region': region_codes[r], 'type': type_codes[t], 'price': prices[t, r],
+             'vcpu': index.df['vCPU'].to_numpy()[rows].astype(np.float64),
+             'memory': index.df['MemoryGiB'].to_numpy()[rows].astype(np.float64)}
+    usable = (cells['vcpu'] > 0) & (cells['memory'] > 0) & np.isfinite(cells['memory'])
+    order = np.flatnonzero(usable)[np.lexsort((-cells['memory'][usable], -cells['vcpu'][usable], cells['price'][usable], cells['region'][usable]))]
+    cells = {name: values[order] for name, values in cells.items()}
+
+    # Sorted by price (bigger first on ties), a cell is dominated when an earlier one in its region covers it:
+    # with the few distinct vCPU sizes as columns, a running max per region gives the most memory
+    # seen so far on a cell with at least each size.
+    sizes, size_rank = np.unique(cells['vcpu'], return_inverse=True)
+    memory_at_size = np.where(size_rank[:, None] >= np.arange(len(sizes)), cells['memory'][:, None], -np.inf)
+    keep = np.zeros(len(order), dtype=bool)
+    for lo, hi in _region_slices(cells['region']):
+        seen = np.maximum.accumulate(memory_at_size[lo:hi], axis=0)
+        keep[lo] = True
+        keep[lo + 1:hi] = seen[np.arange(hi - lo - 1), size_rank[lo + 1:hi]] < cells['memory'][lo + 1:hi]
+    return {name: values[keep] for name, values in cells.items()}
+
+
+def _region_slices(region):
+    """(start, stop) of every run of equal region codes."""
+    starts = np.flatnonzero(np.r_[True, region[1:] != region[:-1]]) if len(region) else np.zeros(0, dtype=np.int64)
+    return list(zip(starts.tolist(), np.r_[starts[1:], len(region)].tolist()))
+
+
+def _lp_relaxation(price, vcpu, memory, need_vcpu, need_memory):
+    """The covering LP without integrality: (lower bound, dual prices (per vCPU, per GiB), cells of the optimal edge, instances).
+
+    A dollar spent on a cell buys the point (vcpu, memory) / price. Spend can be mixed, so the LP
+    optimum lies on the upper-right hull of those points; each hull edge gives dual prices y with
+    y . (vcpu, memory) <= price for every cell, and the edge the need points at maximises y . need.
+    """
+    per_dollar = np.column_stack([vcpu / price, memory / price])
+    points = [(0.0, per_dollar[:, 1].max(), -1)] + [(x, y, i) for i, (x, y) in enumerate(per_dollar.tolist())]
+    points.sort()
+    hull = []
+    for point in reversed(points): # Andrew's monotone chain, upper half, right to left
+        while len(hull) >= 2 and ((hull[-1][0] - hull[-2][0]) * (point[1] - hull[-2][1])
+                                  - (hull[-1][1] - hull[-2][1]) * (point[0] - hull[-2][0])) <= 0:
+            hull.pop()
+        hull.append(point)
+    # Edges from right to left, starting with the drop from the rightmost point to the vCPU axis.
+    edges = [((1.0 / hull[0][0], 0.0), (hull[0][2],))]
+    for (x1, y1, i), (x2, y2, j) in zip(hull, hull[1:]):
+        det = x1 * y2 - x2 * y1
+        edges.append((((y2 - y1) / det, (x1 - x2) / det), tuple(k for k in (i, j) if k >= 0)))
+    bound, dual, tail = max(((y[0] * need_vcpu + y[1] * need_memory, y, tail) for y, tail in edges), key=lambda edge: edge[0])
+
+    if len(tail) == 1:
+        instances = max(need_vcpu / vcpu[tail[0]], need_memory / memory[tail[0]])
+    else: # the need split between the two edge cells
+        i, j = tail
+        det = vcpu[i] * memory[j] - vcpu[j] * memory[i]
+        instances = (max(need_vcpu * memory[j] - need_memory * vcpu[j], 0) + max(vcpu[i] * need_memory - memory[i] * need_vcpu, 0)) / det
+    return bound, dual, tail, float(instances)
+
+
+def _capped_relaxation(price, vcpu, memory, need_vcpu, need_memory, max_instances):
+    """The LP with at most max_instances instances: (lower bound, dual prices, cells of the optimal edge, price per instance).
+
+    Lagrangian relaxation of the instance count: with every instance charged an extra lam, the
+    plain LP bound minus lam * max_instances still bounds the capped problem. The best lam is
+    where the LP's instance count comes down to the cap, found by bisection.
+    """
+    def relax(lam):
+        bound, dual, tail, instances = _lp_relaxation(price + lam, vcpu, memory, need_vcpu, need_memory)
+        return bound - lam * max_instances, dual, tail, lam, instances
+
+    best = low = relax(0.0)
+    if low[4] <= max_instances:
+        return best[:4]
+    high = relax(float(price.max()))
+    for _ in range(20):
+        if high[4] <= max_instances:
+            break
+        high = relax(2 * high[3])
+    for _ in range(16):
+        best = max(best, low, high, key=lambda relaxation: relaxation[0])
+        middle = relax((low[3] + high[3]) / 2)
+        if middle[4] > max_instances:
+            low = middle
+        else:
+            high = middle
+    return max(best, low, high, key=lambda relaxation: relaxation[0])[:4]
+
+
+def _cover_with(price, vcpu, memory, tail, need_vcpu, need_memory, limit):
+    """Cheapest counts of the one or two tail cells covering the need: (cost, {cell: count}); cost is inf past limit."""
+    if need_vcpu <= 0 and need_memory <= 0:
+        return 0.0, {}
+    counts = {cell: math.ceil(max(need_vcpu / vcpu[cell], need_memory / memory[cell]) - _EPS) for cell in tail}
+    p = min(tail, key=counts.get) # count the cell that needs fewer instances, the other one fills up
+    if len(tail) == 1:
+        return (price[p] * counts[p], {p: counts[p]}) if counts[p] <= limit else (math.inf, {})
+    q = tail[0] if tail[1] == p else tail[1]
+    top = min(counts[p], limit)
+
+    def filler(x): # instances of q, fractional, needed next to x of p
+        return max(0.0, (need_vcpu - vcpu[p] * x) / vcpu[q], (need_memory - memory[p] * x) / memory[q])
+
+    # A fleet with x of p costs at least price[p] * x + price[q] * filler(x), which is convex in x,
+    # so the scan starts at its minimum (a kink or an end) and stops on each side once it passes the best.
+    kinks = [need_vcpu / vcpu[p], need_memory / memory[p]]
+    if vcpu[p] * memory[q] != memory[p] * vcpu[q]:
+        kinks.append((need_vcpu * memory[q] - need_memory * vcpu[q]) / (vcpu[p] * memory[q] - memory[p] * vcpu[q]))
+    start = int(min([0, top] + [x for x in kinks if 0 < x < top], key=lambda x: price[p] * x + price[q] * filler(x)))
+    best = (math.inf, 0, 0)
+    for x, step in ((start, -1), (start + 1, 1)):
+        while 0 <= x <= top and price[p] * x + price[q] * filler(x) < best[0]:
+            y = math.ceil(filler(x) - _EPS)
+            if x + y <= limit and price[p] * x + price[q] * y < best[0]:
+                best = (price[p] * x + price[q] * y, x, y)
+            x += step
+    return best[0], {cell: n for cell, n in ((p, best[1]), (q, best[2])) if n}
+
+
+def _cover_totals(price, vcpu, memory, need_vcpu, need_memory, max_instances, relaxation, cutoff, node_budget):
+    """Cheapest integer counts of these cells covering the totals: (cost, {cell: count}, lower bound, nodes searched).
+
+    Branch and bound from the region's LP relaxation. Its dual prices y bound any partial plan
+    from below (cost so far plus y . remaining need), and a plan costs that bound plus each cell's
+    reduced cost price - y . capacity per instance, so a cell with reduced cost r can appear at
+    most (incumbent - lower bound) / r times and cells with r past the gap not at all. When
+    max_instances binds the LP, the capped relaxation adds a second such bound. The cells of the
+    optimal edge have no reduced cost and are solved exactly at every leaf. Plans costing cutoff or
+    more are not looked for; the search is complete unless it used more than node_budget nodes.
+    """
+    limit = max_instances or math.inf
+    lower_bound, (dual_vcpu, dual_memory), tail, _ = relaxation
+    capped_bound, (capped_vcpu, capped_memory), lam = lower_bound, (dual_vcpu, dual_memory), 0.0
+    if max_instances and lower_bound < cutoff:
+        capped_bound, (capped_vcpu, capped_memory), tail, lam = _capped_relaxation(price, vcpu, memory, need_vcpu, need_memory, max_instances)
+    reduced = np.maximum(price - vcpu * dual_vcpu - memory * dual_memory, 0)
+    capped_reduced = np.maximum(price + lam - vcpu * capped_vcpu - memory * capped_memory, 0)
+    floats = price.tolist(), vcpu.tolist(), memory.tolist() # plain floats for the scalar code below
+
+    # Incumbent: the best single-cell fleet or the exact mix of the optimal edge's cells.
+    alone = np.ceil(np.maximum(need_vcpu / vcpu, need_memory / memory) - _EPS)
+    single = np.where(alone <= limit, price * alone, np.inf)
+    best_cell = int(np.argmin(single))
+    best = [float(single[best_cell]), {best_cell: int(alone[best_cell])}]
+    cost, counts = _cover_with(*floats, tail, need_vcpu, need_memory, limit)
+    if cost < best[0]:
+        best = [cost, counts]
+    bar = min(best[0], cutoff) * (1 - _EPS)
+
+    # Free cells, largest reduced cost first so that the deepest (most revisited) levels vary the
+    # cells closest to the LP optimum.
+    free = [i for i in np.argsort(-capped_reduced, kind='stable').tolist()
+            if i not in tail and price[i] < bar and reduced[i] < bar - lower_bound and capped_reduced[i] < bar - capped_bound]
+    price, vcpu, memory = floats
+    chosen = {}
+    nodes = 0
+
+    def search(k, cost, need_v, need_m, used):
+        nonlocal nodes, bar
+        nodes += 1
+        if nodes > node_budget:
+            return
+        if k == len(free):
+            tail_cost, tail_counts = _cover_with(price, vcpu, memory, tail, need_v, need_m, limit - used)
+            if cost + tail_cost < bar:
+                best[:] = [cost + tail_cost, {**{i: n for i, n in chosen.items() if n}, **tail_counts}]
+                bar = best[0] * (1 - _EPS)
+            return
+        i = free[k]
+        n = 0
+        while used + n <= limit:
+            left_v, left_m = max(need_v - n * vcpu[i], 0), max(need_m - n * memory[i], 0)
+            bound = dual_vcpu * left_v + dual_memory * left_m
+            if lam:
+                bound = max(bound, capped_vcpu * left_v + capped_memory * left_m - lam * (limit - used - n))
+            if cost + n * price[i] + bound >= bar:
+                break
+            chosen[i] = n
+            if not left_v and not left_m:
+                best[:] = [cost + n * price[i], {j: c for j, c in chosen.items() if c}]
+                bar = best[0] * (1 - _EPS)
+                break
+            search(k + 1, cost + n * price[i], left_v, left_m, used + n)
+            n += 1
+        chosen[i] = 0
+
+    search(0, 0.0, need_vcpu, need_memory, 0)
+    return best[0], best[1], max(lower_bound, capped_bound), nodes
+
+
+def _how_many(free_vcpu, free_memory, vcpu, memory):
+    """How many (vcpu, memory) pods fit in the given free capacity."""
+    by_vcpu = np.floor(free_vcpu / vcpu + _EPS) if vcpu > 0 else np.inf
+    by_memory = np.floor(free_memory / memory + _EPS) if memory > 0 else np.inf
+    return np.minimum(by_vcpu, by_memory)
+
+
+def _first_fit_decreasing(pod_vcpu, pod_memory, pod_count, bin_vcpu, bin_memory, max_bins):
+    """Packs the pod groups into bins of one shape: (used vCPU, used memory, pods per bin and group), or None past max_bins."""
+    free_vcpu, free_memory = np.zeros(0), np.zeros(0)
+    placed = np.zeros((0, len(pod_count)), dtype=np.int64)
+    for g in np.argsort(-np.maximum(pod_vcpu / bin_vcpu, pod_memory / bin_memory), kind='stable'):
+        vcpu, memory, count = pod_vcpu[g], pod_memory[g], int(pod_count[g])
+        # First fit for identical pods: fill the open bins in order, each with as many as it holds.
+        fit = _how_many(free_vcpu, free_memory, vcpu, memory)
+        take = np.clip(count - (np.cumsum(fit) - fit), 0, fit).astype(np.int64)
+        free_vcpu = free_vcpu - take * vcpu
+        free_memory = free_memory - take * memory
+        placed[:, g] += take
+        left = count - int(take.sum())
+        if not left:
+            continue
+        per_bin = int(_how_many(bin_vcpu, bin_memory, vcpu, memory))
+        new = -(-left // per_bin)
+        if max_bins and len(free_vcpu) + new > max_bins:
+            return None
+        fill = np.full(new, per_bin, dtype=np.int64)
+        fill[-1] = left - per_bin * (new - 1)
+        free_vcpu = np.r_[free_vcpu, bin_vcpu - fill * vcpu]
+        free_memory = np.r_[free_memory, bin_memory - fill * memory]
+        rows = np.zeros((new, len(pod_count)), dtype=np.int64)
+        rows[:, g] = fill
+        placed = np.vstack([placed, rows])
+    return bin_vcpu - free_vcpu, bin_memory - free_memory, placed
+
+
+def _pack_pods(cells, pods, max_instances):
+    """Cheapest pod packing: (cost per region, {cell: count} and bins [(cell, pods per group)] in the best region), or None."""
+    pod_vcpu, pod_memory, pod_count = (np.array([pod[k] for pod in pods], dtype=np.float64) for k in range(3))
+    slices = _region_slices(cells['region'])
+    starts = np.array([lo for lo, _ in slices])
+    fits_largest = (cells['vcpu'] >= pod_vcpu.max()) & (cells['memory'] >= pod_memory.max())
+    shapes = np.unique(np.column_stack([cells['vcpu'][fits_largest], cells['memory'][fits_largest]]), axis=0)
+
+    region_costs = np.full(len(slices), np.inf)
+    best = None
+    for bin_vcpu, bin_memory in shapes:
+        packed = _first_fit_decreasing(pod_vcpu, pod_memory, pod_count, bin_vcpu, bin_memory, max_instances)
+        if packed is None:
+            continue
+        used_vcpu, used_memory, placed = packed
+        usage, inverse, counts = np.unique(np.column_stack([used_vcpu, used_memory]), axis=0, return_inverse=True, return_counts=True)
+        fits = (cells['vcpu'] >= usage[:, :1] - _EPS) & (cells['memory'] >= usage[:, 1:] - _EPS)
+        bin_cost = np.where(fits, cells['price'], np.inf) # (distinct bins, cells)
+        costs = counts @ np.minimum.reduceat(bin_cost, starts, axis=1)
+        region_costs = np.minimum(region_costs, costs)
+        r = int(np.argmin(costs))
+        if np.isfinite(costs[r]) and (best is None or costs[r] < best[0]):
+            lo, hi = slices[r]
+            choice = lo + np.argmin(bin_cost[:, lo:hi], axis=1)
+            best = (float(costs[r]), choice[inverse.ravel()], placed)
+    if best is None:
+        return None
+    _, bin_cells, placed = best
+    counts = dict(zip(*(a.tolist() for a in np.unique(bin_cells, return_counts=True))))
+    return region_costs, counts, list(zip(bin_cells.tolist(), placed.tolist()))
+
+
+def optimize_fleet(index, vcpu=None, memory_gib=None, pods=None, regions=None, families=None, max_instances=None):
+    """Cheapest instance mix for a workload as a JSON-ready dict, or None when nothing satisfies it.
+
+    Give either vcpu / memory_gib totals or pods as (vcpu, memory_gib, count) requests. regions and
+    families (e.g. ["m5", "c6g"]) restrict the catalog, unknown names raise ValueError;
+    max_instances caps the fleet size. For totals the mix is the exact optimum when 'optimal' is
+    true, and 'lower_bound' is the LP bound; pods are packed heuristically.
+    """
+    cells = _frontier(index, regions, families)
+    slices = _region_slices(cells['region'])
+    if not slices:
+        return None
+    plan = {}
+    if pods is None:
+        region_costs = np.full(len(slices), np.inf)
+        counts = None
+        columns = [(cells['price'][lo:hi], cells['vcpu'][lo:hi], cells['memory'][lo:hi]) for lo, hi in slices]
+        relaxations = [_lp_relaxation(*column, vcpu or 0, memory_gib or 0) for column in columns]
+        region_bounds = np.array([relaxation[0] for relaxation in relaxations])
+        proven = np.zeros(len(slices), dtype=bool)
+        budget = NODE_BUDGET
+        # Regions in lower bound order, each searched only for plans beating the best one so far: first
+        # every region with an equal share of half the nodes, then the unfinished ones with the rest.
+        for share in (NODE_BUDGET // 2 // len(slices), None):
+            for r in np.argsort(region_bounds, kind='stable').tolist():
+                if proven[r]:
+                    continue
+                cost, region_counts, bound, nodes = _cover_totals(
+                    *columns[r], vcpu or 0, memory_gib or 0, max_instances, relaxations[r], region_costs.min(), share or budget)
+                region_bounds[r] = max(region_bounds[r], bound)
+                proven[r] = nodes <= (share or budget)
+                budget = max(budget - nodes, 0)
+                if cost < region_costs[r]:
+                    region_costs[r] = cost
+                    if cost <= region_costs.min():
+                        counts = {slices[r][0] + cell: count for cell, count in region_counts.items()}
+        if not np.isfinite(region_costs.min()):
+            return None
+        plan['lower_bound'] = float(region_bounds.min())
+        # Optimal when no region whose search ran out of nodes could still hold something cheaper.
+        plan['optimal'] = bool(np.all(proven | (region_bounds >= region_costs.min() * (1 - _EPS))))
+    else:
+        packed = _pack_pods(cells, pods, max_instances)
+        if packed is None:
+            return None
+        region_costs, counts, bins = packed
+        grouped = {}
+        for cell, placement in bins:
+            key = (cell, tuple(placement))
+            grouped[key] = grouped.get(key, 0) + 1
+        plan['bins'] = [{'instance_type': index.instance_types[cells['type'][cell]], 'count': count, 'pods': list(placement)}
+                        for (cell, placement), count in sorted(grouped.items(), key=lambda item: -item[1])]
+
+    instances = [{'instance_type': index.instance_types[cells['type'][cell]], 'count': count,
+                  'vcpu': float(cells['vcpu'][cell]), 'memory_gib': float(cells['memory'][cell]),
+                  'price_per_hour': float(cells['price'][cell]), 'hourly_cost': float(cells['price'][cell]) * count}
+                 for cell, count in sorted(counts.items(), key=lambda item: -cells['price'][item[0]] * item[1])]
+    region_order = [r for r in np.argsort(region_costs, kind='stable') if np.isfinite(region_costs[r])]
+    return {
+        'region': index.regions[cells['region'][next(iter(counts))]],
+        'hourly_cost': sum(item['hourly_cost'] for item in instances),
+        'instance_count': sum(item['count'] for item in instances),
+        'vcpu': sum(item['vcpu'] * item['count'] for item in instances),
+        'memory_gib': sum(item['memory_gib'] * item['count'] for item in instances),
+        'instances': instances,
+        **plan,
+        'candidates': len(cells['price']),
+        'regions': [{'region': index.regions[cells['region'][slices[r][0]]], 'hourly_cost': float(region_costs[r])} for r in region_order],
+    }
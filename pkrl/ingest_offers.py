@@ -0,0 +1,254 @@
+"""Builds the EC2 pricing dataset straight from AWS bulk pricing offer files.
+
+Usage: python ingest_offers.py OFFER [OFFER ...] [--cache-dir ./ec2_cache] [--workers N]
+                               [--operating-system Linux] [--tenancy Shared]
+
+Each OFFER is a regional EC2 offer file (index.json from
+https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonEC2/current/<region>/index.json,
+optionally gzipped) or a directory searched recursively for such files. Files are stream-parsed,
+so memory stays flat however large they are, and one worker process handles one file at a time.
+The On-Demand hourly price of every matching instance type is written into the columnar cache
+that server.py loads (see ec2_cache.py); a running server picks it up within EC2_RELOAD_INTERVAL.
+
+Any small hand-written file in the same layout ({"products": {...}, "terms": {"OnDemand": {...}}})
+works as a fixture; tests/fixtures/us-east-1.json is one, checked by
+python -m unittest discover -s tests (run from this directory).
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from ec2_cache import write_ec2_frame
+from ec2_index import build_index_arrays
+
+COLUMNS = ('Region', 'InstanceType', 'vCPU', 'Memory', 'PricePerHourUSD')
+INSTANCE_FAMILIES = ('Compute Instance', 'Compute Instance (bare metal)')
+CHUNK_SIZE = 1 << 20
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*\Z')
+
+
+class JSONStream:
+    """Pull parser over one large JSON document.
+
+    Objects are walked key by key with items(); only the values asked for with value() are decoded
+    (with json's C decoder), so memory is bounded by the largest single value read, not the file.
+    """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """The next non-whitespace character, or None at the end of the input."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return None
+
+    def _expect(self, char):
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"Malformed offer file: expected {char!r}, found {found!r}")
+        self.pos += 1
+
+    def value(self):
+        """Decodes the next complete value."""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number cut at the chunk edge ("12345." or "1.5e") decodes "successfully" as a shorter
+            # number; if only number characters follow it to the end of the buffer, read on and retry.
+            if isinstance(value, (int, float)) and _NUMBER_TAIL.match(self.buf, end) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def items(self):
+        """Yields the keys of the object at the current position; the caller consumes each value before the next key."""
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            separator = self._peek()
+            self.pos += 1
+            if separator == '}':
+                return
+            if separator != ',':
+                raise ValueError(f"Malformed offer file: expected ',' or '}}' after {key!r}, found {separator!r}")
+
+    def skip(self):
+        """Skips the next value, one member at a time when it is an object."""
+        if self._peek() == '{':
+            for _ in self.items():
+                self.value()
+        else:
+            self.value()
+
+
+def _open_offer(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def _region_from_path(path):
+    """us-east-1 for .../us-east-1/index.json or .../us-east-1.json(.gz)."""
+    name = os.path.basename(path)
+    for suffix in ('.gz', '.json'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return os.path.basename(os.path.dirname(path)) if name == 'index' else name
+
+
+def _instance_spec(product, operating_system, tenancy, default_region):
+    """(region, instance type, vCPU, memory) for an On-Demand compute product matching the filters, else None."""
+    if product.get('productFamily') not in INSTANCE_FAMILIES:
+        return None
+    attrs = product.get('attributes', {})
+    if (attrs.get('operatingSystem') != operating_system or attrs.get('tenancy') != tenancy
+            or attrs.get('preInstalledSw', 'NA') != 'NA' or attrs.get('capacitystatus', 'Used') != 'Used'
+            or attrs.get('licenseModel', 'No License required') != 'No License required'):
+        return None
+    vcpu = attrs.get('vcpu', '')
+    if not vcpu.isdigit() or 'instanceType' not in attrs:
+        return None
+    return (attrs.get('regionCode') or default_region, attrs['instanceType'], int(vcpu), attrs.get('memory', ''))
+
+
+def _hourly_usd(offers):
+    """The USD per-hour price from a SKU's On-Demand offers, or None."""
+    for offer in offers.values():
+        for dimension in offer.get('priceDimensions', {}).values():
+            if dimension.get('unit') in ('Hrs', 'Hours') and 'USD' in dimension.get('pricePerUnit', {}):
+                return float(dimension['pricePerUnit']['USD'])
+    return None
+
+
+def parse_offer_file(path, operating_system='Linux', tenancy='Shared', chunk_size=CHUNK_SIZE):
+    """Returns ({column: list}, products seen) for one offer file.
+
+    Offer files list "products" before "terms"; only the matching products are kept while the file
+    is read, and each is emitted once its On-Demand terms come by. Reserved terms are skipped.
+    """
+    default_region = _region_from_path(path)
+    specs = {}
+    columns = {name: [] for name in COLUMNS}
+    products_seen = 0
+    with _open_offer(path) as f:
+        stream = JSONStream(f, chunk_size)
+        for key in stream.items():
+            if key == 'products':
+                for sku in stream.items():
+                    products_seen += 1
+                    spec = _instance_spec(stream.value(), operating_system, tenancy, default_region)
+                    if spec:
+                        specs[sku] = spec
+            elif key == 'terms':
+                for term_type in stream.items():
+                    if term_type != 'OnDemand':
+                        stream.skip()
+                        continue
+                    for sku in stream.items():
+                        offers = stream.value()
+                        spec = specs.get(sku)
+                        price = _hourly_usd(offers) if spec else None
+                        if price is None:
+                            continue
+                        for name, value in zip(COLUMNS, spec + (price,)):
+                            columns[name].append(value)
+            else:
+                stream.skip()
+    return columns, products_seen
+
+
+def _parse_task(args):
+    path, operating_system, tenancy = args
+    started = time.perf_counter()
+    columns, products_seen = parse_offer_file(path, operating_system, tenancy)
+    return path, columns, products_seen, time.perf_counter() - started
+
+
+def find_offer_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(('.json', '.json.gz')))
+        else:
+            files.append(path)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert AWS EC2 offer files into the pkrl pricing dataset.")
+    parser.add_argument('offers', nargs='+', help="Offer files or directories containing them.")
+    parser.add_argument('--cache-dir', default=os.getenv('EC2_CACHE_DIR', './ec2_cache'), help="Columnar cache to write (default EC2_CACHE_DIR or ./ec2_cache).")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Parallel parser processes (default: CPU count).")
+    parser.add_argument('--operating-system', default='Linux', help="operatingSystem attribute to keep (default Linux).")
+    parser.add_argument('--tenancy', default='Shared', help="tenancy attribute to keep (default Shared).")
+    args = parser.parse_args()
+
+    files = find_offer_files(args.offers)
+    if not files:
+        sys.exit("No offer files found.")
+    started = time.perf_counter()
+    parts = []
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(files)))) as pool:
+        tasks = [(path, args.operating_system, args.tenancy) for path in files]
+        for path, columns, products_seen, seconds in pool.map(_parse_task, tasks):
+            print(f"{path}: {len(columns['Region'])} instance prices from {products_seen} products in {seconds:.1f}s")
+            parts.append(pd.DataFrame(columns, columns=list(COLUMNS)))
+
+    df = pd.concat(parts, ignore_index=True)
+    # Several SKUs can describe the same instance type (e.g. different usage types); keep the cheapest.
+    df = df.sort_values('PricePerHourUSD', kind='stable').drop_duplicates(['Region', 'InstanceType']).sort_values(['Region', 'InstanceType']).reset_index(drop=True)
+
+    signatures = []
+    for path in files:
+        stat = os.stat(path)
+        signatures.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    source = {'kind': 'offers', 'files': signatures, 'ingested_at_ns': time.time_ns(),
+              'sha256': hashlib.sha256(json.dumps(signatures).encode()).hexdigest(),
+              'operating_system': args.operating_system, 'tenancy': args.tenancy}
+    rows = write_ec2_frame(df, args.cache_dir, source, derive=build_index_arrays)
+    print(f"Wrote {rows} rows ({len(df) - rows} zero-priced dropped) from {len(files)} offer file(s) "
+          f"to {args.cache_dir} in {time.perf_counter() - started:.1f}s.")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,25 @@ import flask
 from flask import Flask, request, redirect, url_for, render_template, session, jsonify, flash
 from flask_cors import CORS
 import os
+import sys
 import sqlite3
 from functools import wraps
 import random
-import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from dotenv import load_dotenv
 import pandas as pd
 import numpy as np
 import json # <<<< ADD THIS IMPORT
+import threading
+import time
+from collections import OrderedDict
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repo root, for common/
+from common.session_store import create_session_store, ServerSessionInterface
+from common.email_outbox import EmailOutbox
+from ec2_cache import load_ec2_frame, csv_signature, manifest_signature
+from ec2_index import EC2Index, SORT_KEYS, build_index_arrays
+from fleet_optimizer import optimize_fleet
 # ... (rest of the imports)
 
 load_dotenv()
@@ -19,43 +28,100 @@ load_dotenv()
 # --- Global Configuration ---
 DB_PATH = './ec2.db'
 CSV_PATH = './ec2_prices_all_regions.csv' # Path to your CSV
+EC2_CACHE_DIR = os.getenv('EC2_CACHE_DIR', './ec2_cache') # preprocessed columns, rebuilt when the CSV changes (see ec2_cache.py)
 
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'a_very_secure_default_secret_key_123!PleaseChange')
 CORS(app, supports_credentials=True)
 
+# Server-side sessions (see common/session_store.py): 'memory' for one process, sqlite:///./sessions.db for several.
+SESSION_STORE = os.getenv('SESSION_STORE', 'memory')
+SESSION_TTL = float(os.getenv('SESSION_TTL', str(7 * 24 * 3600)))
+session_store = create_session_store(SESSION_STORE, SESSION_TTL)
+app.session_interface = ServerSessionInterface(session_store)
+
 APP_EMAIL_SENDER = os.getenv('EMAIL_USER')
 APP_EMAIL_PASSWORD = os.getenv('PASSWORD')
-
-# Global DataFrame for EC2 data
-ec2_df = None
-unique_regions = []
+# OTP mail is queued in the email_outbox table of ec2.db and sent in the background (see common/email_outbox.py).
+# Local testing: `python -m aiosmtpd -n -l localhost:1025` plus SMTP_HOST=localhost SMTP_PORT=1025
+# SMTP_STARTTLS=0; login is skipped when PASSWORD is unset.
+SMTP_HOST = os.getenv('SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', '1') == '1'
+email_outbox = EmailOutbox(DB_PATH, SMTP_HOST, SMTP_PORT, username=APP_EMAIL_SENDER, password=APP_EMAIL_PASSWORD,
+                           starttls=SMTP_STARTTLS, batch_size=int(os.getenv('EMAIL_BATCH_SIZE', '20')),
+                           max_attempts=int(os.getenv('EMAIL_MAX_ATTEMPTS', '6')),
+                           retention=float(os.getenv('EMAIL_RETENTION_DAYS', '7')) * 24 * 3600)
+
+# --- EC2 pricing data ---
+# The loaded data lives in one immutable EC2Snapshot (frame, row indexes, version). A request reads
+# the global ec2_data once and works on that object, so a reload is just a reference swap: requests
+# already running finish on the old snapshot, new ones see the new one, and there is no window where
+# the data is missing. A background thread polls the CSV and the cache manifest (which changes when
+# ingest_offers.py writes a dataset or another worker rebuilds) and reloads off the request path.
+EC2_RELOAD_INTERVAL = float(os.getenv('EC2_RELOAD_INTERVAL', '5')) # seconds between CSV checks; 0 disables hot reload
+SCATTER_MAX_POINTS = 200
+
+class EC2Snapshot:
+    def __init__(self, df, index, version, source):
+        self.df = df
+        self.index = index
+        self.version = version
+        self.source = source # (CSV, cache manifest) signatures it was loaded from
+        self.regions = sorted(df['Region'].cat.categories.tolist())
+        self.instance_types = sorted(index.instance_types)
+        self.loaded_at = time.time()
+
+ec2_data = None # current EC2Snapshot, None until the first successful load
+_ec2_failed_source = None # source signature that last failed to load; not retried until something changes again
+_ec2_reload_lock = threading.Lock()
+_ec2_watcher_started = False
 
 def load_and_preprocess_ec2_data():
-    global ec2_df, unique_regions
-    try:
-        df = pd.read_csv(CSV_PATH)
-        
-        # Preprocess Memory: Extract numeric value
-        df['MemoryGiB'] = df['Memory'].str.extract(r'(\d+\.?\d*)').astype(float)
-        
-        # Calculate Price per vCPU and Price per GiB Memory
-        # Handle cases where vCPU or MemoryGiB might be 0 to avoid division by zero
-        df['PricePerVCpu'] = df.apply(lambda row: row['PricePerHourUSD'] / row['vCPU'] if row['vCPU'] > 0 else np.inf, axis=1)
-        df['PricePerMemoryGiB'] = df.apply(lambda row: row['PricePerHourUSD'] / row['MemoryGiB'] if row['MemoryGiB'] > 0 else np.inf, axis=1)
-        
-        # Filter out rows where price is 0.0000000000 (likely placeholders or free tiers not relevant for general analysis)
-        df = df[df['PricePerHourUSD'] > 0.00000001]
-
-        ec2_df = df
-        unique_regions = sorted(df['Region'].unique().tolist())
-        print(f"EC2 data loaded and preprocessed successfully. {len(ec2_df)} records.")
-    except FileNotFoundError:
-        print(f"ERROR: CSV file not found at {CSV_PATH}")
-        ec2_df = pd.DataFrame() # Empty DataFrame
-    except Exception as e:
-        print(f"ERROR: Failed to load or preprocess EC2 data: {e}")
-        ec2_df = pd.DataFrame() # Empty DataFrame
+    """Loads the CSV or ingested dataset (through the columnar cache) into a new snapshot and swaps it in. Returns True on success."""
+    global ec2_data, _ec2_failed_source
+    with _ec2_reload_lock:
+        csv_source = csv_signature(CSV_PATH)
+        try:
+            started = time.perf_counter()
+            df, index_arrays, cache_version = load_ec2_frame(CSV_PATH, EC2_CACHE_DIR, derive=build_index_arrays)
+            # The manifest is read after loading since a CSV rebuild rewrites it.
+            snapshot = EC2Snapshot(df, EC2Index(df, index_arrays), cache_version, (csv_source, manifest_signature(EC2_CACHE_DIR)))
+        except FileNotFoundError:
+            print(f"ERROR: CSV file not found at {CSV_PATH} and no ingested offer data in {EC2_CACHE_DIR}")
+            return False
+        except Exception as e:
+            _ec2_failed_source = (csv_source, manifest_signature(EC2_CACHE_DIR))
+            print(f"ERROR: Failed to load or preprocess EC2 data: {e}" + (" (still serving the previous data)" if ec2_data else ""))
+            return False
+        ec2_data = snapshot
+        clear_ec2_result_cache()
+        print(f"EC2 data loaded and preprocessed successfully. {len(df)} records "
+              f"(cache {cache_version}, {(time.perf_counter() - started) * 1000:.1f} ms).")
+        return True
+
+def _watch_ec2_csv():
+    settling = None
+    while True:
+        time.sleep(EC2_RELOAD_INTERVAL)
+        source = (csv_signature(CSV_PATH), manifest_signature(EC2_CACHE_DIR))
+        if source == (None, None) or source == (ec2_data.source if ec2_data else None) or source == _ec2_failed_source:
+            settling = None
+            continue
+        # Only reload once the file has stopped changing for a full interval (it may still be copying).
+        if source != settling:
+            settling = source
+            continue
+        settling = None
+        print(f"EC2 price data ({CSV_PATH} / {EC2_CACHE_DIR}) changed, reloading in the background.")
+        load_and_preprocess_ec2_data()
+
+def start_ec2_data_watcher():
+    global _ec2_watcher_started
+    if EC2_RELOAD_INTERVAL <= 0 or _ec2_watcher_started:
+        return
+    _ec2_watcher_started = True
+    threading.Thread(target=_watch_ec2_csv, name='ec2-data-watcher', daemon=True).start()
 
 # --- Database Initialization ---
 def init_db():
@@ -67,6 +133,7 @@ def init_db():
                             otp TEXT,
                             verified INTEGER DEFAULT 0
                         )''')
+        email_outbox.init_table(conn)
         conn.commit()
     print(f"User database initialized/checked at {DB_PATH}")
         
@@ -74,8 +141,9 @@ def is_valid_email(email):
     return email and email.endswith('@cloudkeeper.com')
 
 def send_otp_email(to_email, otp):
-    if not APP_EMAIL_SENDER or not APP_EMAIL_PASSWORD:
-        print(f"ERROR: Email credentials not configured. Cannot send OTP. SENDER: {APP_EMAIL_SENDER}, PASS_CONFIGURED: {bool(APP_EMAIL_PASSWORD)}")
+    """Queues the OTP email for the background sender. Returns False only if it could not be queued."""
+    if not APP_EMAIL_SENDER:
+        print("ERROR: Email sender (EMAIL_USER) not configured. Cannot send OTP.")
         return False
 
     msg = MIMEMultipart('alternative')
@@ -89,15 +157,23 @@ def send_otp_email(to_email, otp):
     msg.attach(MIMEText(html, 'html'))
 
     try:
-        with smtplib.SMTP('smtp.gmail.com', 587) as server:
-            server.starttls()
-            server.login(APP_EMAIL_SENDER, APP_EMAIL_PASSWORD)
-            server.sendmail(msg['From'], [msg['To']], msg.as_string())
-            print(f"OTP email sent successfully to {to_email}!")
-            return True
-    except Exception as e:
-        print(f"Failed to send OTP email to {to_email}: {e}")
+        outbox_id = email_outbox.enqueue(msg)
+    except sqlite3.Error as e:
+        print(f"Failed to queue OTP email to {to_email}: {e}")
         return False
+    email_outbox.start()
+    print(f"OTP email to {to_email} queued (outbox id {outbox_id}).")
+    return True
+
+def cached_user(username):
+    """The user's {username, verified} record from the session store; the users table is read only on a miss."""
+    record = session_store.get_user(username)
+    if record is None:
+        with sqlite3.connect(DB_PATH) as conn:
+            row = conn.execute("SELECT verified FROM users WHERE username = ?", (username,)).fetchone()
+        record = {"username": username, "verified": bool(row and row[0])}
+        session_store.put_user(username, record)
+    return record
 
 def login_required(f):
     @wraps(f)
@@ -105,16 +181,11 @@ def login_required(f):
         if 'username' not in session:
             flash("You need to be logged in to access this page.", "warning")
             return redirect(url_for('login', next=request.url))
-        # Check if user is verified (if not already handled at login)
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute("SELECT verified FROM users WHERE username = ?", (session['username'],))
-            user = cur.fetchone()
-            if not user or not user['verified']:
-                session.pop('username', None) # Log them out
-                flash("Your account is not verified. Please verify or log in again.", "danger")
-                return redirect(url_for('login'))
+        # Check if user is verified (if not already handled at login); cached, so normally no DB hit
+        if not cached_user(session['username'])['verified']:
+            session.pop('username', None) # Log them out
+            flash("Your account is not verified. Please verify or log in again.", "danger")
+            return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
@@ -146,7 +217,9 @@ def login():
             user = cur.fetchone()
             if user:
                 if user['verified']:
+                    session.regenerate()
                     session['username'] = user['username']
+                    session_store.put_user(user['username'], {"username": user['username'], "verified": True})
                     next_url = request.args.get('next')
                     print(f"User '{username}' logged in successfully.")
                     flash(f"Welcome back, {username}!", "success")
@@ -188,6 +261,7 @@ def signup():
                  else:
                     cur.execute("UPDATE users SET password = ?, otp = ? WHERE id = ?", (password, otp, existing_user['id'])) # INSECURE: Plain text password
                     conn.commit()
+                    session_store.invalidate_user(username)
                     print(f"OTP updated for existing unverified user: {username}")
                     if send_otp_email(username, otp):
                         session['pending_user'] = username
@@ -197,6 +271,7 @@ def signup():
             else:
                 cur.execute("INSERT INTO users (username, password, otp, verified) VALUES (?, ?, ?, 0)", (username, password, otp)) # INSECURE: Plain text password
                 conn.commit()
+                session_store.invalidate_user(username)
                 print(f"New user created: {username}")
                 if send_otp_email(username, otp):
                     session['pending_user'] = username
@@ -233,6 +308,7 @@ def verify_otp():
             if user_record and not user_record['verified'] and user_record['otp'] == otp_input:
                 cur.execute("UPDATE users SET verified = 1, otp = NULL WHERE username = ?", (email_to_verify,))
                 conn.commit()
+                session_store.invalidate_user(email_to_verify)
                 session.pop('pending_user', None)
                 print(f"User {email_to_verify} verified successfully.")
                 flash("Your email has been verified! Please log in.", "success")
@@ -258,6 +334,11 @@ def logout():
     flash("You have been logged out.", "info")
     return redirect(url_for('login'))
 
+@app.route('/api/email_metrics')
+@login_required
+def email_metrics():
+    return jsonify(email_outbox.metrics())
+
 @app.route('/home_or_main_placeholder_route_for_logo') 
 def home_or_main():
     return redirect(url_for('index_route'))
@@ -265,85 +346,69 @@ def home_or_main():
 # --- EC2 Analysis Routes ---
 # ... (inside server.py)
 
-@app.route('/ec2-analysis')
-@login_required
-def ec2_analysis_tool():
-    if ec2_df is None or ec2_df.empty:
-        flash("EC2 pricing data is not available. Please check server logs.", "danger")
-        return render_template('ec2_analysis.html', instances=[], regions=[], total_matched_instances=0, infinity=float('inf'))
-
-    # Make a working copy of the full dataframe for this request
-    current_view_df = ec2_df.copy()
-
-    # Get filter parameters
-    region_filter = request.args.get('region')
-    instance_type_prefix = request.args.get('instance_type_prefix', '').strip().lower()
-    min_vcpu = request.args.get('min_vcpu', type=int)
-    min_memory = request.args.get('min_memory', type=float)
-    max_price = request.args.get('max_price', type=float)
-    sort_by = request.args.get('sort_by', 'PricePerHourUSD')
-    limit_str = request.args.get('limit', '20')
-
+# --- EC2 analysis result cache ---
+# The table rows and the three chart payloads (already serialised to JSON) for a normalised filter
+# tuple. The snapshot version is part of the key and a reload clears the cache, so stale prices are
+# never served. Very large results (limit=all) are rebuilt each time rather than pinned in memory.
+EC2_RESULT_CACHE_MAX_ENTRIES = int(os.getenv('EC2_RESULT_CACHE_MAX_ENTRIES', '256'))
+EC2_RESULT_CACHE_MAX_ROWS = int(os.getenv('EC2_RESULT_CACHE_MAX_ROWS', '5000'))
+_ec2_result_cache = OrderedDict()
+_ec2_result_cache_lock = threading.Lock()
+
+def clear_ec2_result_cache():
+    with _ec2_result_cache_lock:
+        _ec2_result_cache.clear()
+
+def ec2_analysis_filters(args):
+    """Request args -> (region, prefix, min_vcpu, min_memory, max_price, sort_by, limit); limit None means all rows."""
+    sort_by = args.get('sort_by', 'PricePerHourUSD')
+    if sort_by not in SORT_KEYS:
+        sort_by = 'PricePerHourUSD'
+    limit_str = args.get('limit', '20')
+    limit = None
+    if limit_str != 'all':
+        try:
+            limit = max(int(limit_str), 0)
+        except ValueError:
+            limit = None
+    return (args.get('region') or None,
+            args.get('instance_type_prefix', '').strip().lower(),
+            args.get('min_vcpu', type=int),
+            args.get('min_memory', type=float),
+            args.get('max_price', type=float),
+            sort_by,
+            limit)
+
+def build_ec2_analysis_payload(data, region_filter, instance_type_prefix, min_vcpu, min_memory, max_price, sort_by, limit):
     # --- CHART DATA PREPARATION ---
     # Chart 1: Instance Count by Region (based on the full dataset if no region filter, or just the selected region)
     chart_region_counts_data = None
-    if not region_filter and not current_view_df.empty: # Only show if "All Regions" is effectively selected
-        region_counts = current_view_df['Region'].value_counts().sort_index()
+    if not region_filter: # Only show if "All Regions" is effectively selected
+        region_counts = data.index.region_counts()
         chart_region_counts_data = {
-            'labels': region_counts.index.tolist(),
-            'data': region_counts.values.tolist(),
+            'labels': list(region_counts.keys()),
+            'data': list(region_counts.values()),
             'title': 'Instance Types per Region (Overall)'
         }
-    elif region_filter and not current_view_df[current_view_df['Region'] == region_filter].empty:
+    elif len(data.index.region_rows(region_filter)):
         # If a region is filtered, show count for that region (might be less interesting, but consistent)
         # Or, you could choose to hide this chart if a region is selected. For now, let's show it.
-        filtered_for_region_chart = current_view_df[current_view_df['Region'] == region_filter]
-        instance_family_counts = filtered_for_region_chart['InstanceType'].apply(lambda x: x.split('.')[0]).value_counts().nlargest(15) # Top 15 families
+        instance_family_counts = data.index.family_counts(region_filter)[:15] # Top 15 families
         chart_region_counts_data = {
-            'labels': instance_family_counts.index.tolist(),
-            'data': instance_family_counts.values.tolist(),
+            'labels': [family for family, _ in instance_family_counts],
+            'data': [count for _, count in instance_family_counts],
             'title': f'Instance Type Families in {region_filter}'
         }
 
-
-    # Apply filters to get the data for table and other charts
-    filtered_df = current_view_df.copy() # Start fresh for filtering
-    if region_filter:
-        filtered_df = filtered_df[filtered_df['Region'] == region_filter]
-    if instance_type_prefix:
-        filtered_df = filtered_df[filtered_df['InstanceType'].str.lower().str.startswith(instance_type_prefix)]
-    if min_vcpu is not None:
-        filtered_df = filtered_df[filtered_df['vCPU'] >= min_vcpu]
-    if min_memory is not None:
-        filtered_df = filtered_df[filtered_df['MemoryGiB'] >= min_memory]
-    if max_price is not None:
-        filtered_df = filtered_df[filtered_df['PricePerHourUSD'] <= max_price]
-    
-    # Sorting (ensure this happens *after* all filtering)
-    ascending_order = True
-    sort_column_for_df = sort_by # Use this for DataFrame sorting
-    if sort_by in ['vCPU', 'MemoryGiB']: 
-        ascending_order = False
-    
-    if sort_by in ['PricePerVCpu', 'PricePerMemoryGiB']:
-        # For DataFrame sorting, np.inf works.
-        # For display, we'll handle np.inf in the template or when preparing chart data.
-        filtered_df = filtered_df.sort_values(by=sort_column_for_df, ascending=ascending_order, na_position='last')
-    else:
-        filtered_df = filtered_df.sort_values(by=sort_column_for_df, ascending=ascending_order, na_position='last')
-
-    total_matched_instances = len(filtered_df)
+    # Apply filters and sorting through the precomputed indexes (see ec2_index.py); only the rows that
+    # are actually shown get materialised. The scatter chart needs the first SCATTER_MAX_POINTS too.
+    rows, total_matched_instances = data.index.query(region=region_filter, type_prefix=instance_type_prefix, min_vcpu=min_vcpu,
+                                                    min_memory=min_memory, max_price=max_price, sort_by=sort_by,
+                                                    limit=None if limit is None else max(limit, SCATTER_MAX_POINTS))
+    filtered_df = data.df.take(rows)
 
     # Limiting results for table display
-    instances_for_table = []
-    if limit_str != 'all':
-        try:
-            limit = int(limit_str)
-            instances_for_table = filtered_df.head(limit).to_dict('records')
-        except ValueError:
-            instances_for_table = filtered_df.to_dict('records') 
-    else:
-        instances_for_table = filtered_df.to_dict('records')
+    instances_for_table = (filtered_df if limit is None else filtered_df.head(limit)).to_dict('records')
 
     # Chart 2: Top N Instances by Selected Metric (based on filtered and sorted data)
     chart_top_n_data = None
@@ -381,17 +446,16 @@ def ec2_analysis_tool():
     chart_price_vcpu_scatter_data = None
     if not filtered_df.empty:
         # Limit scatter plot points for performance if too many, e.g., max 200 points
-        scatter_df = filtered_df.head(200) if len(filtered_df) > 200 else filtered_df
-        
-        scatter_plot_points = []
-        for _, instance in scatter_df.iterrows():
-            if instance['vCPU'] > 0 and instance['PricePerHourUSD'] != np.inf and not pd.isna(instance['PricePerHourUSD']):
-                 scatter_plot_points.append({
-                    'x': instance['vCPU'],
-                    'y': instance['PricePerHourUSD'],
-                    'label': f"{instance['InstanceType']} ({instance['Region']}) | Mem: {instance['MemoryGiB']:.1f}GiB" # Add more info to tooltip
-                })
-        
+        scatter_df = filtered_df.head(SCATTER_MAX_POINTS)
+        vcpu = scatter_df['vCPU']
+        price = scatter_df['PricePerHourUSD']
+        keep = ((vcpu > 0) & np.isfinite(price.to_numpy(dtype=float))).to_numpy()
+        scatter_df = scatter_df[keep]
+        labels = (scatter_df['InstanceType'].astype(str) + ' (' + scatter_df['Region'].astype(str) + ') | Mem: '
+                  + np.char.mod('%.1f', scatter_df['MemoryGiB'].to_numpy(dtype=float)) + 'GiB') # Add more info to tooltip
+        scatter_plot_points = [{'x': x, 'y': y, 'label': label}
+                               for x, y, label in zip(scatter_df['vCPU'].tolist(), scatter_df['PricePerHourUSD'].tolist(), labels.tolist())]
+
         if scatter_plot_points:
             chart_price_vcpu_scatter_data = {
                 'datasets': [{
@@ -401,32 +465,352 @@ def ec2_analysis_tool():
                 }],
                 'title': 'Price/Hour vs. vCPU (Filtered Results)'
             }
-            if len(filtered_df) > 200:
-                 chart_price_vcpu_scatter_data['title'] += ' (Sampled 200 points)'
+            if total_matched_instances > SCATTER_MAX_POINTS:
+                 chart_price_vcpu_scatter_data['title'] += f' (Sampled {SCATTER_MAX_POINTS} points)'
+
+    return {
+        'instances': instances_for_table,
+        'total_matched_instances': total_matched_instances,
+        # Chart data as JSON strings to be parsed by JavaScript
+        'chart_region_counts_data_json': json.dumps(chart_region_counts_data) if chart_region_counts_data else None,
+        'chart_top_n_data_json': json.dumps(chart_top_n_data) if chart_top_n_data else None,
+        'chart_price_vcpu_scatter_data_json': json.dumps(chart_price_vcpu_scatter_data) if chart_price_vcpu_scatter_data else None,
+    }
 
+@app.route('/ec2-analysis')
+@login_required
+def ec2_analysis_tool():
+    data = ec2_data # one snapshot for the whole request, even if a reload swaps in a new one meanwhile
+    if data is None or data.df.empty:
+        flash("EC2 pricing data is not available. Please check server logs.", "danger")
+        return render_template('ec2_analysis.html', instances=[], regions=[], total_matched_instances=0, infinity=float('inf'))
 
-    return render_template('ec2_analysis.html', 
-                           instances=instances_for_table, 
-                           regions=unique_regions,
-                           total_matched_instances=total_matched_instances,
+    filters = ec2_analysis_filters(request.args)
+    cache_key = (data.version,) + filters
+    with _ec2_result_cache_lock:
+        payload = _ec2_result_cache.get(cache_key)
+        if payload is not None:
+            _ec2_result_cache.move_to_end(cache_key)
+    if payload is None:
+        payload = build_ec2_analysis_payload(data, *filters)
+        if len(payload['instances']) <= EC2_RESULT_CACHE_MAX_ROWS:
+            with _ec2_result_cache_lock:
+                _ec2_result_cache[cache_key] = payload
+                while len(_ec2_result_cache) > EC2_RESULT_CACHE_MAX_ENTRIES:
+                    _ec2_result_cache.popitem(last=False)
+
+    return render_template('ec2_analysis.html',
+                           regions=data.regions,
                            infinity=float('inf'), # Still needed for table display of N/A
-                           # Pass chart data as JSON strings to be parsed by JavaScript
-                           chart_region_counts_data_json=json.dumps(chart_region_counts_data) if chart_region_counts_data else None,
-                           chart_top_n_data_json=json.dumps(chart_top_n_data) if chart_top_n_data else None,
-                           chart_price_vcpu_scatter_data_json=json.dumps(chart_price_vcpu_scatter_data) if chart_price_vcpu_scatter_data else None
-                           )
+                           **payload)
+
+# --- EC2 query API ---
+# POST /api/ec2/query takes one filter spec or a JSON array of them, with the fields of /ec2-analysis:
+#   {"region": "us-east-1", "prefix": "m5", "min_vcpu": 4, "min_memory": 16, "max_price": 1.5,
+#    "sort_by": "PricePerVCpu", "limit": 20}    (limit may be "all"; every field is optional)
+# All specs are answered from one snapshot with a single EC2Index.query_many() call and the matched
+# rows are gathered from the frame in one take per column. The reply is columnar:
+#   {"version": ..., "results": [{"total": n, "rows": {"Region": [...], "InstanceType": [...], ...}}, ...]}
+# with one result per spec, in order; inf/NaN values come back as null.
+EC2_QUERY_MAX_SPECS = int(os.getenv('EC2_QUERY_MAX_SPECS', '1000'))
+EC2_QUERY_COLUMNS = ['Region', 'InstanceType', 'vCPU', 'MemoryGiB', 'PricePerHourUSD', 'PricePerVCpu', 'PricePerMemoryGiB']
+
+def parse_ec2_query_spec(raw):
+    """A JSON filter spec -> EC2Index.query() keyword dict. Raises ValueError with a message for the client."""
+    if not isinstance(raw, dict):
+        raise ValueError("Each filter spec must be a JSON object.")
+    unknown = set(raw) - {'region', 'prefix', 'instance_type_prefix', 'min_vcpu', 'min_memory', 'max_price', 'sort_by', 'limit'}
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(sorted(unknown))}.")
+
+    def number(field):
+        value = raw.get(field)
+        if value is None:
+            return None
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"'{field}' must be a number.")
+        return value
+
+    region = raw.get('region') or None
+    prefix = raw.get('prefix', raw.get('instance_type_prefix')) or ''
+    if (region is not None and not isinstance(region, str)) or not isinstance(prefix, str):
+        raise ValueError("'region' and 'prefix' must be strings.")
+    sort_by = raw.get('sort_by', 'PricePerHourUSD')
+    if sort_by not in SORT_KEYS:
+        raise ValueError(f"'sort_by' must be one of {', '.join(SORT_KEYS)}.")
+    limit = raw.get('limit', 20)
+    if limit == 'all':
+        limit = None
+    elif isinstance(limit, bool) or not isinstance(limit, int) or limit < 0:
+        raise ValueError("'limit' must be a non-negative integer or \"all\".")
+    return {'region': region, 'type_prefix': prefix.strip().lower(), 'min_vcpu': number('min_vcpu'),
+            'min_memory': number('min_memory'), 'max_price': number('max_price'),
+            'sort_by': sort_by, 'limit': limit}
+
+def _json_column(values):
+    """A column of gathered values as a JSON-safe list (inf/NaN -> None)."""
+    if pd.api.types.is_float_dtype(values.dtype):
+        array = values.to_numpy()
+        out = array.astype(object)
+        out[~np.isfinite(array)] = None
+        return out.tolist()
+    return values.tolist()
+
+@app.route('/api/ec2/query', methods=['POST'])
+@login_required
+def ec2_query_api():
+    data = ec2_data
+    if data is None or data.df.empty:
+        return jsonify({"error": "EC2 pricing data is not available."}), 503
+    body = request.get_json(silent=True)
+    raw_specs = body if isinstance(body, list) else [body]
+    if not raw_specs or len(raw_specs) > EC2_QUERY_MAX_SPECS:
+        return jsonify({"error": f"Send one filter spec or a list of 1 to {EC2_QUERY_MAX_SPECS}."}), 400
+    specs = []
+    for i, raw in enumerate(raw_specs):
+        try:
+            specs.append(parse_ec2_query_spec(raw))
+        except ValueError as e:
+            return jsonify({"error": f"Spec {i}: {e}"}), 400
+
+    matches = data.index.query_many(specs)
+    offsets = np.cumsum([0] + [len(positions) for positions, _ in matches])
+    all_positions = np.concatenate([positions for positions, _ in matches]) if matches else np.zeros(0, dtype=np.int64)
+    gathered = {column: _json_column(data.df[column].take(all_positions)) for column in EC2_QUERY_COLUMNS}
+    results = [{"total": total,
+                "rows": {column: values[offsets[i]:offsets[i + 1]] for column, values in gathered.items()}}
+               for i, (_, total) in enumerate(matches)]
+    return jsonify({"version": data.version, "results": results})
+
+# --- EC2 region prices ---
+# Built on the instance type x region price matrix in EC2Index (the cheapest hourly price of every
+# pair, NaN where a type is not offered), so each lookup is one row or column slice:
+#   GET /api/ec2/regions/cheapest?instance_type=m5.large&n=5
+#       the n cheapest regions for the type (n omitted or "all": every region offering it), each
+#       with its delta from the cheapest region in USD/hour and percent;
+#   GET /api/ec2/regions/compare?region_a=us-east-1&region_b=eu-west-1&limit=50
+#       the types offered in both regions, B's price against A's, biggest saving in B first,
+#       plus how many types are cheaper on each side.
+# /ec2-regions shows the same two reports as a page.
+
+def _count_arg(args, name, default):
+    """A positive integer request arg; "all" gives None and a missing arg gives default. Raises ValueError."""
+    value = args.get(name)
+    if value is None or value == '':
+        return default
+    if value == 'all':
+        return None
+    count = int(value) # ValueError on junk
+    if count < 1:
+        raise ValueError(f"'{name}' must be a positive integer or \"all\".")
+    return count
+
+def ec2_cheapest_regions(data, instance_type, n=None):
+    """Cheapest regions for one instance type with each region's delta from the cheapest; None if the type is unknown."""
+    type_code = data.index.instance_type_code(instance_type)
+    if type_code is None:
+        return None
+    region_codes, prices = data.index.cheapest_regions(type_code)
+    cheapest = prices[0] if len(prices) else np.nan
+    deltas = prices - cheapest
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta_pcts = deltas / cheapest * 100
+    shown = slice(None, n)
+    # vCPU and memory from the row behind the cheapest price
+    row = data.index.arrays['price_matrix_rows'][type_code, region_codes[0]] if len(prices) else -1
+    memory = float(data.df['MemoryGiB'].iat[row]) if row >= 0 else np.nan
+    return {
+        'instance_type': data.index.instance_types[type_code],
+        'vcpu': int(data.df['vCPU'].iat[row]) if row >= 0 else None,
+        'memory_gib': memory if np.isfinite(memory) else None,
+        'regions_offered': len(prices),
+        'regions': [{'region': data.index.regions[code], 'price': price, 'delta': delta, 'delta_pct': pct}
+                    for code, price, delta, pct in zip(region_codes[shown].tolist(), prices[shown].tolist(),
+                                                       deltas[shown].tolist(), delta_pcts[shown].tolist())],
+    }
+
+def ec2_compare_regions(data, region_a, region_b, limit=None):
+    """Price of every type offered in both regions, B against A, biggest saving in B first; None if a region is unknown."""
+    code_a, code_b = data.index.region_code(region_a), data.index.region_code(region_b)
+    if code_a is None or code_b is None:
+        return None
+    type_codes, prices_a, prices_b, only_in_a, only_in_b = data.index.compare_regions(code_a, code_b)
+    deltas = prices_b - prices_a
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta_pcts = deltas / prices_a * 100
+    order = np.argsort(delta_pcts, kind='stable')[:limit]
+    return {
+        'region_a': region_a,
+        'region_b': region_b,
+        'types_compared': len(type_codes),
+        'cheaper_in_a': int(np.count_nonzero(deltas > 0)),
+        'cheaper_in_b': int(np.count_nonzero(deltas < 0)),
+        'same_price': int(np.count_nonzero(deltas == 0)),
+        'only_in_a': only_in_a,
+        'only_in_b': only_in_b,
+        'median_delta_pct': float(np.median(delta_pcts)) if len(type_codes) else None,
+        'instances': [{'instance_type': data.index.instance_types[code], 'price_a': a, 'price_b': b, 'delta': delta, 'delta_pct': pct}
+                      for code, a, b, delta, pct in zip(type_codes[order].tolist(), prices_a[order].tolist(), prices_b[order].tolist(),
+                                                        deltas[order].tolist(), delta_pcts[order].tolist())],
+    }
+
+@app.route('/api/ec2/regions/cheapest')
+@login_required
+def ec2_cheapest_regions_api():
+    data = ec2_data
+    if data is None or data.df.empty:
+        return jsonify({"error": "EC2 pricing data is not available."}), 503
+    instance_type = request.args.get('instance_type', '').strip()
+    if not instance_type:
+        return jsonify({"error": "'instance_type' is required."}), 400
+    try:
+        n = _count_arg(request.args, 'n', None)
+    except ValueError:
+        return jsonify({"error": "'n' must be a positive integer or \"all\"."}), 400
+    report = ec2_cheapest_regions(data, instance_type, n)
+    if report is None:
+        return jsonify({"error": f"Unknown instance type '{instance_type}'."}), 404
+    return jsonify({"version": data.version, **report})
+
+@app.route('/api/ec2/regions/compare')
+@login_required
+def ec2_compare_regions_api():
+    data = ec2_data
+    if data is None or data.df.empty:
+        return jsonify({"error": "EC2 pricing data is not available."}), 503
+    region_a, region_b = request.args.get('region_a', '').strip(), request.args.get('region_b', '').strip()
+    if not region_a or not region_b:
+        return jsonify({"error": "'region_a' and 'region_b' are required."}), 400
+    try:
+        limit = _count_arg(request.args, 'limit', None)
+    except ValueError:
+        return jsonify({"error": "'limit' must be a positive integer or \"all\"."}), 400
+    report = ec2_compare_regions(data, region_a, region_b, limit)
+    if report is None:
+        unknown = region_a if data.index.region_code(region_a) is None else region_b
+        return jsonify({"error": f"Unknown region '{unknown}'."}), 404
+    return jsonify({"version": data.version, **report})
+
+@app.route('/ec2-regions')
+@login_required
+def ec2_regions_tool():
+    data = ec2_data
+    if data is None or data.df.empty:
+        flash("EC2 pricing data is not available. Please check server logs.", "danger")
+        return render_template('ec2_regions.html', regions=[], instance_types=[], cheapest=None, comparison=None)
+
+    try:
+        n = _count_arg(request.args, 'n', None)
+        limit = _count_arg(request.args, 'limit', 50)
+    except ValueError:
+        flash("Counts must be positive whole numbers.", "warning")
+        n, limit = None, 50
+    cheapest = comparison = None
+    instance_type = request.args.get('instance_type', '').strip()
+    if instance_type:
+        cheapest = ec2_cheapest_regions(data, instance_type, n)
+        if cheapest is None:
+            flash(f"Unknown instance type '{instance_type}'.", "warning")
+    region_a, region_b = request.args.get('region_a', ''), request.args.get('region_b', '')
+    if region_a and region_b:
+        comparison = ec2_compare_regions(data, region_a, region_b, limit)
+        if comparison is None:
+            flash("Choose two regions from the list.", "warning")
+
+    return render_template('ec2_regions.html', regions=data.regions, instance_types=data.instance_types,
+                           cheapest=cheapest, comparison=comparison)
+
+# --- EC2 fleet optimizer ---
+# POST /api/ec2/fleet sizes a fleet instead of trying min_vcpu/min_memory filters by hand. The
+# workload is either totals or a list of pods (identical requests grouped with a count):
+#   {"vcpu": 256, "memory_gib": 1024}
+#   {"pods": [{"vcpu": 2, "memory_gib": 4, "count": 30}, {"vcpu": 0.5, "memory_gib": 1, "count": 200}]}
+# with optional "regions", "families" (e.g. ["m5", "c6g"]) and "max_instances". The reply is the
+# cheapest mix found (see fleet_optimizer.py): region, instances with counts, totals, the cheapest
+# plan found per allowed region, for totals the LP lower_bound and whether the mix is proven
+# optimal, and for pods how many of each group go on every instance.
+EC2_FLEET_MAX_PODS = int(os.getenv('EC2_FLEET_MAX_PODS', '100000'))
+
+def parse_fleet_request(raw):
+    """A JSON fleet request -> optimize_fleet() keyword dict. Raises ValueError with a message for the client."""
+    if not isinstance(raw, dict):
+        raise ValueError("The request body must be a JSON object.")
+    unknown = set(raw) - {'vcpu', 'memory_gib', 'pods', 'regions', 'families', 'max_instances'}
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(sorted(unknown))}.")
+
+    def number(value, field):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value < float('inf'):
+            raise ValueError(f"'{field}' must be a non-negative number.")
+        return value
+
+    def names(field):
+        value = raw.get(field)
+        if value is None:
+            return None
+        if not isinstance(value, list) or not all(isinstance(name, str) for name in value):
+            raise ValueError(f"'{field}' must be a list of strings.")
+        return value
+
+    max_instances = raw.get('max_instances')
+    if max_instances is not None and (isinstance(max_instances, bool) or not isinstance(max_instances, int) or max_instances < 1):
+        raise ValueError("'max_instances' must be a positive integer.")
+    options = {'regions': names('regions'), 'families': names('families'), 'max_instances': max_instances}
+
+    if 'pods' in raw:
+        if 'vcpu' in raw or 'memory_gib' in raw:
+            raise ValueError("Give either 'pods' or 'vcpu'/'memory_gib' totals, not both.")
+        if not isinstance(raw['pods'], list) or not raw['pods']:
+            raise ValueError("'pods' must be a non-empty list.")
+        pods = []
+        for i, pod in enumerate(raw['pods']):
+            if not isinstance(pod, dict) or set(pod) - {'vcpu', 'memory_gib', 'count'}:
+                raise ValueError(f"Pod {i} must be an object with 'vcpu', 'memory_gib' and 'count'.")
+            vcpu, memory = number(pod.get('vcpu', 0), f'pods[{i}].vcpu'), number(pod.get('memory_gib', 0), f'pods[{i}].memory_gib')
+            count = pod.get('count', 1)
+            if isinstance(count, bool) or not isinstance(count, int) or count < 1:
+                raise ValueError(f"'pods[{i}].count' must be a positive integer.")
+            if not vcpu and not memory:
+                raise ValueError(f"Pod {i} must request some vCPU or memory.")
+            pods.append((vcpu, memory, count))
+        if sum(count for _, _, count in pods) > EC2_FLEET_MAX_PODS:
+            raise ValueError(f"At most {EC2_FLEET_MAX_PODS} pods per request.")
+        options['pods'] = pods
+    else:
+        options['vcpu'] = number(raw.get('vcpu', 0), 'vcpu')
+        options['memory_gib'] = number(raw.get('memory_gib', 0), 'memory_gib')
+        if not options['vcpu'] and not options['memory_gib']:
+            raise ValueError("Give 'vcpu' and/or 'memory_gib' totals, or 'pods'.")
+    return options
+
+@app.route('/api/ec2/fleet', methods=['POST'])
+@login_required
+def ec2_fleet_api():
+    data = ec2_data
+    if data is None or data.df.empty:
+        return jsonify({"error": "EC2 pricing data is not available."}), 503
+    try:
+        started = time.perf_counter()
+        plan = optimize_fleet(data.index, **parse_fleet_request(request.get_json(silent=True)))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if plan is None:
+        return jsonify({"error": "No instance mix in the allowed regions and families satisfies the workload."}), 422
+    return jsonify({"version": data.version, "search_ms": round((time.perf_counter() - started) * 1000, 1), **plan})
 
 # ... (rest of your server.py code for main, etc.)
 
 
 if __name__ == '__main__':
     init_db()
+    email_outbox.start() # drain mail queued before a restart
     load_and_preprocess_ec2_data() # Load data at startup
+    start_ec2_data_watcher() # then pick up CSV changes without a restart
     print("DB Path:", os.path.abspath(DB_PATH))
     print(f"Flask app secret key is: {'SET (length ' + str(len(app.secret_key)) + ')' if app.secret_key and app.secret_key != 'a_very_secure_default_secret_key_123!PleaseChange' else 'NOT SET (USING DEFAULT FALLBACK - INSECURE!)'}")
-    if not APP_EMAIL_SENDER or not APP_EMAIL_PASSWORD:
-        print("WARNING: Email sending credentials (EMAIL_USER or PASSWORD in .env) are not fully configured. OTP emails will fail.")
+    if not APP_EMAIL_SENDER:
+        print("WARNING: Email sender (EMAIL_USER in .env) is not configured. OTP emails will fail.")
     else:
-        print(f"Email sending configured with user: {APP_EMAIL_SENDER}")
+        print(f"Email sending configured with user: {APP_EMAIL_SENDER} via {SMTP_HOST}:{SMTP_PORT} (login {'on' if APP_EMAIL_PASSWORD else 'off'})")
     
     app.run(host='0.0.0.0', port=5002, debug=True, use_reloader=True) # use_reloader=False if you have issues with data loading twice on startup
\ No newline at end of file
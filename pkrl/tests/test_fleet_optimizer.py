@@ -0,0 +1,81 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ec2_cache import preprocess_ec2_frame
+from ec2_index import EC2Index, build_index_arrays
+from fleet_optimizer import _cover_totals, _lp_relaxation, optimize_fleet
+
+REGIONS = ['eu-west-1', 'us-east-1']
+
+
+def random_index(rng, types=7):
+    """A catalog of random integer shapes in two regions, priced per vCPU and GiB with +-40% noise per region."""
+    shapes = [(int(rng.integers(1, 17)), int(rng.integers(1, 33))) for _ in range(types)]
+    rows = [(region, f'x{i}.large', vcpu, f'{memory} GiB', round(float((0.04 * vcpu + 0.01 * memory) * rng.uniform(0.6, 1.4)), 4))
+            for region in REGIONS for i, (vcpu, memory) in enumerate(shapes)]
+    df = preprocess_ec2_frame(pd.DataFrame(rows, columns=['Region', 'InstanceType', 'vCPU', 'Memory', 'PricePerHourUSD']))
+    return EC2Index(df, build_index_arrays(df))
+
+
+def brute_force(index, vcpu, memory, max_instances):
+    """Cheapest fleet over all regions by DP on (instances, vCPU still needed, GiB still needed)."""
+    best = np.inf
+    df = index.df
+    for region in REGIONS:
+        rows = df[df['Region'] == region]
+        shapes = list(zip(rows['vCPU'].astype(int), rows['MemoryGiB'].astype(int), rows['PricePerHourUSD']))
+        cost = np.full((vcpu + 1, memory + 1), np.inf)
+        cost[0, 0] = 0.0
+        for _ in range(max_instances):
+            step = cost.copy()
+            for v, m, price in shapes:
+                left = np.ix_(np.maximum(np.arange(vcpu + 1) - v, 0), np.maximum(np.arange(memory + 1) - m, 0))
+                step = np.minimum(step, price + cost[left])
+            cost = step
+        best = min(best, cost[vcpu, memory])
+    return best
+
+
+class OptimizeFleetTotalsTest(unittest.TestCase):
+    def test_matches_brute_force(self):
+        # About one case in eight here needs three or more types, which a pairwise search misses.
+        rng = np.random.default_rng(2)
+        for case in range(40):
+            index = random_index(rng)
+            vcpu, memory = int(rng.integers(1, 41)), int(rng.integers(1, 81))
+            max_instances = int(rng.integers(2, 7)) if case % 2 else 12
+            with self.subTest(case=case, vcpu=vcpu, memory=memory, max_instances=max_instances):
+                expected = brute_force(index, vcpu, memory, max_instances)
+                plan = optimize_fleet(index, vcpu=vcpu, memory_gib=memory, max_instances=max_instances)
+                if not np.isfinite(expected):
+                    self.assertIsNone(plan)
+                    continue
+                self.assertAlmostEqual(plan['hourly_cost'], expected, places=6)
+                self.assertTrue(plan['optimal'])
+                self.assertLessEqual(plan['lower_bound'], plan['hourly_cost'] + 1e-9)
+                self.assertLessEqual(plan['instance_count'], max_instances)
+                self.assertGreaterEqual(plan['vcpu'], vcpu)
+                self.assertGreaterEqual(plan['memory_gib'], memory)
+
+    def test_node_budget(self):
+        rng = np.random.default_rng(3)
+        columns = rng.uniform(0.1, 1, 40), rng.integers(1, 65, 40).astype(float), rng.integers(1, 257, 40).astype(float)
+        relaxation = _lp_relaxation(*columns, 1000, 3000)
+        cost, _, bound, nodes = _cover_totals(*columns, 1000, 3000, None, relaxation, np.inf, 10 ** 6)
+        cut_cost, cut_counts, _, cut_nodes = _cover_totals(*columns, 1000, 3000, None, relaxation, np.inf, 1)
+        self.assertGreater(nodes, 1)
+        self.assertLessEqual(relaxation[0], bound)
+        self.assertLessEqual(bound, cost)
+        self.assertGreater(cut_nodes, 1)
+        self.assertGreaterEqual(cut_cost, cost - 1e-9)
+        self.assertGreaterEqual(sum(columns[1][cell] * count for cell, count in cut_counts.items()), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import gzip
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingest_offers import JSONStream, parse_offer_file
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'us-east-1.json')
+
+# Linux/Shared On-Demand rows of the fixture: the Windows, Dedicated, capacity-reservation and
+# storage products are filtered out, Reserved terms are ignored, and the bare-metal product has no
+# regionCode so it takes the region from the file name.
+EXPECTED = {
+    'Region': ['us-east-1', 'us-east-1'],
+    'InstanceType': ['m5.large', 'c5.metal'],
+    'vCPU': [2, 96],
+    'Memory': ['8 GiB', '192 GiB'],
+    'PricePerHourUSD': [0.096, 4.08],
+}
+
+
+class ParseOfferFileTest(unittest.TestCase):
+    def test_rows(self):
+        columns, products_seen = parse_offer_file(FIXTURE)
+        self.assertEqual(columns, EXPECTED)
+        self.assertEqual(products_seen, 6)
+
+    def test_reserved_terms_are_skipped(self):
+        columns, _ = parse_offer_file(FIXTURE)
+        self.assertNotIn(0.0123456789, columns['PricePerHourUSD'])
+
+    def test_gzip_input(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'us-east-1.json.gz')
+        with open(FIXTURE, 'rb') as src, gzip.open(path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        self.assertEqual(parse_offer_file(path), (EXPECTED, 6))
+
+    def test_every_chunk_boundary(self):
+        # Small chunks put a boundary inside every token of the file at some size, including the bare number 4.08.
+        for chunk_size in range(1, 80):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(parse_offer_file(FIXTURE, chunk_size=chunk_size), (EXPECTED, 6))
+
+
+class JSONStreamTest(unittest.TestCase):
+    def test_number_cut_at_chunk_edge(self):
+        text = '{"a": 12345.678, "b": -0.5e3, "c": [1, 22]}'
+        for chunk_size in range(1, len(text) + 1):
+            with self.subTest(chunk_size=chunk_size):
+                stream = JSONStream(io.StringIO(text), chunk_size)
+                self.assertEqual({key: stream.value() for key in stream.items()}, {'a': 12345.678, 'b': -500.0, 'c': [1, 22]})
+
+    def test_skip(self):
+        stream = JSONStream(io.StringIO('{"skip": {"x": [1, {"y": 2}], "z": "}"}, "keep": 7}'), 4)
+        seen = {}
+        for key in stream.items():
+            if key == 'skip':
+                stream.skip()
+            else:
+                seen[key] = stream.value()
+        self.assertEqual(seen, {'keep': 7})
+
+
+if __name__ == '__main__':
+    unittest.main()